@@ -0,0 +1,85 @@
+"""
+Numeric arrays backed by numpy ndarrays. The + - * / BinOps and the - UnOp
+are plain operator functions, so they already work elementwise when an
+operand is an array; this module adds constructors and reductions as
+builtins, see install.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from runtime import LinkList, build_list, sclist2pylist
+
+
+def as_array(value):
+    if isinstance(value, LinkList):
+        return numpy.array(sclist2pylist(value))
+    return numpy.asarray(value)
+
+
+def scalar(value):
+    """ numpy scalars back to python numbers """
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+
+def make_array(n, fill=0.0):
+    """ (make-array n [fill]) """
+    return [numpy.full(n, fill)]
+
+
+def array_from_list(lst):
+    """ (array-from-list lst) """
+    return [as_array(lst)]
+
+
+def load_array(path, delimiter=None):
+    """ (load-array path [delimiter]), a text file of numbers """
+    return [numpy.loadtxt(path, delimiter=delimiter, ndmin=1)]
+
+
+def array_to_list(array):
+    return [build_list(array.tolist())]
+
+
+def array_ref(array, index):
+    return [scalar(array[index])]
+
+
+def array_length(array):
+    return [len(array)]
+
+
+def array_sum(value):
+    return [scalar(numpy.sum(as_array(value)))]
+
+
+def array_max(value):
+    return [scalar(numpy.max(as_array(value)))]
+
+
+def array_dot(a, b):
+    return [scalar(numpy.dot(as_array(a), as_array(b)))]
+
+
+BUILTINS = {
+    "make-array": make_array,
+    "array-from-list": array_from_list,
+    "load-array": load_array,
+    "array->list": array_to_list,
+    "array-ref": array_ref,
+    "array-length": array_length,
+    "sum": array_sum,
+    "max": array_max,
+    "dot": array_dot,
+}
+
+
+def install(env):
+    """ add the array builtins to 'env' """
+    if numpy is None:
+        raise ImportError("arrays need numpy")
+    env.update(BUILTINS)
+    return env
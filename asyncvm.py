@@ -0,0 +1,48 @@
+"""
+Run stack VMs on an asyncio event loop (trollius on python 2). A VM runs
+for a budget of instructions and then yields to the loop, so a long loop
+in a script doesn't stall the other tasks. A host function may return a
+coroutine or a future instead of a list, the VM is suspended until it
+resolves and its result becomes the value of the call. A runtime.Native
+can't suspend the VM, an awaitable it returns is the value of the call.
+
+    loop.run_until_complete(asyncio.gather(*[asyncvm.run(vm) for vm in vms]))
+"""
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    asyncio = None
+
+from vm import Suspend
+
+DEFAULT_BUDGET = 1000
+
+
+if asyncio is not None:
+    @asyncio.coroutine
+    def run(vm, budget=DEFAULT_BUDGET, loop=None):
+        """ run 'vm' to the end, 'budget' instructions at a time """
+        while not vm.run_slice(budget):
+            if vm.awaiting is None:
+                # budget used up, let the other tasks run.
+                yield From(asyncio.sleep(0, loop=loop))
+            else:
+                value = yield From(asyncio.async(vm.awaiting, loop=loop))
+                vm.resume(value)
+        raise Return(None)
+else:
+    def run(vm, budget=DEFAULT_BUDGET, loop=None):
+        raise ImportError("asyncvm needs trollius")
+
+
+def run_sync(vm, budget=DEFAULT_BUDGET, wait=None):
+    """
+    run 'vm' without an event loop, 'wait(awaitable)' returns the value of
+    an awaitable a host function returned.
+    """
+    while not vm.run_slice(budget):
+        if vm.awaiting is not None:
+            if wait is None:
+                raise Suspend(vm.awaiting)
+            vm.resume(wait(vm.awaiting))
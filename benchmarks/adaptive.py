@@ -0,0 +1,49 @@
+"""
+Run programs with and without adaptive quickening of arithmetic, list
+and test instructions, and print what got specialized.
+
+    python -m benchmarks.adaptive
+"""
+import sys
+
+import vm
+import code
+import runtime
+from benchmarks.dispatch import PROGRAMS, best_of
+from benchmarks.calls import TAK
+
+SOURCES = dict(PROGRAMS, tak=TAK % (18, 12, 6))
+SOURCES["float"] = """
+    (define (loop i x acc) (if (> i 0) (loop (- i 1) (* x 1.0001) (+ acc x)) acc))
+    (loop 100000 1.0 0.0)
+"""
+SOURCES["lists"] = """
+    (define (build n acc) (if (= n 0) acc (build (- n 1) (cons n acc))))
+    (define (total l acc) (if l (total (cdr l) (+ acc (car l))) acc))
+    (define (repeat n acc) (if (= n 0) acc (repeat (- n 1) (+ acc (total (build 1000 0) 0)))))
+    (repeat 50 0)
+"""
+
+
+def run(consts, adaptive):
+    machine = vm.VM(consts, runtime.Globals(), adaptive=adaptive)
+    machine.start()
+    return machine
+
+
+def main(argv):
+    names = argv[1:] or sorted(SOURCES)
+    print "%-10s %10s %10s %8s %12s %8s" % (
+        "program", "generic", "adaptive", "ratio", "specialized", "deopts")
+    for name in names:
+        consts = code.compile_source(SOURCES[name])
+        generic = best_of(lambda: run(consts, False))
+        adaptive = best_of(lambda: run(consts, True))
+        stats = run(code.compile_source(SOURCES[name]), True).specialization_stats()
+        print "%-10s %8.1fms %8.1fms %7.2fx %12d %8d" % (
+            name, generic * 1000, adaptive * 1000, generic / adaptive,
+            sum(s[1] for s in stats), sum(s[3] for s in stats))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,79 @@
+"""
+Cost of calling a host function from Lisp, with the list returning
+convention and as a runtime.Native. The first table times the OpCall
+handler alone, the second whole programs.
+
+    python -m benchmarks.builtins
+"""
+import sys
+import timeit
+
+import vm
+import code
+import runtime
+from benchmarks.dispatch import best_of
+
+CALLS = 100000
+
+SOURCES = {
+    "1 arg": """
+        (define (loop n acc) (if (= n 0) acc (loop (- n 1) (inc acc))))
+        (loop %d 0)
+    """ % CALLS,
+    "2 args": """
+        (define (loop n acc) (if (= n 0) acc (loop (- n 1) (add acc n))))
+        (loop %d 0)
+    """ % CALLS,
+    "tail call": """
+        (define (loop n) (if (= n 0) 0 (begin (inc n) (loop (- n 1)))))
+        (define (f n) (inc n))
+        (loop %d)
+    """ % CALLS,
+}
+
+LIST_ENV = {
+    "inc": lambda a: [a + 1],
+    "add": lambda a, b: [a + b],
+}
+
+NATIVE_ENV = {
+    "inc": runtime.Native(lambda a: a + 1, 1),
+    "add": runtime.Native(lambda a, b: a + b, 2),
+}
+
+
+def call_time(func, argn):
+    """ seconds per OpCall of 'func' with 'argn' arguments """
+    stack = []
+    frame = vm.Frame.__new__(vm.Frame)
+    frame.stack = stack
+    args = range(argn)
+
+    def call():
+        stack.append(func)
+        stack.extend(args)
+        vm.op_call(None, frame, argn)
+        stack.pop()
+    return min(timeit.repeat(call, number=CALLS, repeat=5)) / CALLS
+
+
+def main(argv):
+    print "%-10s %10s %10s %8s" % ("OpCall", "list", "native", "ratio")
+    for argn in range(4):
+        times = [call_time(lambda *args: [None], argn),
+                 call_time(runtime.Native(lambda *args: None, argn), argn)]
+        print "%-10s %8.2fus %8.2fus %7.2fx" % (
+            "%d args" % argn, times[0] * 1e6, times[1] * 1e6, times[0] / times[1])
+
+    names = argv[1:] or sorted(SOURCES)
+    print "%-10s %10s %10s %8s" % ("program", "list", "native", "ratio")
+    for name in names:
+        consts = code.compile_source(SOURCES[name])
+        times = [best_of(lambda: vm.VM(consts, runtime.Globals(env)).start())
+                 for env in (LIST_ENV, NATIVE_ENV)]
+        print "%-10s %8.1fms %8.1fms %7.2fx" % (
+            name, times[0] * 1000, times[1] * 1000, times[0] / times[1])
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,60 @@
+"""
+Call throughput of the VM on call heavy programs, with a plain dict env
+and with a runtime.Globals one, whose global loads are quickened to slots.
+
+    python -m benchmarks.calls
+"""
+import sys
+
+import vm
+import code
+import runtime
+from benchmarks.dispatch import best_of
+
+FIB = """
+(define (fib n) (if (> 2 n) n (+ (fib (- n 1)) (fib (- n 2)))))
+(fib %d)
+"""
+
+TAK = """
+(define (tak x y z)
+  (if (> x y)
+      (tak (tak (- x 1) y z) (tak (- y 1) z x) (tak (- z 1) x y))
+      z))
+(tak %d %d %d)
+"""
+
+
+def fib_calls(n):
+    if n < 2:
+        return 1
+    return 1 + fib_calls(n - 1) + fib_calls(n - 2)
+
+
+def tak_count(x, y, z):
+    count = [0]
+
+    def tak(x, y, z):
+        count[0] += 1
+        if x > y:
+            return tak(tak(x - 1, y, z), tak(y - 1, z, x), tak(z - 1, x, y))
+        return z
+    tak(x, y, z)
+    return count[0]
+
+
+def main(argv):
+    cases = [
+        ("fib 20", FIB % 20, fib_calls(20)),
+        ("tak 18 12 6", TAK % (18, 12, 6), tak_count(18, 12, 6)),
+    ]
+    print "%-12s %-8s %10s %10s %12s" % ("program", "globals", "calls", "time", "calls/sec")
+    for name, source, calls in cases:
+        consts = code.compile_source(source)
+        for env_name, make_env in (("dict", dict), ("slots", runtime.Globals)):
+            elapsed = best_of(lambda: vm.VM(consts, make_env()).start())
+            print "%-12s %-8s %10d %8.1fms %12.0f" % (
+                name, env_name, calls, elapsed * 1000, calls / elapsed)
+
+if __name__ == "__main__":
+    main(sys.argv)
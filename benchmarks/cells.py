@@ -0,0 +1,60 @@
+"""
+Memory per cell and build time of a list built with runtime.build_list,
+against cells with a per instance __dict__ as LinkList had before. Every
+kind of cell is built in a process of its own, the growth of its peak
+memory over the whole list is divided by the number of cells.
+
+    python -m benchmarks.cells [cells]
+"""
+import sys
+import time
+import subprocess
+
+import runtime
+from benchmarks.suite import peak_kb
+
+
+class DictCell(object):
+    def __init__(self, v, next=None):
+        self.v = v
+        self.next = next
+
+
+def build(cls, seq):
+    ret = None
+    for i in reversed(seq):
+        ret = cls(i, ret)
+    return ret
+
+
+BUILDERS = {
+    "dict": lambda seq: build(DictCell, seq),
+    "slots": runtime.build_list,
+}
+
+
+def measure(name, n):
+    """ run in the child process, bytes per cell and build time in seconds """
+    seq = range(n)
+    before = peak_kb()
+    start = time.time()
+    head = BUILDERS[name](seq)
+    elapsed = time.time() - start
+    return (peak_kb() - before) * 1024.0 / n, elapsed
+
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == "--child":
+        print "%f %f" % measure(argv[2], int(argv[3]))
+        return
+    n = int(argv[1]) if len(argv) > 1 else 1000000
+    print "%-10s %12s %10s" % ("cell", "bytes/cell", "build")
+    for name in ("dict", "slots"):
+        output = subprocess.check_output(
+            [sys.executable, "-m", "benchmarks.cells", "--child", name, str(n)])
+        size, elapsed = map(float, output.split())
+        print "%-10s %12.0f %8.0fms" % (name, size, elapsed * 1000)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
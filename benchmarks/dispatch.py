@@ -0,0 +1,65 @@
+"""
+Compare the if/elif dispatch loop with the handler table on the same
+programs.
+
+    python -m benchmarks.dispatch
+"""
+import sys
+import time
+
+import vm
+import code
+
+PROGRAMS = {
+    "tail_sum": """
+        (define (sum from to)
+          (begin
+            (define (iter from to acc)
+              (if (> from to)
+                  acc
+                  (iter (+ from 1) to (+ acc from))))
+            (iter from to 0)))
+        (sum 1 100000)
+    """,
+    "fib": """
+        (define (fib n) (if (> 2 n) n (+ (fib (- n 1)) (fib (- n 2)))))
+        (fib 20)
+    """,
+    "closure": """
+        (define (mul x y) (* x y))
+        (define (muln n) (lambda (x) (mul x n)))
+        (define (loop i acc)
+          (if (= i 0) acc (loop (- i 1) (+ acc (let ((f (muln i))) (f 2))))))
+        (loop 30000 0)
+    """,
+}
+
+
+def best_of(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run(source, dispatch):
+    consts = code.compile_source(source)
+    return best_of(lambda: vm.VM(consts, {}, dispatch=dispatch).start())
+
+
+def main(argv):
+    names = argv[1:] or sorted(PROGRAMS)
+    modes = (vm.VM.DISPATCH_SWITCH, vm.VM.DISPATCH_TABLE)
+    print "%-10s %12s %12s %8s" % (("program",) + modes + ("ratio",))
+    for name in names:
+        times = [run(PROGRAMS[name], mode) for mode in modes]
+        print "%-10s %10.1fms %10.1fms %7.2fx" % (
+            name, times[0] * 1000, times[1] * 1000, times[0] / times[1])
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,77 @@
+"""
+Tokens per second of the legacy and the fast lexer on a generated source.
+
+    python -m benchmarks.lexer [megabytes]
+"""
+import os
+import sys
+import mmap
+import tempfile
+
+from parser import Lexer, EOF_TOKEN
+from benchmarks.dispatch import best_of
+
+FORM = """\
+; record %(i)d
+(define (item%(i)d x . rest)
+  (if (> x %(i)d) "item %(i)d" `(x ,rest (+ x -%(i)d.5))))
+(display (item%(i)d %(i)d 1 2 3) 'done)
+"""
+
+
+def generate(megabytes):
+    size = int(megabytes * (1 << 20))
+    forms = []
+    total = 0
+    i = 0
+    while total < size:
+        form = FORM % {"i": i}
+        forms.append(form)
+        total += len(form)
+        i += 1
+    return "".join(forms)
+
+
+def count(lexer):
+    n = 0
+    while lexer.next() is not EOF_TOKEN:
+        n += 1
+    return n
+
+
+def main(argv):
+    megabytes = float(argv[1]) if len(argv) > 1 else 4
+    source = generate(megabytes)
+    fd, path = tempfile.mkstemp(suffix=".lisp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(source)
+        ntokens = count(Lexer(source, fast=True))
+
+        def from_file():
+            with open(path, "rb") as f:
+                count(Lexer(f, fast=True))
+
+        def from_mmap():
+            with open(path, "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                count(Lexer(m, fast=True))
+                m.close()
+
+        cases = [
+            ("legacy", lambda: count(Lexer(source))),
+            ("fast", lambda: count(Lexer(source, fast=True))),
+            ("file", from_file),
+            ("mmap", from_mmap),
+        ]
+        print "%.1fMB, %d tokens" % (len(source) / float(1 << 20), ntokens)
+        print "%-8s %10s %14s" % ("lexer", "time", "tokens/sec")
+        for name, func in cases:
+            elapsed = best_of(func, repeat=3)
+            print "%-8s %8.0fms %14.0f" % (name, elapsed * 1000, ntokens / elapsed)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
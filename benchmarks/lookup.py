@@ -0,0 +1,58 @@
+"""
+Build a table of n keys as an association list and as a hash table and
+time lookups of keys spread evenly over it, per lookup. A lookup in the
+alist scans half of it on average.
+
+    python -m benchmarks.lookup [n ...]
+"""
+import sys
+import time
+
+import toplevel
+
+SIZES = [10000, 100000, 1000000]
+
+BUILD = """
+(define (build-alist i n acc) (if (= i n) acc (build-alist (+ i 1) n (cons (cons i i) acc))))
+(define (build-hash i n h) (if (= i n) h (begin (hash-set! h i i) (build-hash (+ i 1) n h))))
+(define (assoc k l) (if l (if (= (car (car l)) k) (car l) (assoc k (cdr l))) 0))
+(define (alist-lookups i m step l acc)
+  (if (= i m) acc (alist-lookups (+ i 1) m step l (+ acc (cdr (assoc (* i step) l))))))
+(define (hash-lookups i m step h acc)
+  (if (= i m) acc (hash-lookups (+ i 1) m step h (+ acc (hash-ref h (* i step))))))
+"""
+
+# lookups timed per table, the alist ones get fewer as it grows.
+HASH_LOOKUPS = 100000
+ALIST_WORK = 2000000
+
+
+def timed(top, source):
+    t = time.time()
+    value = top.run(source)
+    return time.time() - t, value
+
+
+def main(argv):
+    sizes = [int(n) for n in argv[1:]] or SIZES
+    sys.setrecursionlimit(100000)
+    print "%-8s %10s %10s %12s %12s %8s" % (
+        "keys", "alist", "hash", "alist/op", "hash/op", "ratio")
+    for n in sizes:
+        top = toplevel.TopLevel(toplevel.default_env())
+        top.run(BUILD)
+        alist_build, _ = timed(top, "(define l (build-alist 0 %d 0))" % n)
+        hash_build, _ = timed(top, "(define h (build-hash 0 %d (make-hash-table)))" % n)
+        m = max(1, min(n, ALIST_WORK // n))
+        alist, a = timed(top, "(alist-lookups 0 %d %d l 0)" % (m, n // m))
+        k = min(n, HASH_LOOKUPS)
+        hashed, b = timed(top, "(hash-lookups 0 %d %d h 0)" % (k, n // k))
+        assert a == sum(i * (n // m) for i in range(m))
+        assert b == sum(i * (n // k) for i in range(k))
+        print "%-8d %8.1fms %8.1fms %10.1fus %10.2fus %7.0fx" % (
+            n, alist_build * 1000, hash_build * 1000, alist / m * 1e6,
+            hashed / k * 1e6, (alist / m) / (hashed / k))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
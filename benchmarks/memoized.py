@@ -0,0 +1,57 @@
+"""
+Run recursive functions over repeated keys as plain defines and with
+define-memo, and print the cache counters of the memoized run.
+
+    python -m benchmarks.memoized
+"""
+import sys
+
+import vm
+import code
+import toplevel
+from benchmarks.dispatch import best_of
+
+# (program, name of the memoized function), %s is define or define-memo
+SOURCES = {
+    "paths": ("""
+    (%s (paths x y)
+      (if (= x 0) 1 (if (= y 0) 1 (+ (paths (- x 1) y) (paths x (- y 1))))))
+    (paths 9 9)
+    """, "paths"),
+    "fib": ("""
+    (%s (fib n) (if (> 2 n) n (+ (fib (- n 1)) (fib (- n 2)))))
+    (fib 22)
+    """, "fib"),
+    # the same lists, built again for every round, are looked up by value.
+    "lists": ("""
+    (%s (score l) (if l (+ (* (car l) (car l)) (score (cdr l))) 0))
+    (define (build n acc) (if (= n 0) acc (build (- n 1) (cons n acc))))
+    (define (rounds n acc) (if (= n 0) acc (rounds (- n 1) (+ acc (score (build 200 0))))))
+    (rounds 200 0)
+    """, "score"),
+}
+
+
+def run(consts):
+    env = toplevel.default_env()
+    vm.VM(consts, env).start()
+    return env
+
+
+def main(argv):
+    names = argv[1:] or sorted(SOURCES)
+    print "%-8s %10s %10s %8s %8s %8s" % (
+        "program", "define", "memo", "ratio", "hits", "misses")
+    for name in names:
+        source, func = SOURCES[name]
+        plain = code.compile_source(source % "define")
+        memoized = code.compile_source(source % "define-memo")
+        t1 = best_of(lambda: run(plain))
+        t2 = best_of(lambda: run(memoized))
+        cache = run(memoized)[func].cache
+        print "%-8s %8.1fms %8.1fms %7.2fx %8d %8d" % (
+            name, t1 * 1000, t2 * 1000, t1 / t2, cache.hits, cache.misses)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,45 @@
+"""
+Instruction counts and wall time with and without the peephole pass.
+
+    python -m benchmarks.peephole
+"""
+import sys
+
+import vm
+import code
+from benchmarks.dispatch import PROGRAMS, best_of
+
+
+def static_count(consts):
+    return sum(len(c.insts) for c in consts if isinstance(c, code.FunctionProto))
+
+
+def dynamic_count(consts):
+    count = [0]
+
+    def counted(handler):
+        def count_inst(m, frame, operand):
+            count[0] += 1
+            return handler(m, frame, operand)
+        return count_inst
+
+    m = vm.VM(consts, {})
+    m.handlers[:] = [counted(h) for h in m.handlers]
+    m.start()
+    return count[0]
+
+
+def main(argv):
+    names = argv[1:] or sorted(PROGRAMS)
+    print "%-10s %-6s %8s %10s %10s" % ("program", "pass", "static", "executed", "time")
+    for name in names:
+        for peephole in (False, True):
+            consts = code.compile_source(PROGRAMS[name], peephole=peephole)
+            elapsed = best_of(lambda: vm.VM(consts, {}).start())
+            print "%-10s %-6s %8d %10d %8.1fms" % (
+                name, "on" if peephole else "off", static_count(consts),
+                dynamic_count(consts), elapsed * 1000)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,47 @@
+"""
+Stack machine against register machine: dispatched instructions and
+wall time on the same programs.
+
+    python -m benchmarks.register
+"""
+import sys
+
+import vm
+import regvm
+import code
+from benchmarks.dispatch import PROGRAMS, best_of
+
+
+def counted(machine):
+    count = [0]
+
+    def wrap(handler):
+        def count_inst(m, frame, inst):
+            count[0] += 1
+            return handler(m, frame, inst)
+        return count_inst
+
+    machine.handlers[:] = [wrap(h) for h in machine.handlers]
+    machine.start()
+    return count[0]
+
+
+BACKENDS = [
+    ("stack", lambda consts: vm.VM(consts, {})),
+    ("register", lambda consts: regvm.RegisterVM(consts, {})),
+]
+
+
+def main(argv):
+    names = argv[1:] or sorted(PROGRAMS)
+    print "%-10s %-9s %10s %10s" % ("program", "backend", "executed", "time")
+    for name in names:
+        for backend, make_vm in BACKENDS:
+            consts = code.compile_source(PROGRAMS[name], backend=backend)
+            executed = counted(make_vm(consts))
+            elapsed = best_of(lambda: make_vm(consts).start())
+            print "%-10s %-9s %10d %8.1fms" % (name, backend, executed, elapsed * 1000)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,63 @@
+"""
+Startup cost of a script: cold compile from source against a warm load
+from the on-disk bytecode cache.
+
+    python -m benchmarks.startup [number-of-functions]
+"""
+import sys
+import time
+import shutil
+import tempfile
+
+import vm
+import code
+import bytecode
+
+
+def make_source(n):
+    lines = []
+    for i in range(n):
+        lines.append("(define (f%d x y) (if (> x y) (+ x %d) (* y %d)))" % (i, i, i))
+        lines.append("(define g%d (lambda (a) (f%d a %d)))" % (i, i, i))
+    lines.append("(define result (g0 1))")
+    return "\n".join(lines)
+
+
+def best_of(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 500
+    source = make_source(n)
+    directory = tempfile.mkdtemp()
+    try:
+        cache = bytecode.Cache(directory)
+        cache.compile(source)
+
+        def cold():
+            vm.VM(code.compile_source(source), {}).start()
+
+        def warm():
+            vm.VM(cache.compile(source), {}).start()
+
+        t_cold = best_of(cold)
+        t_warm = best_of(warm)
+    finally:
+        shutil.rmtree(directory)
+
+    print "source: %d bytes, %d top-level forms" % (len(source), 2 * n + 1)
+    print "cold (parse + compile + run): %8.2f ms" % (t_cold * 1000)
+    print "warm (cache load + run):      %8.2f ms" % (t_warm * 1000)
+    print "speedup:                      %8.1fx" % (t_cold / t_warm)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
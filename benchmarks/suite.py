@@ -0,0 +1,211 @@
+"""
+Benchmark suite. Every program runs in a process of its own, which times
+the parse, compile and execute phases and records how much each one raises
+the peak memory of the process. Results are written as JSON and compared
+against a baseline, a slowdown beyond the threshold fails the run.
+
+    python -m benchmarks.suite [-o results.json] [-b baseline.json]
+                               [-t 0.25] [--save-baseline] [program ...]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+from benchmarks.dispatch import PROGRAMS as DISPATCH_PROGRAMS
+from benchmarks.calls import TAK
+from benchmarks.startup import make_source
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+PROGRAMS = {
+    "tail_sum": DISPATCH_PROGRAMS["tail_sum"],
+    "fib": DISPATCH_PROGRAMS["fib"],
+    "closure": DISPATCH_PROGRAMS["closure"],
+    "tak": TAK % (18, 12, 6),
+    "lists": """
+        (define (build n acc) (if (= n 0) acc (build (- n 1) (cons n acc))))
+        (define (total l acc) (if l (total (cdr l) (+ acc (car l))) acc))
+        (define (lists i acc)
+          (if (= i 0) acc (lists (- i 1) (+ acc (car (cdr (list i i i i)))))))
+        (total (build 20000 0) (lists 5000 0))
+    """,
+    "varargs": """
+        (define (first . a) (car a))
+        (define (len l) (if l (+ 1 (len (cdr l))) 0))
+        (define (count . a) (len a))
+        (define (loop i acc)
+          (if (= i 0) acc (loop (- i 1) (+ acc (+ (first i 1 2 3) (count i 1))))))
+        (loop 20000 0)
+    """,
+    "compile": make_source(1000),
+}
+
+# metrics compared against the baseline, all of them lower is better.
+TIMES = ("parse_ms", "compile_ms", "execute_ms")
+PHASES = ("parse", "compile", "execute")
+# times and peak memory growth below these are noise, a phase of a few
+# milliseconds varies by a third between runs. ru_maxrss moves by
+# whole arenas, a phase growing by a megabyte or two in one run and not in
+# the next, so memory is gated only on growth of several megabytes.
+MIN_TIME_MS = 50.0
+MIN_MEMORY_KB = 4096
+
+
+def peak_kb():
+    # ru_maxrss is in kilobytes on linux and bytes on darwin.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak
+
+
+def measure(name, repeat):
+    """ run in the child process, returns the results of one program """
+    import vm
+    import code
+    import optimize
+    import profiler
+    from parser import Parser, Transform, traverse
+    from runtime import Globals, build_list
+
+    source = PROGRAMS[name]
+
+    def make_env():
+        return Globals(display=lambda *args: [None],
+                       list=lambda *args: [build_list(args)])
+
+    def parse():
+        ast = Parser(source, fast=True).exprs()
+        traverse(ast, Transform())
+        return ast
+
+    def compile(ast):
+        optimize.fold(ast)
+        return optimize.peephole(code.generate(ast))
+
+    def execute(consts):
+        vm.VM(consts, make_env()).start()
+
+    best = dict((phase, None) for phase in PHASES)
+    memory = {}
+    for i in range(repeat):
+        value = None
+        for phase, func in (("parse", parse), ("compile", compile),
+                            ("execute", execute)):
+            before = peak_kb()
+            start = time.time()
+            value = func(value) if phase != "parse" else func()
+            elapsed = time.time() - start
+            if i == 0:
+                memory[phase] = peak_kb() - before
+            if best[phase] is None or elapsed < best[phase]:
+                best[phase] = elapsed
+
+    counter = profiler.Profiler()
+    counter.run(vm.VM(compile(parse()), make_env()))
+    instructions = sum(counter.counts.values())
+    calls = sum(counter.counts[op] for op in (vm.OpCall, vm.OpTailCall,
+                                              vm.OpCallCached, vm.OpTailCallCached))
+    execute_time = max(best["execute"], 1e-9)
+    return {
+        "parse_ms": best["parse"] * 1000,
+        "compile_ms": best["compile"] * 1000,
+        "execute_ms": best["execute"] * 1000,
+        "source_bytes": len(source),
+        "instructions": instructions,
+        "calls": calls,
+        "insts_per_sec": instructions / execute_time,
+        "calls_per_sec": calls / execute_time,
+        "peak_kb": memory,
+    }
+
+
+def run(names, repeat):
+    results = {}
+    for name in names:
+        output = subprocess.check_output(
+            [sys.executable, "-m", "benchmarks.suite", "--child", name,
+             "-r", str(repeat)])
+        results[name] = json.loads(output)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ [message] of every metric worse than the baseline by 'threshold' """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        metrics = [(key, result[key], base[key])
+                   for key in TIMES if base[key] >= MIN_TIME_MS]
+        metrics += [("peak_kb." + phase, result["peak_kb"][phase], base["peak_kb"][phase])
+                    for phase in PHASES if base["peak_kb"][phase] >= MIN_MEMORY_KB]
+        for key, new, old in metrics:
+            if new > old * (1 + threshold):
+                regressions.append("%s %s: %.1f -> %.1f (+%.0f%%)"
+                                   % (name, key, old, new, (float(new) / old - 1) * 100))
+    return regressions
+
+
+def report(results):
+    print "%-9s %9s %9s %9s %12s %12s %8s %8s %8s" % (
+        "program", "parse", "compile", "execute", "insts/sec", "calls/sec",
+        "parseKB", "compKB", "execKB")
+    for name, r in sorted(results.items()):
+        print "%-9s %7.1fms %7.1fms %7.1fms %12.0f %12.0f %8d %8d %8d" % (
+            name, r["parse_ms"], r["compile_ms"], r["execute_ms"],
+            r["insts_per_sec"], r["calls_per_sec"], r["peak_kb"]["parse"],
+            r["peak_kb"]["compile"], r["peak_kb"]["execute"])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.suite")
+    parser.add_argument("programs", nargs="*", metavar="program")
+    parser.add_argument("-o", "--output", help="write results as JSON")
+    parser.add_argument("-b", "--baseline", default=BASELINE)
+    parser.add_argument("-t", "--threshold", type=float, default=0.25,
+                        help="allowed slowdown, 0.25 is 25%%")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store the results as the new baseline")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv[1:])
+
+    if args.child:
+        print json.dumps(measure(args.child, args.repeat))
+        return 0
+
+    names = args.programs or sorted(PROGRAMS)
+    for name in names:
+        if name not in PROGRAMS:
+            parser.error("unknown program '%s'" % name)
+    results = run(names, args.repeat)
+    report(results)
+
+    document = {"python": sys.version.split()[0], "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print "no baseline at %s" % args.baseline
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+    for message in regressions:
+        print "REGRESSION", message
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,53 @@
+"""
+Context switches between green threads of vm.Scheduler: many tasks
+yielding in turn, and two tasks passing a value back and forth over
+unbuffered channels.
+
+    python -m benchmarks.tasks [tasks]
+"""
+import sys
+import time
+
+import vm
+import code
+
+YIELDS = """
+(define (worker n) (if (= n 0) 0 (begin (yield) (worker (- n 1)))))
+(define (start i) (if (= i 0) 0 (begin (spawn worker %d) (start (- i 1)))))
+(start %d)
+"""
+
+PING_PONG = """
+(define ping (make-channel))
+(define pong (make-channel))
+(define (echo) (begin (send pong (+ (receive ping) 1)) (echo)))
+(define (loop n v) (if (= n 0) v (begin (send ping v) (loop (- n 1) (receive pong)))))
+(spawn echo)
+(loop %d 0)
+"""
+
+
+def run(source):
+    m = vm.VM(code.compile_source(source), {})
+    scheduler = vm.Scheduler(m)
+    scheduler.install(m.env)
+    start = time.time()
+    scheduler.run()
+    return time.time() - start, scheduler.switches
+
+
+def main(argv):
+    tasks = int(argv[1]) if len(argv) > 1 else 10000
+    cases = [
+        ("yield %dx10" % tasks, YIELDS % (10, tasks)),
+        ("ping-pong", PING_PONG % 20000),
+    ]
+    print "%-16s %10s %10s %14s" % ("program", "switches", "time", "switches/sec")
+    for name, source in cases:
+        elapsed, switches = run(source)
+        print "%-16s %10d %8.1fms %14.0f" % (
+            name, switches, elapsed * 1000, switches / elapsed)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
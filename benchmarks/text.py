@@ -0,0 +1,46 @@
+"""
+Build a string of n pieces by appending to the string built so far and
+with a string builder, and print a list of n numbers.
+
+    python -m benchmarks.text [n ...]
+"""
+import sys
+import time
+
+import toplevel
+import runtime
+
+SIZES = [1000, 10000, 50000]
+
+SOURCE = """
+(define piece "0123456789")
+(define (by-append i n s) (if (= i n) s (by-append (+ i 1) n (string-append s piece))))
+(define (by-builder i n b) (if (= i n) b (by-builder (+ i 1) n (string-builder-append! b piece))))
+"""
+
+
+def timed(top, source):
+    t = time.time()
+    value = top.run(source)
+    return time.time() - t, value
+
+
+def main(argv):
+    sizes = [int(n) for n in argv[1:]] or SIZES
+    print "%-8s %10s %10s %8s %12s" % ("pieces", "append", "builder", "ratio", "list str")
+    for n in sizes:
+        top = toplevel.TopLevel(toplevel.default_env())
+        top.run(SOURCE)
+        appended, a = timed(top, '(by-append 0 %d "")' % n)
+        built, b = timed(top, "(string-builder->string (by-builder 0 %d (make-string-builder)))" % n)
+        assert a == b
+        l = runtime.build_list(range(n * 10))
+        t = time.time()
+        str(l)
+        printed = time.time() - t
+        print "%-8d %8.1fms %8.1fms %7.2fx %10.1fms" % (
+            n, appended * 1000, built * 1000, appended / built, printed * 1000)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,44 @@
+"""
+Run the dispatch programs and tak on the VM and transpiled to python,
+and time the translation itself, cold and from the on-disk cache.
+
+    python -m benchmarks.transpiled
+"""
+import sys
+import shutil
+import tempfile
+
+import vm
+import code
+import runtime
+import transpile
+from benchmarks.dispatch import PROGRAMS, best_of
+from benchmarks.calls import TAK
+
+SOURCES = dict(PROGRAMS, tak=TAK % (18, 12, 6))
+
+
+def main(argv):
+    names = argv[1:] or sorted(SOURCES)
+    directory = tempfile.mkdtemp()
+    try:
+        print "%-10s %10s %10s %8s %10s %10s" % (
+            "program", "vm", "python", "ratio", "translate", "cached")
+        for name in names:
+            consts = code.compile_source(SOURCES[name])
+            program = transpile.translate(consts)
+            times = [best_of(lambda: vm.VM(consts, runtime.Globals()).start()),
+                     best_of(lambda: program.run(runtime.Globals()))]
+            translate = best_of(lambda: transpile.translate(consts))
+            cache = transpile.Cache(directory)
+            cache.translate(consts)
+            cached = best_of(lambda: cache.translate(consts))
+            print "%-10s %8.1fms %8.1fms %7.2fx %8.1fms %8.1fms" % (
+                name, times[0] * 1000, times[1] * 1000, times[0] / times[1],
+                translate * 1000, cached * 1000)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
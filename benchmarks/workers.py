@@ -0,0 +1,39 @@
+"""
+Throughput of pool.Runner calling fib on many inputs, with a growing
+number of worker processes.
+
+    python -m benchmarks.workers [tasks]
+"""
+import sys
+import time
+import multiprocessing
+
+import pool
+from benchmarks.calls import FIB
+
+SOURCE = FIB % 0
+
+
+def main(argv):
+    tasks = int(argv[1]) if len(argv) > 1 else 200
+    inputs = [(15,)] * tasks
+    counts = [1]
+    while counts[-1] * 2 <= multiprocessing.cpu_count():
+        counts.append(counts[-1] * 2)
+    print "%-10s %10s %12s %8s" % ("processes", "time", "tasks/sec", "speedup")
+    first = None
+    for processes in counts:
+        with pool.Runner(SOURCE, processes=processes) as runner:
+            # let every worker start before timing.
+            runner.map("fib", [(1,)] * processes, chunksize=1)
+            start = time.time()
+            results = runner.map("fib", inputs)
+            elapsed = time.time() - start
+        assert all(result.value == 610 for result in results)
+        first = first or elapsed
+        print "%-10d %8.1fms %12.1f %7.2fx" % (
+            processes, elapsed * 1000, tasks / elapsed, first / elapsed)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
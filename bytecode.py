@@ -0,0 +1,206 @@
+import os
+import marshal
+import hashlib
+import tempfile
+
+import code
+from const import OpLoadGlobal, OpSetGlobal, OpLoadGlobalSlot, OpSetGlobalSlot
+from const import OpCall, OpTailCall, OpCallCached, OpTailCallCached
+from const import OpBinOp, OpUnOp, OpLocalConstBinOp, OpLocalLocalBinOp
+from const import OpBinOpTest, OpBinOpInt, OpBinOpFloat, OpBinOpCons
+from const import OpUnOpList, OpLocalConstBinOpInt, OpLocalLocalBinOpInt
+from const import OpBinOpTestInt
+from code import ConstTable, FunctionProto
+from runtime import SLOT_NAMES
+from regcode import RegisterProto
+
+MAGIC = "PYLC"
+FORMAT_VERSION = 2
+
+# modules whose source decides what code.generate emits.
+COMPILER_MODULES = ("const", "parser", "symbol", "code", "optimize", "regcode")
+
+CONST_LITERAL = 0
+CONST_PROTO = 1
+
+
+class BytecodeException(Exception):
+    pass
+
+
+_fingerprint = None
+
+
+def compiler_version():
+    """ digest of format version and compiler sources """
+    global _fingerprint
+    if _fingerprint is None:
+        h = hashlib.sha1(str(FORMAT_VERSION))
+        for name in COMPILER_MODULES:
+            module = __import__(name)
+            path = os.path.splitext(module.__file__)[0] + ".py"
+            with open(path, "rb") as f:
+                h.update(f.read())
+        _fingerprint = h.hexdigest()
+    return _fingerprint
+
+
+UNQUICKEN = {OpLoadGlobalSlot: OpLoadGlobal, OpSetGlobalSlot: OpSetGlobal}
+UNCACHE = {OpCallCached: OpCall, OpTailCallCached: OpTailCall}
+UNSPECIALIZE = {
+    OpBinOpInt: OpBinOp,
+    OpBinOpFloat: OpBinOp,
+    OpBinOpCons: OpBinOp,
+    OpUnOpList: OpUnOp,
+    OpLocalConstBinOpInt: OpLocalConstBinOp,
+    OpLocalLocalBinOpInt: OpLocalLocalBinOp,
+    OpBinOpTestInt: OpBinOpTest,
+}
+
+
+def unquicken(insts, consts):
+    """
+    global slots back to const operands, slots are per process, calls
+    without their inline caches and type specialized instructions generic.
+    """
+    for op, operand in insts:
+        if op in UNQUICKEN:
+            op = UNQUICKEN[op]
+            operand = consts.literals[(str, SLOT_NAMES[operand])]
+        elif op in UNCACHE:
+            op = UNCACHE[op]
+            operand = operand[0]
+        elif op in UNSPECIALIZE:
+            if op == OpLocalConstBinOpInt:
+                operand = operand[:3]
+            op = UNSPECIALIZE[op]
+        yield op, operand
+
+
+def encode_proto(proto, consts):
+    if isinstance(proto, RegisterProto):
+        registers = (proto.ntemps, proto.nregs)
+        insts = tuple(proto.insts)
+    else:
+        registers = None
+        insts = tuple(unquicken(proto.insts, consts))
+    return (proto.argc,
+            proto.isVararg,
+            proto.maxLocalvars,
+            insts,
+            tuple(proto.upvars),
+            getattr(proto, "name", None),
+            getattr(proto, "indexInConsts", None),
+            registers)
+
+
+def decode_proto(fields):
+    argc, isvarg, maxLocalvars, insts, upvars, name, index, registers = fields
+    if registers is None:
+        proto = FunctionProto(argc, isvarg)
+    else:
+        proto = RegisterProto(argc, isvarg)
+        proto.ntemps, proto.nregs = registers
+    proto.maxLocalvars = maxLocalvars
+    proto.iLocalvars = argc
+    proto.insts = list(insts)
+    proto.upvars = list(upvars)
+    proto.name = name
+    if index is not None:
+        proto.indexInConsts = index
+    return proto
+
+
+def dumps(consts):
+    """ dumps(constTable) => str """
+    payload = []
+    for value in consts:
+        if isinstance(value, FunctionProto):
+            payload.append((CONST_PROTO, encode_proto(value, consts)))
+        else:
+            payload.append((CONST_LITERAL, value))
+    body = marshal.dumps((FORMAT_VERSION, compiler_version(), payload))
+    return MAGIC + body
+
+
+def loads(data):
+    """ loads(str) => constTable """
+    if data[:len(MAGIC)] != MAGIC:
+        raise BytecodeException("Bad magic number")
+    try:
+        version, fingerprint, payload = marshal.loads(data[len(MAGIC):])
+    except (ValueError, EOFError, TypeError):
+        raise BytecodeException("Corrupted bytecode")
+    if version != FORMAT_VERSION:
+        raise BytecodeException("Unsupported bytecode version %s" % version)
+    if fingerprint != compiler_version():
+        raise BytecodeException("Bytecode built by another compiler")
+
+    consts = ConstTable()
+    consts.consts = []
+    for kind, value in payload:
+        if kind == CONST_PROTO:
+            value = decode_proto(value)
+        elif kind == CONST_LITERAL:
+            if consts.consts:
+                consts.literals[(type(value), value)] = len(consts.consts)
+        else:
+            raise BytecodeException("Unknown const kind %s" % kind)
+        consts.consts.append(value)
+    return consts
+
+
+def dump(consts, f):
+    f.write(dumps(consts))
+
+
+def load(f):
+    return loads(f.read())
+
+
+def source_key(source, backend="stack"):
+    return hashlib.sha1(compiler_version() + backend + source).hexdigest()
+
+
+class Cache(object):
+    """ on-disk cache of compiled sources keyed by source and compiler """
+    suffix = ".lispc"
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.path.join(os.path.expanduser("~"), ".cache", "pylisp")
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, source, backend="stack"):
+        return os.path.join(self.directory, source_key(source, backend) + self.suffix)
+
+    def get(self, source, backend="stack"):
+        try:
+            with open(self.path(source, backend), "rb") as f:
+                return load(f)
+        except (IOError, BytecodeException):
+            return None
+
+    def put(self, source, consts, backend="stack"):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                dump(consts, f)
+            os.rename(tmp, self.path(source, backend))
+        except:
+            os.unlink(tmp)
+            raise
+
+    def compile(self, source, backend="stack"):
+        consts = self.get(source, backend)
+        if consts is not None:
+            self.hits += 1
+            return consts
+        self.misses += 1
+        consts = code.compile_source(source, backend=backend)
+        self.put(source, consts, backend)
+        return consts
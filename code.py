@@ -1,6 +1,7 @@
 from const import *
 
 from symbol import SymbolTable
+from parser import Parser, Transform, traverse, check_token
 
 UNDEF_VALUE = None
 
@@ -33,9 +34,10 @@ def GenExp(ast, symbol, generator, isTail=False):
             GenDefine(ast, symbol, generator, isTail)
 
     elif type == "symbol":
-        if info in Symbol2BinOp:
+        # "-" is both, the arity decides.
+        if info in Symbol2BinOp and len(ast) == 3:
             GenBinOp(ast, symbol, generator, isTail)
-        elif info in Symbol2UnOp:
+        elif info in Symbol2UnOp and len(ast) == 2:
             GenUnOp(ast, symbol, generator, isTail)
         else:
             GenCall(ast, symbol, generator, isTail)
@@ -64,7 +66,7 @@ def GenSeq(ast, symbol, generator, isTail=False):
 
     # Value of a seq is last value of its expr.
     last = ast[-1]
-    GenExp(last, symbol, generator, True)
+    GenExp(last, symbol, generator, isTail)
 
 
 def GenIf(ast, symbol, generator, isTail=False):
@@ -109,9 +111,12 @@ def GenCall(ast, symbol, generator, isTail=False):
     assert ast[0].type == 'symbol'
 
     sym = ast[0].info
-    symbol.genLoadSymbol(sym)
-
     argc = len(ast) - 1
+    if isTail and isSelfCall(sym, argc, symbol, generator.proto):
+        GenSelfTailCall(ast, symbol, generator)
+        return
+
+    symbol.genLoadSymbol(sym)
     for arg in ast[1:]:
         GenExp(arg, symbol, generator)
 
@@ -121,6 +126,39 @@ def GenCall(ast, symbol, generator, isTail=False):
         generator.gen((OpCall, argc))
 
 
+def isSelfCall(sym, argc, symbol, proto):
+    """
+    'sym' is the local binding 'proto' was defined to. Nothing but its
+    define sets a local binding, so it always holds this function.
+    """
+    if proto.binding is None or sym != proto.name or argc != proto.argc:
+        return False
+    return symbol.binding(sym) is proto.binding
+
+
+def GenSelfTailCall(ast, symbol, generator):
+    """
+    (name arg*) in tail position of the function bound to 'name', the
+    arguments are stored over its own and the body runs again in the same
+    frame.
+    """
+    proto = generator.proto
+    stores = []
+    for i, arg in enumerate(ast[1:]):
+        # an argument passed on as it is needs no store.
+        if (not isinstance(arg, list) and arg.type == "symbol" and
+                symbol.resolve(arg.info) == ("local", i)):
+            continue
+        GenExp(arg, symbol, generator)
+        stores.append(i)
+    # closures built before in this run keep the values they saw.
+    if proto.captured:
+        generator.gen((OpCloseUpvar, 0))
+    for i in reversed(stores):
+        generator.gen((OpSetLocal, i))
+    generator.gen((OpJump, -generator.pc))
+
+
 def GenDefine(ast, symbol, generator, isTail=False):
     """ (define name expr) """
     assert ast[0].type == "keyword" and ast[0].info == "define"
@@ -128,7 +166,14 @@ def GenDefine(ast, symbol, generator, isTail=False):
     assert len(ast) == 3
 
     scope, info = symbol.add(ast[1].info)
-    GenExp(ast[2], symbol, generator)
+    binding = symbol.current_scope() if scope == "local" else None
+    value = ast[2]
+    if isinstance(value, list) and check_token(value[0], "keyword", "lambda"):
+        GenLambda(value, symbol, generator, name=ast[1].info, binding=binding)
+    elif isinstance(value, list) and check_token(value[0], "keyword", "lambda_v"):
+        GenLambdaV(value, symbol, generator, name=ast[1].info)
+    else:
+        GenExp(value, symbol, generator)
     if scope == "global":
         generator.gen((OpSetGlobal, info))
     else:
@@ -155,10 +200,12 @@ def GenLet(ast, symbol, generator, isTail=False):
         assert scope == "local"
         generator.gen((OpSetLocal, info))
     GenExp(expr, symbol, generator, isTail)
-    # close the scope
+    # close the scope, only needed when an inner lambda captured one of
+    # its localvars.
     proto.iLocalvars -= len(binds)
-    scope_index = (symbol.current_scope()).index
-    generator.gen((OpCloseUpvar, scope_index))
+    scope = symbol.current_scope()
+    if scope.captured:
+        generator.gen((OpCloseUpvar, scope.index))
     symbol.pop()
 
 
@@ -190,7 +237,7 @@ def GenLambdaV(ast, symbol, generator, isTail=False, name=None):
     generator.gen((OpBuildClosure, proto.indexInConsts))
 
 
-def GenLambda(ast, symbol, generator, isTail=False, name=None):
+def GenLambda(ast, symbol, generator, isTail=False, name=None, binding=None):
     """ (lambda (arg1 arg2) (body)) """
     assert ast[0].type == "keyword" and ast[0].info in ("lambda", "lambda_v")
 
@@ -199,6 +246,7 @@ def GenLambda(ast, symbol, generator, isTail=False, name=None):
     body = ast[2:]
     proto = FunctionProto(len(args), False)
     proto.name = name
+    proto.binding = binding
     generator.pushProto(proto)
     symbol.push(proto)
     # make new symbols for arguments.
@@ -209,7 +257,7 @@ def GenLambda(ast, symbol, generator, isTail=False, name=None):
         i += 1
     # gen code for body
     for expr in body[:-1]:
-        GenExp(expr, symbol, generator, True)
+        GenExp(expr, symbol, generator)
         generator.gen((OpPop, 1))
     GenExp(body[-1], symbol, generator, True)
     generator.gen((OpRet, 1))
@@ -256,6 +304,13 @@ class CodeGenerator(object):
         self.insts = self.proto.insts
         return oldProto
 
+    def newMain(self, proto):
+        """ generate following code into a new main proto """
+        assert not self.stack
+        self.proto = proto
+        self.insts = proto.insts
+        self.pc = 0
+
 
 class ConstTable(object):
     def __init__(self):
@@ -267,12 +322,14 @@ class ConstTable(object):
         return len(self.consts) - 1
 
     def addLiteral(self, literal):
-        if literal in self.literals:
-            return self.literals[literal]
+        # keyed by type too, 1, 1.0 and True are equal dict keys.
+        key = (type(literal), literal)
+        if key in self.literals:
+            return self.literals[key]
 
         self.consts.append(literal)
         index = len(self.consts) - 1
-        self.literals[literal] = index
+        self.literals[key] = index
 
         return index
 
@@ -294,6 +351,12 @@ class FunctionProto(object):
         # index of next free localvar
         self.iLocalvars = argc
         self.upvars = []
+        # number of nested scopes, see SymbolTable.push
+        self.nscopes = 0
+        # set once an inner lambda captures one of its localvars
+        self.captured = False
+        # the local scope its define bound it in, see isSelfCall
+        self.binding = None
 
     def adjustMaxLocalvars(self):
         if self.iLocalvars > self.maxLocalvars:
@@ -311,3 +374,19 @@ def generate(ast):
     GenExps(ast, symbols, generator)
     consts.addProto(main)
     return consts
+
+
+def compile_source(source, peephole=True, backend="stack", fold=True):
+    """ compile_source(source) => constTable """
+    import optimize
+    ast = Parser(source, fast=True).exprs()
+    traverse(ast, Transform())
+    if fold:
+        optimize.fold(ast)
+    if backend == "register":
+        import regcode
+        return regcode.generate(ast)
+    consts = generate(ast)
+    if peephole:
+        optimize.peephole(consts)
+    return consts
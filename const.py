@@ -25,11 +25,50 @@ __all__ = [
     "OpBuildClosure",
     "OpBuildContinuation",
     "OpHalt",
+    "OpLocalConstBinOp",
+    "OpLocalLocalBinOp",
+    "OpBinOpTest",
+    "OpLoadGlobalSlot",
+    "OpSetGlobalSlot",
+    "OpCallCached",
+    "OpTailCallCached",
+    "OpBinOpInt",
+    "OpBinOpFloat",
+    "OpBinOpCons",
+    "OpUnOpList",
+    "OpLocalConstBinOpInt",
+    "OpLocalLocalBinOpInt",
+    "OpBinOpTestInt",
+    "OpMemoStore",
+    "ROpMove",
+    "ROpLoadGlobal",
+    "ROpSetGlobal",
+    "ROpLoadUpvar",
+    "ROpSetUpvar",
+    "ROpLoadVarg",
+    "ROpBinOp",
+    "ROpUnOp",
+    "ROpTest",
+    "ROpJump",
+    "ROpCall",
+    "ROpTailCall",
+    "ROpRet",
+    "ROpClosure",
+    "ROpClose",
+    "ROpMemoStore",
     "VMOps",
+    "RegOps",
     "BinOps",
     "UnOps",
     "Symbol2UnOp",
-    "Symbol2BinOp"
+    "Symbol2BinOp",
+    "BinOpCons",
+    "UnOpCar",
+    "UnOpCdr",
+    "BinOpAdd",
+    "BinOpSub",
+    "BinOpEq",
+    "BinOpGt",
 ]
 
 OpRet = 1
@@ -54,9 +93,54 @@ OpLoadVarg = 19
 OpSetUpvar = 20
 OpBuildContinuation = 21
 OpHalt = 22
+# superinstructions, only emitted by optimize.peephole
+OpLocalConstBinOp = 23
+OpLocalLocalBinOp = 24
+OpBinOpTest = 25
+# quickened global access, operand is a runtime.global_slot, only written
+# by the VM while running against a runtime.Globals env.
+OpLoadGlobalSlot = 26
+OpSetGlobalSlot = 27
+# calls with a monomorphic inline cache, operand is (argc, proto, padding),
+# written by the VM over an OpCall/OpTailCall which called 'proto'.
+OpCallCached = 28
+OpTailCallCached = 29
+# type specialized forms of OpBinOp, OpUnOp, OpLocalConstBinOp,
+# OpLocalLocalBinOp and OpBinOpTest, written by a VM in adaptive mode over an instruction whose
+# operand types it saw. A guard failing writes the generic form back.
+OpBinOpInt = 30             # operand binop, both operands are ints
+OpBinOpFloat = 31           # operand binop, both operands are floats
+OpBinOpCons = 32            # operand binop
+OpUnOpList = 33             # operand unop, car or cdr of a LinkList
+OpLocalConstBinOpInt = 34   # operand (local, const, binop, value of const)
+OpBinOpTestInt = 35         # operand (binop, offset), both operands are ints
+OpLocalLocalBinOpInt = 36   # operand (local, local, binop), both locals are ints
+# only in vm.MEMO_PROTO, caches the value of a memoized call, see memo.py
+OpMemoStore = 37
+
+
+# register machine instructions, see regcode.py. A register operand is a
+# register index, an RK operand is a register index or -1 - const index.
+ROpMove = 1         # (op, dst, rk)
+ROpLoadGlobal = 2   # (op, dst, const)
+ROpSetGlobal = 3    # (op, const, rk)
+ROpLoadUpvar = 4    # (op, dst, upvar)
+ROpSetUpvar = 5     # (op, upvar, rk)
+ROpLoadVarg = 6     # (op, dst)
+ROpBinOp = 7        # (op, dst, rk, rk, binop)
+ROpUnOp = 8         # (op, dst, rk, unop)
+ROpTest = 9         # (op, rk, offset)
+ROpJump = 10        # (op, offset)
+ROpCall = 11        # (op, base, argc), callee in base, result into base
+ROpTailCall = 12    # (op, base, argc)
+ROpRet = 13         # (op, rk)
+ROpClosure = 14     # (op, dst, const)
+ROpClose = 15       # (op, scope_index)
+ROpMemoStore = 16   # (op,), only in regvm.MEMO_PROTO, see memo.py
 
 
 VMOps = {v: k for k, v in globals().items() if k.startswith("Op")}
+RegOps = {v: k for k, v in globals().items() if k.startswith("ROp")}
 
 BinOps = dict([
     (1, ("+", operator.add)),
@@ -77,3 +161,13 @@ UnOps = dict([
 ])
 
 Symbol2UnOp = {v[0]: k for k, v in UnOps.items()}
+
+# list primitives the VM inlines instead of calling through BinOps/UnOps.
+BinOpCons = Symbol2BinOp["cons"]
+UnOpCar = Symbol2UnOp["car"]
+UnOpCdr = Symbol2UnOp["cdr"]
+# arithmetic the int and float specializations do without a call.
+BinOpAdd = Symbol2BinOp["+"]
+BinOpSub = Symbol2BinOp["-"]
+BinOpEq = Symbol2BinOp["="]
+BinOpGt = Symbol2BinOp[">"]
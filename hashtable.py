@@ -0,0 +1,160 @@
+"""
+Hash tables, a dict behind a few Native builtins, see install.
+
+    (define t (make-hash-table))
+    (hash-set! t key value)
+    (hash-ref t key [default])      the value, or default (nil) if absent
+    (hash-remove! t key)
+    (hash-has-key? t key)
+    (hash-count t)
+    (hash-keys t) (hash-values t) (hash->list t)   lists, (hash->list t)
+                                                   of (key . value) pairs
+
+Keys are compared as define-memo compares arguments, see memo.key_of:
+numbers by value and type, so 1, 1.0 and True are three keys, strings by
+their characters. Lists can't be changed once built and are keyed by
+their contents, a list and an equal list built later find the same value.
+Anything else, closures or host objects, is its own key unless its python
+type defines __eq__ and __hash__.
+"""
+from runtime import LinkList, Native, build_list, cons
+from memo import key_of
+
+
+class HashTable(object):
+    """
+    'items' maps the key_of of the keys to their values, a list is stored
+    in 'lists' too, so the keys can be listed again.
+    """
+    __slots__ = ["items", "lists"]
+
+    def __init__(self, pairs=()):
+        self.items = {}
+        self.lists = {}
+        for key, value in pairs:
+            self.set(key, value)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key_of(key) in self.items
+
+    def get(self, key, default=None):
+        return self.items.get(key_of(key), default)
+
+    def set(self, key, value):
+        k = key_of(key)
+        if type(key) is LinkList:
+            self.lists[k] = key
+        self.items[k] = value
+
+    def remove(self, key):
+        k = key_of(key)
+        # 'in' hashes the key even when the table is empty, pop doesn't.
+        if k in self.items:
+            del self.items[k]
+            self.lists.pop(k, None)
+
+    def original(self, k):
+        """ the key whose key_of is 'k' """
+        return self.lists[k] if k[0] is LinkList else k[1]
+
+    def keys(self):
+        return [self.original(k) for k in self.items]
+
+    def values(self):
+        return self.items.values()
+
+    def iteritems(self):
+        for k, value in self.items.iteritems():
+            yield self.original(k), value
+
+    def __str__(self):
+        return "#<hash-table %d>" % len(self.items)
+
+    __repr__ = __str__
+
+
+def table_of(value):
+    if type(value) is not HashTable:
+        raise ValueError("Expect a hash table, got %s" % (value,))
+    return value
+
+
+def unhashable(key):
+    return ValueError("Unhashable key %s" % (key,))
+
+
+def make_hash_table():
+    return HashTable()
+
+
+def hash_ref(table, key, default=None):
+    table = table_of(table)
+    try:
+        return table.get(key, default)
+    except TypeError:
+        raise unhashable(key)
+
+
+def hash_set(table, key, value):
+    table = table_of(table)
+    try:
+        table.set(key, value)
+    except TypeError:
+        raise unhashable(key)
+
+
+def hash_remove(table, key):
+    table = table_of(table)
+    try:
+        table.remove(key)
+    except TypeError:
+        raise unhashable(key)
+
+
+def hash_has_key(table, key):
+    table = table_of(table)
+    try:
+        return key in table
+    except TypeError:
+        raise unhashable(key)
+
+
+def hash_count(table):
+    return len(table_of(table))
+
+
+def hash_keys(table):
+    return build_list(table_of(table).keys())
+
+
+def hash_values(table):
+    return build_list(table_of(table).values())
+
+
+def hash_to_list(table):
+    pairs = None
+    for key, value in table_of(table).iteritems():
+        pairs = cons(cons(key, value), pairs)
+    return pairs
+
+
+BUILTINS = dict((name, Native(func, argc, name)) for name, func, argc in [
+    ("make-hash-table", make_hash_table, 0),
+    ("hash-ref", hash_ref, None),
+    ("hash-set!", hash_set, 3),
+    ("hash-remove!", hash_remove, 2),
+    ("hash-has-key?", hash_has_key, 2),
+    ("hash-count", hash_count, 1),
+    ("hash-keys", hash_keys, 1),
+    ("hash-values", hash_values, 1),
+    ("hash->list", hash_to_list, 1),
+])
+
+
+def install(env):
+    """ add the hash table builtins to 'env' """
+    env.update(BUILTINS)
+    return env
@@ -0,0 +1,178 @@
+"""
+Memoized functions. (memoize f [size [ttl]]) wraps a closure or a host
+function in a Memo, which the VM calls like the function itself but which
+returns the value of an earlier call with equal arguments from a bounded
+LRU cache. A value older than 'ttl' seconds is computed again.
+
+    (define-memo (score node depth) ...)
+
+is (define score (memoize (lambda (node depth) ...))), recursive calls go
+through the Memo as well. Lists are keyed by their contents, any other
+argument by its type and value, so (f 1) and (f 1.0) are cached apart.
+A call with an unhashable argument is not cached.
+
+    memo = env["score"]
+    print memo.cache.hits, memo.cache.misses
+"""
+import time
+
+from runtime import Closure, LinkList, Native
+
+DEFAULT_SIZE = 1024
+
+# the value of a key which is not cached
+MISSING = object()
+
+# fields of a cache entry
+PREV, NEXT, KEY, VALUE, EXPIRES = 0, 1, 2, 3, 4
+
+
+class LRUCache(object):
+    """
+    At most 'size' values, the least recently used is evicted first. The
+    entries form a ring of lists around 'root', the newest is root[PREV].
+    """
+    def __init__(self, size=DEFAULT_SIZE, ttl=None, clock=time.time):
+        if size < 1:
+            raise ValueError("Cache size must be positive, got %s" % size)
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.map = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, None]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.map)
+
+    def get(self, key, default=None):
+        entry = self.map.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        prev, next = entry[PREV], entry[NEXT]
+        prev[NEXT] = next
+        next[PREV] = prev
+        if self.ttl is not None and entry[EXPIRES] <= self.clock():
+            del self.map[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.append(entry)
+        return entry[VALUE]
+
+    def put(self, key, value):
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        entry = self.map.get(key)
+        if entry is not None:
+            # computed again while the call of the same key ran.
+            entry[PREV][NEXT] = entry[NEXT]
+            entry[NEXT][PREV] = entry[PREV]
+            entry[VALUE] = value
+            entry[EXPIRES] = expires
+        else:
+            if len(self.map) >= self.size:
+                oldest = self.root[NEXT]
+                oldest[PREV][NEXT] = oldest[NEXT]
+                oldest[NEXT][PREV] = oldest[PREV]
+                del self.map[oldest[KEY]]
+                self.evictions += 1
+            entry = [None, None, key, value, expires]
+            self.map[key] = entry
+        self.append(entry)
+
+    def append(self, entry):
+        root = self.root
+        last = root[PREV]
+        last[NEXT] = root[PREV] = entry
+        entry[PREV] = last
+        entry[NEXT] = root
+
+    def clear(self):
+        self.map.clear()
+        self.root[:] = [self.root, self.root, None, None, None]
+
+    def stats(self):
+        return {"size": len(self.map), "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions,
+                "expirations": self.expirations}
+
+
+def list_key(l):
+    items = []
+    while type(l) is LinkList:
+        items.append(key_of(l.v))
+        l = l.next
+    # the cdr of the last cell, None for a proper list.
+    return (LinkList, tuple(items), key_of(l))
+
+
+def key_of(value):
+    """
+    dict key of a value, lists are keyed by their contents and anything
+    else together with its type, so 1, 1.0 and True are three keys.
+    """
+    if type(value) is LinkList:
+        return list_key(value)
+    return (type(value), value)
+
+
+def make_key(args):
+    """ key of an argument list, see key_of """
+    return tuple([key_of(a) for a in args])
+
+
+class Memo(object):
+    """ a function and the cache of its values, see memoize """
+    __slots__ = ["func", "cache", "__name__"]
+
+    def __init__(self, func, size=DEFAULT_SIZE, ttl=None, clock=time.time):
+        self.func = func
+        self.cache = LRUCache(size, ttl, clock)
+        if isinstance(func, Closure):
+            self.__name__ = func.proto.name or "<lambda>"
+        else:
+            self.__name__ = getattr(func, "__name__", "memo")
+
+    def lookup(self, args):
+        """
+        (key, cached value or MISSING) of a call with 'args', the key is
+        MISSING if an argument is unhashable.
+        """
+        try:
+            key = make_key(args)
+            return key, self.cache.get(key, MISSING)
+        except TypeError:
+            self.cache.misses += 1
+            return MISSING, MISSING
+
+    def store(self, key, value):
+        if key is not MISSING:
+            self.cache.put(key, value)
+
+    def call(self, call, args):
+        """ the value for 'args', 'call(func, *args)' computes a new one """
+        key, value = self.lookup(args)
+        if value is MISSING:
+            value = call(self.func, *args)
+            self.store(key, value)
+        return value
+
+    def __repr__(self):
+        return "<memo %s>" % self.__name__
+
+
+def install(env, size=DEFAULT_SIZE, ttl=None, clock=time.time):
+    """
+    add memoize to 'env', 'size' and 'ttl' are the defaults of the Memos
+    it builds, and so of define-memo.
+    """
+    def memoize(func, size=size, ttl=ttl):
+        return Memo(func, size, ttl, clock)
+    env["memoize"] = Native(memoize, None, "memoize")
+    return env
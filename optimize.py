@@ -0,0 +1,241 @@
+from const import *
+
+from code import FunctionProto
+from parser import Token, check_token
+
+# instructions which only push a value and have no side effect.
+PURE_PUSH = (OpLoadLocal, OpLoadConst, OpLoadUpvar, OpLoadVarg, OpBuildClosure)
+BRANCHES = (OpJump, OpTest, OpBinOpTest)
+MAX_SWEEPS = 16
+
+
+class Inst(object):
+    """ instruction with its jump target resolved to another Inst """
+    __slots__ = ["op", "operand", "target"]
+
+    def __init__(self, op, operand, target=None):
+        self.op = op
+        self.operand = operand
+        self.target = target
+
+
+def decode(insts):
+    code = [Inst(op, operand) for op, operand in insts]
+    end = Inst(OpHalt, 0)
+    for i, inst in enumerate(code):
+        if inst.op in (OpJump, OpTest):
+            offset = inst.operand
+            inst.operand = None
+        elif inst.op == OpBinOpTest:
+            inst.operand, offset = inst.operand
+        else:
+            continue
+        j = i + offset
+        inst.target = code[j] if j < len(code) else end
+    return code, end
+
+
+def encode(code, end):
+    index = dict((id(inst), i) for i, inst in enumerate(code))
+    index[id(end)] = len(code)
+    insts = []
+    for i, inst in enumerate(code):
+        if inst.target is None:
+            insts.append((inst.op, inst.operand))
+            continue
+        offset = index[id(inst.target)] - i
+        if inst.op == OpBinOpTest:
+            insts.append((inst.op, (inst.operand, offset)))
+        else:
+            insts.append((inst.op, offset))
+    return insts
+
+
+def follow(target, limit):
+    """ thread a jump through a chain of unconditional jumps """
+    while target.op == OpJump and target.target is not None and limit:
+        target = target.target
+        limit -= 1
+    return target
+
+
+def sweep(code, end):
+    """ one pass of rewrite rules, returns (code, changed) """
+    targeted = set(id(inst.target) for inst in code if inst.target is not None)
+    # deleted instruction => the instruction control falls through to.
+    forward = {}
+    out = []
+    changed = False
+    n = len(code)
+    i = 0
+
+    def at(k):
+        return code[k] if k < n else end
+
+    while i < n:
+        inst = code[i]
+        a, b = at(i + 1), at(i + 2)
+
+        # push x; pop 1 => nothing
+        if (inst.op in PURE_PUSH and a.op == OpPop and
+                id(a) not in targeted):
+            changed = True
+            if a.operand == 1:
+                forward[id(inst)] = forward[id(a)] = b
+                i += 2
+            else:
+                a.operand -= 1
+                forward[id(inst)] = a
+                i += 1
+            continue
+
+        # load x; load y; binop => fused binop on locals and consts
+        if (inst.op == OpLoadLocal and a.op in (OpLoadLocal, OpLoadConst) and
+                b.op == OpBinOp and id(a) not in targeted and
+                id(b) not in targeted):
+            if a.op == OpLoadLocal:
+                inst.op = OpLocalLocalBinOp
+            else:
+                inst.op = OpLocalConstBinOp
+            inst.operand = (inst.operand, a.operand, b.operand)
+            out.append(inst)
+            changed = True
+            i += 3
+            continue
+
+        # binop; test => compare and branch
+        if inst.op == OpBinOp and a.op == OpTest and id(a) not in targeted:
+            inst.op = OpBinOpTest
+            inst.target = a.target
+            out.append(inst)
+            changed = True
+            i += 2
+            continue
+
+        if inst.op in BRANCHES:
+            target = follow(inst.target, n)
+            if target is not inst.target:
+                inst.target = target
+                changed = True
+            if inst.op == OpJump and target.op == OpRet:
+                inst.op, inst.operand, inst.target = OpRet, target.operand, None
+                changed = True
+            elif inst.op == OpJump and target is a:
+                forward[id(inst)] = a
+                changed = True
+                i += 1
+                continue
+
+        out.append(inst)
+        i += 1
+
+        # code after an unconditional transfer is dead until a jump target.
+        if inst.op in (OpJump, OpRet):
+            while i < n and id(code[i]) not in targeted:
+                changed = True
+                i += 1
+
+    for inst in out:
+        target = inst.target
+        while target is not None and id(target) in forward:
+            target = forward[id(target)]
+        inst.target = target
+    return out, changed
+
+
+def optimize_insts(insts):
+    code, end = decode(insts)
+    for _ in range(MAX_SWEEPS):
+        code, changed = sweep(code, end)
+        if not changed:
+            break
+    return encode(code, end)
+
+
+def peephole(consts):
+    """ rewrite every FunctionProto in a constTable in place """
+    for value in consts:
+        if isinstance(value, FunctionProto):
+            value.insts[:] = optimize_insts(value.insts)
+    return consts
+
+
+# binops whose result can be a literal again, comparisons only fold when
+# they are the predicate of an if.
+FOLD_BINOPS = ("+", "-", "*", "/")
+COMPARE_BINOPS = ("=", ">")
+NUMBER_TYPES = (int, long, float)
+
+
+def is_literal(ast):
+    return isinstance(ast, Token) and ast.type in ("number", "string")
+
+
+def evaluate(ast, binops):
+    """ evaluate(ast, binops) => (True, value) or (False, None) """
+    if is_literal(ast):
+        return True, ast.info
+    if (isinstance(ast, list) and len(ast) == 3 and
+            isinstance(ast[0], Token) and ast[0].type == "symbol" and
+            ast[0].info in binops and
+            is_literal(ast[1]) and ast[1].type == "number" and
+            is_literal(ast[2]) and ast[2].type == "number"):
+        binop = BinOps[Symbol2BinOp[ast[0].info]][1]
+        try:
+            return True, binop(ast[1].info, ast[2].info)
+        except ArithmeticError:
+            # leave it to raise at runtime.
+            pass
+    return False, None
+
+
+def number_token(value, origin):
+    token = Token("number", value)
+    if hasattr(origin, "lineno"):
+        token.lineno = origin.lineno
+        token.position = origin.position
+    return token
+
+
+def fold_exp(ast):
+    if not isinstance(ast, list) or not ast or not isinstance(ast[0], Token):
+        return ast
+    head = ast[0]
+
+    if head.type == "keyword":
+        if head.info in ("lambda", "lambda_v"):
+            ast[2:] = [fold_exp(exp) for exp in ast[2:]]
+        elif head.info == "define":
+            ast[2] = fold_exp(ast[2])
+        elif head.info == "let":
+            for bind in ast[1]:
+                bind[1] = fold_exp(bind[1])
+            ast[2] = fold_exp(ast[2])
+        elif head.info == "begin":
+            ast[1:] = [fold_exp(exp) for exp in ast[1:]]
+        elif head.info == "if":
+            ast[1:] = [fold_exp(exp) for exp in ast[1:]]
+            ok, value = evaluate(ast[1], FOLD_BINOPS + COMPARE_BINOPS)
+            if ok and len(ast) == 4:
+                # only the branch taken is compiled.
+                return ast[2] if value else ast[3]
+        return ast
+
+    if head.type != "symbol":
+        return ast
+    ast[1:] = [fold_exp(exp) for exp in ast[1:]]
+
+    if head.info in FOLD_BINOPS and len(ast) == 3:
+        ok, value = evaluate(ast, FOLD_BINOPS)
+        if ok and type(value) in NUMBER_TYPES:
+            return number_token(value, head)
+    elif check_token(head, "symbol", "-") and len(ast) == 2:
+        if is_literal(ast[1]) and ast[1].type == "number":
+            return number_token(-ast[1].info, head)
+    return ast
+
+
+def fold(ast):
+    """ fold constant expressions of a transformed ast in place """
+    ast[:] = [fold_exp(exp) for exp in ast]
+    return ast
@@ -37,6 +37,19 @@ def str2num(s):
         return int(s)
 
 
+# a backslash before any other character stands for that character.
+ESCAPES = {"n": "\n", "t": "\t", "r": "\r"}
+ESCAPE_PTN = re.compile(r'\\([\s\S])')
+
+
+def str2string(s):
+    """ the value of a string literal, the text between its quotes """
+    s = s[1:-1]
+    if "\\" in s:
+        s = ESCAPE_PTN.sub(lambda m: ESCAPES.get(m.group(1), m.group(1)), s)
+    return s
+
+
 PATTERNS = [
     ('whitespace', r'([ \t\r\f\v])'),
     ('newline', r'(\n)'),
@@ -52,23 +65,49 @@ PATTERNS = [
                 '''),
     ('symbol', r'''([a-zA-Z\+\=\?\!\@\#\$\%\^\&\*\-\/\.\>\<]
                    [\w\+\=\?\!\@\#\$\%\^\&\*\-\/\.\>\<]*)'''),
-    ('string', r'("([^\"] | \\")*")'),
+    ('string', r'("(?:[^"\\] | \\[\s\S])*")'),
     ('quote', r'(\')'),
     ('backquote', r'(`)'),
     ('comma', r'(,)'),
 ]
 
+# the same tokens for Lexer.tokenize_fast: one group per kind, so the kind is
+# found from m.lastindex, and whitespace, newlines and comments fold into a
+# single 'skip' match.
+FAST_PATTERNS = [
+    ('skip', r'(?:[ \t\r\f\v\n]+|;[^\n]*)+'),
+    ('lparen', r'\('),
+    ('rparen', r'\)'),
+    ('number', r'[+\-]?(?:\d+\.\d+|\d+\.|\.\d+|\d+)'),
+    ('symbol', r'''[a-zA-Z\+\=\?\!\@\#\$\%\^\&\*\-\/\.\>\<]
+                   [\w\+\=\?\!\@\#\$\%\^\&\*\-\/\.\>\<]*'''),
+    ('string', r'"(?:[^"\\]|\\[\s\S])*"'),
+    ('quote', r"'"),
+    ('backquote', r'`'),
+    ('comma', r','),
+]
+FAST_KINDS = [None] + [name for name, _ in FAST_PATTERNS]
+
+# bytes read at a time when lexing a file or an mmap.
+CHUNK_SIZE = 1 << 20
+
 
 class Lexer(object):
     skip = ("comment", "whitespace", "newline")
     token_ptn = re.compile("|".join(["(?P<%s>%s)" % (n, e) for n, e in PATTERNS]),
                            re.VERBOSE)
+    fast_ptn = re.compile("|".join(["(%s)" % e for n, e in FAST_PATTERNS]),
+                          re.VERBOSE)
     keywords = {"define", "let", "lambda", "lambda_v", "if", "begin"}
 
-    def __init__(self, src):
+    def __init__(self, src, fast=False, chunk_size=CHUNK_SIZE):
         self.s = src
         self.buffer = []
-        self.tokens = ifilter(lambda x: x.type not in self.skip, self.tokenize(src))
+        self.chunk_size = chunk_size
+        if fast:
+            self.tokens = self.tokenize_fast(src)
+        else:
+            self.tokens = ifilter(lambda x: x.type not in self.skip, self.tokenize(src))
 
     def tokenize(self, s):
         lineno = 1
@@ -98,6 +137,8 @@ class Lexer(object):
                 token.info = str2num(value)
             elif name == "symbol" and value in self.keywords:
                 token.type = "keyword"
+            elif name == "string":
+                token.info = str2string(value)
 
             yield token
 
@@ -107,6 +148,68 @@ class Lexer(object):
 
         yield EOF_TOKEN
 
+    def tokenize_fast(self, src):
+        """
+        Tokens of 'src' without the skipped ones. 'src' is a string, or
+        anything with read() like a file or an mmap, which is lexed in chunks.
+        """
+        match = self.fast_ptn.match
+        kinds = FAST_KINDS
+        keywords = self.keywords
+        chunk_size = self.chunk_size
+        read = getattr(src, "read", None)
+        if read is None:
+            buf, eof = src, True
+        else:
+            buf, eof = read(chunk_size), False
+        offset = 0
+        lineno = 1
+        # offset of the current line in buf, negative once it is dropped.
+        line_start = 0
+
+        while 1:
+            m = match(buf, offset)
+            if not eof and (m is None or m.end() == len(buf)):
+                # the token may go on in the next chunk.
+                more = read(chunk_size)
+                eof = not more
+                buf = buf[offset:] + more
+                line_start -= offset
+                offset = 0
+                continue
+            if m is None:
+                break
+
+            kind = kinds[m.lastindex]
+            end = m.end()
+            if kind == "skip":
+                newlines = buf.count("\n", offset, end)
+                if newlines:
+                    lineno += newlines
+                    line_start = buf.rfind("\n", offset, end) + 1
+                offset = end
+                continue
+
+            value = m.group()
+            token = Token(kind, value)
+            token.lineno = lineno
+            token.position = offset - line_start
+            if kind == "number":
+                token.info = str2num(value)
+            elif kind == "symbol":
+                if value in keywords:
+                    token.type = "keyword"
+            elif kind == "string":
+                token.info = str2string(value)
+                newlines = value.count("\n")
+                if newlines:
+                    lineno += newlines
+                    line_start = buf.rfind("\n", offset, end) + 1
+            yield token
+            offset = end
+
+        yield EOF_TOKEN
+
     def next(self):
         if self.buffer:
             return self.buffer.pop()
@@ -122,19 +225,22 @@ class Lexer(object):
 
 
 class Parser(object):
-    def __init__(self, src):
-        self.lexer = Lexer(src)
+    def __init__(self, src, fast=False):
+        self.lexer = Lexer(src, fast)
 
     def exprs(self):
+        return list(self.iter_exprs())
+
+    def iter_exprs(self):
+        """ yield top-level exprs one at a time """
         lexer = self.lexer
-        ast = []
         while 1:
             token = lexer.next()
             if token is EOF_TOKEN or not token:
-                return ast
+                return
             else:
                 lexer.push(token)
-                ast.append(self.expr())
+                yield self.expr()
 
     def expr(self):
         """ expr => ( expr* ) | s | `expr """
@@ -193,6 +299,16 @@ class Transform(object):
             # keeps only ast[:3]
             del ast[3:]
             return [(2,)]
+        elif (check_token(ast[0], "symbol", "define-memo") and
+                type(ast[1]) == list and
+                len(ast[1]) >= 1):
+            # (define name (memoize (lambda args body))), see memo.py
+            body = ast[2:]
+            name, args = ast[1][0], ast[1][1:]
+            lambda_ = [Token("keyword", "lambda"), args] + body
+            ast[:] = [Token("keyword", "define"), name,
+                      [Token("symbol", "memoize"), lambda_]]
+            return [(2, 1)]
         # XXX: more transform to be added here.
         elif (check_token(ast[0], "keyword", "lambda") and
                 len(ast[1]) >= 2 and
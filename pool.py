@@ -0,0 +1,132 @@
+"""
+Run many invocations of one compiled program on a pool of worker
+processes. The program is compiled once and shipped to the workers as
+bytecode, inherited by fork or unpickled once per worker. Every worker
+builds its env, runs the main program once and then calls the entry
+function of every input it is given.
+
+    runner = Runner(source, setup=add_builtins)
+    for result in runner.map("score", [(1, 2), (3, 4)]):
+        print result.value, result.error
+"""
+import sys
+import traceback
+import multiprocessing
+
+import bytecode
+import code
+import toplevel
+from vm import VM
+
+# the worker's VM, built by init_worker
+_worker = None
+
+
+class Result(object):
+    """ value of one invocation, or the formatted error it raised """
+    __slots__ = ["value", "error"]
+
+    def __init__(self, value=None, error=None):
+        self.value = value
+        self.error = error
+
+    def __getstate__(self):
+        return (self.value, self.error)
+
+    def __setstate__(self, state):
+        self.value, self.error = state
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.error is None:
+            return "Result(%r)" % (self.value,)
+        return "Result(error=%r)" % (self.error.splitlines()[-1],)
+
+
+def init_worker(data, setup, dispatch):
+    """ build the worker's env and VM and run the main program """
+    global _worker
+    consts = bytecode.loads(data)
+    env = toplevel.default_env()
+    if setup is not None:
+        setup(env)
+    _worker = VM(consts, env, dispatch=dispatch)
+    _worker.start()
+
+
+def invoke(task):
+    entry, args = task
+    try:
+        return Result(_worker.call(_worker.env[entry], *args))
+    except Exception:
+        return Result(error=traceback.format_exc())
+
+
+class Runner(object):
+    """
+    A pool of workers running one program. 'program' is a source string or
+    a ConstTable of the stack backend. 'setup(env)' is called in every
+    worker before the main program runs, it should add the host functions
+    the program needs. Globals set by an invocation are seen by the later
+    ones of the same worker, entries should not depend on them.
+    """
+    def __init__(self, program, setup=None, processes=None,
+                 dispatch=VM.DISPATCH_TABLE):
+        if isinstance(program, basestring):
+            program = code.compile_source(program)
+        self.data = bytecode.dumps(program)
+        self.processes = processes or multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(self.processes, init_worker,
+                                         (self.data, setup, dispatch))
+
+    def map(self, entry, inputs, chunksize=None):
+        """ [Result] of calling global 'entry' with each tuple of 'inputs' """
+        tasks = [(entry, tuple(args)) for args in inputs]
+        if chunksize is None:
+            # a few chunks per worker keeps them busy to the end.
+            chunksize = max(1, len(tasks) // (self.processes * 4))
+        return self.pool.map(invoke, tasks, chunksize)
+
+    def imap(self, entry, inputs, chunksize=1):
+        """ Results as they finish, in the order of 'inputs' """
+        tasks = ((entry, tuple(args)) for args in inputs)
+        return self.pool.imap(invoke, tasks, chunksize)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+def main(argv):
+    """ python pool.py script.lisp entry [arg ...], one input per arg """
+    import ast
+    with open(argv[1], "rb") as f:
+        source = f.read()
+    args = argv[3:]
+    with Runner(source) as runner:
+        results = runner.map(argv[2], [(ast.literal_eval(a),) for a in args])
+        for arg, result in zip(args, results):
+            if result.ok:
+                print "%s => %s" % (arg, result.value)
+            else:
+                print "%s => %s" % (arg, result.error.splitlines()[-1])
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,237 @@
+"""
+Deterministic profiler for the stack VM. It wraps the handlers of a VM, see
+VM.turn_profile, so a VM which is not profiled runs the plain handlers.
+
+Counts every executed opcode, and calls, exclusive and inclusive time and
+caller edges of every FunctionProto and host function. Results are written
+as a pstats file and as collapsed stacks for flamegraph.pl.
+
+    python profiler.py script.lisp [prefix]
+"""
+import sys
+import marshal
+from timeit import default_timer
+
+from const import *
+from runtime import Closure
+from memo import Memo
+
+FILENAME = "<lisp>"
+MAIN_KEY = (FILENAME, 0, "<main>")
+
+
+def proto_key(proto):
+    return (FILENAME, getattr(proto, "indexInConsts", 0),
+            getattr(proto, "name", None) or "<lambda>")
+
+
+def host_key(func):
+    # the way cProfile names builtins.
+    return ("~", 0, "<%s>" % getattr(func, "__name__", type(func).__name__))
+
+
+class Entry(object):
+    """ a function being run """
+    __slots__ = ["key", "start", "children", "path"]
+
+    def __init__(self, key, start, path):
+        self.key = key
+        self.start = start
+        self.children = 0.0
+        self.path = path
+
+
+class Profiler(object):
+    def __init__(self, timer=default_timer):
+        self.timer = timer
+        # opcode => executed count
+        self.counts = {}
+        # key => [primitive calls, calls, exclusive, inclusive, callers]
+        # where callers maps caller key => [same four numbers].
+        self.stats = {}
+        # "main;f;g" => exclusive time
+        self.collapsed = {}
+        self.entries = []
+        # key => number of entries of it in self.entries
+        self.active = {}
+
+    def run(self, vm, key=MAIN_KEY):
+        """ run vm.start() under the profiler """
+        vm.turn_profile(self)
+        self.enter(key, self.timer())
+        try:
+            vm.start()
+        finally:
+            vm.turn_profile(None)
+            self.stop()
+
+    def stop(self):
+        now = self.timer()
+        while self.entries:
+            self.leave(now)
+
+    def enter(self, key, now):
+        if self.entries:
+            path = self.entries[-1].path + ";" + key[2]
+        else:
+            path = key[2]
+        self.entries.append(Entry(key, now, path))
+        self.active[key] = self.active.get(key, 0) + 1
+
+    def leave(self, now):
+        entry = self.entries.pop()
+        key = entry.key
+        total = now - entry.start
+        own = total - entry.children
+        self.active[key] -= 1
+        # inclusive time only counts for the outermost of recursive calls.
+        primitive = not self.active[key]
+
+        if self.entries:
+            caller = self.entries[-1]
+            caller.children += total
+            caller = caller.key
+        else:
+            caller = None
+        stat = self.stats.get(key)
+        if stat is None:
+            stat = self.stats[key] = [0, 0, 0.0, 0.0, {}]
+        records = [stat]
+        if caller is not None:
+            edge = stat[4].get(caller)
+            if edge is None:
+                edge = stat[4][caller] = [0, 0, 0.0, 0.0]
+            records.append(edge)
+        for record in records:
+            record[1] += 1
+            record[2] += own
+            if primitive:
+                record[0] += 1
+                record[3] += total
+        self.collapsed[entry.path] = self.collapsed.get(entry.path, 0.0) + own
+
+    def enter_proto(self, proto):
+        """ a closure a host function calls back, see VM.call """
+        self.enter(proto_key(proto), self.timer())
+
+    def host_call(self, func, start, end):
+        self.enter(host_key(func), start)
+        self.leave(end)
+
+    def wrap(self, handlers):
+        """ profiling versions of 'handlers' """
+        wrapped = [self.counted(op, handler) for op, handler in enumerate(handlers)]
+        wrapped[OpCall] = self.call(OpCall, handlers[OpCall])
+        wrapped[OpTailCall] = self.call(OpTailCall, handlers[OpTailCall])
+        wrapped[OpCallCached] = self.call(OpCallCached, handlers[OpCallCached])
+        wrapped[OpTailCallCached] = self.call(OpTailCallCached,
+                                              handlers[OpTailCallCached])
+        wrapped[OpRet] = self.ret(handlers[OpRet])
+        return wrapped
+
+    def counted(self, op, handler):
+        counts = self.counts
+        counts[op] = 0
+
+        def count(vm, frame, operand):
+            counts[op] += 1
+            return handler(vm, frame, operand)
+        return count
+
+    def call(self, op, handler):
+        counts = self.counts
+        counts[op] = 0
+        timer = self.timer
+
+        tail = op in (OpTailCall, OpTailCallCached)
+        cached = op in (OpCallCached, OpTailCallCached)
+
+        def call(vm, frame, operand):
+            counts[op] += 1
+            argc = operand[0] if cached else operand
+            callee = frame.stack[-argc - 1]
+            if type(callee) is Memo:
+                start = timer()
+                ret = handler(vm, frame, operand)
+                if ret is frame:
+                    # a cached value, or the value of a host function.
+                    self.host_call(callee, start, timer())
+                else:
+                    # the closure runs even for a tail call and returns
+                    # into the OpMemoStore frame, which has no OpRet.
+                    self.enter(proto_key(callee.func.proto), start)
+                return ret
+            if not isinstance(callee, Closure):
+                # entered first, the host function may call back into the VM.
+                self.enter(host_key(callee), timer())
+                try:
+                    return handler(vm, frame, operand)
+                finally:
+                    self.leave(timer())
+            now = timer()
+            if tail:
+                # the callee replaces the caller.
+                self.leave(now)
+            self.enter(proto_key(callee.proto), now)
+            return handler(vm, frame, operand)
+        return call
+
+    def ret(self, handler):
+        counts = self.counts
+        counts[OpRet] = 0
+
+        def ret(vm, frame, operand):
+            counts[OpRet] += 1
+            self.leave(self.timer())
+            return handler(vm, frame, operand)
+        return ret
+
+    def opcodes(self):
+        """ [(name, count)] of executed opcodes, most executed first """
+        counts = [(VMOps[op], n) for op, n in self.counts.items()
+                  if n and op in VMOps]
+        return sorted(counts, key=lambda item: -item[1])
+
+    def pstats(self):
+        """ the dict pstats.Stats loads from a file """
+        stats = {}
+        for key, (cc, nc, tt, ct, callers) in self.stats.items():
+            callers = dict((caller, tuple(edge)) for caller, edge in callers.items())
+            stats[key] = (cc, nc, tt, ct, callers)
+        return stats
+
+    def dump_stats(self, path):
+        with open(path, "wb") as f:
+            marshal.dump(self.pstats(), f)
+
+    def dump_collapsed(self, path):
+        """ one 'main;f;g microseconds' line per stack """
+        with open(path, "w") as f:
+            for stack, seconds in sorted(self.collapsed.items()):
+                f.write("%s %d\n" % (stack, int(seconds * 1e6)))
+
+
+def main(argv):
+    import pstats
+    import code
+    import toplevel
+    import vm
+
+    if len(argv) < 2:
+        print "usage: python profiler.py script.lisp [prefix]"
+        return
+    prefix = argv[2] if len(argv) > 2 else argv[1]
+    with open(argv[1], "rb") as f:
+        consts = code.compile_source(f.read())
+    profiler = Profiler()
+    profiler.run(vm.VM(consts, toplevel.default_env()))
+
+    profiler.dump_stats(prefix + ".pstats")
+    profiler.dump_collapsed(prefix + ".collapsed")
+    for name, count in profiler.opcodes():
+        print "%-20s %10d" % (name, count)
+    pstats.Stats(prefix + ".pstats").sort_stats("cumulative").print_stats(20)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
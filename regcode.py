@@ -0,0 +1,386 @@
+import functools
+
+from const import *
+
+from parser import check_token
+from symbol import SymbolTable
+from code import CodeGenerator, ConstTable, FunctionProto
+
+# temporaries are numbered from TEMP_BASE while a proto is generated and
+# moved right after its localvars once maxLocalvars is known.
+TEMP_BASE = 1 << 16
+
+# positions of register and RK operands in each instruction.
+REG_FIELDS = {
+    ROpMove: (1, 2),
+    ROpLoadGlobal: (1,),
+    ROpSetGlobal: (2,),
+    ROpLoadUpvar: (1,),
+    ROpSetUpvar: (2,),
+    ROpLoadVarg: (1,),
+    ROpBinOp: (1, 2, 3),
+    ROpUnOp: (1, 2),
+    ROpTest: (1,),
+    ROpJump: (),
+    ROpCall: (1,),
+    ROpTailCall: (1,),
+    ROpRet: (1,),
+    ROpClosure: (1,),
+    ROpClose: (),
+}
+
+
+def RK(index):
+    """ RK operand of the const at 'index' """
+    return -1 - index
+
+
+def GenExps(ast, symbol, generator):
+    assert type(ast) == list
+    for exp in ast:
+        mark = generator.mark()
+        GenExp(exp, symbol, generator)
+        generator.release(mark)
+
+
+def GenExp(ast, symbol, generator, dst=None, isTail=False):
+    """
+    Generate code for 'ast' and return the RK operand holding its value.
+    The value ends up in register 'dst' if it is given, otherwise it may be
+    a localvar, a const or a new temporary left allocated for the caller.
+    """
+    if not isinstance(ast, list):
+        return SinglarExp(ast, symbol, generator, dst)
+
+    type, info = ast[0].type, ast[0].info
+    if type == "keyword":
+        if info == "begin":
+            return GenSeq(ast, symbol, generator, dst, isTail)
+        elif info == "if":
+            return GenIf(ast, symbol, generator, dst, isTail)
+        elif info == "let":
+            return GenLet(ast, symbol, generator, dst, isTail)
+        elif info == "lambda":
+            return GenLambda(ast, symbol, generator, dst, isTail)
+        elif info == "lambda_v":
+            return GenLambdaV(ast, symbol, generator, dst, isTail)
+        elif info == "define":
+            return GenDefine(ast, symbol, generator, dst, isTail)
+
+    elif type == "symbol":
+        # "-" is both, the arity decides.
+        if info in Symbol2BinOp and len(ast) == 3:
+            return GenBinOp(ast, symbol, generator, dst, isTail)
+        elif info in Symbol2UnOp and len(ast) == 2:
+            return GenUnOp(ast, symbol, generator, dst, isTail)
+        else:
+            return GenCall(ast, symbol, generator, dst, isTail)
+    assert 0
+
+
+def move(generator, dst, operand):
+    if dst is None:
+        return operand
+    if dst != operand:
+        generator.gen((ROpMove, dst, operand))
+    return dst
+
+
+def target(generator, dst):
+    if dst is None:
+        return generator.alloc()
+    return dst
+
+
+def SinglarExp(ast, symbol, generator, dst=None):
+    assert not isinstance(ast, list)
+    if ast.type == "symbol":
+        kind, info = symbol.resolve(ast.info)
+        if kind == "local":
+            return move(generator, dst, info)
+        reg = target(generator, dst)
+        if kind == "global":
+            generator.gen((ROpLoadGlobal, reg, info))
+        elif kind == "upvar":
+            generator.gen((ROpLoadUpvar, reg, info))
+        elif kind == "varg":
+            generator.gen((ROpLoadVarg, reg))
+        else:
+            assert 0
+        return reg
+    elif ast.type in ("string", "number"):
+        index = generator.consts.addLiteral(ast.info)
+        return move(generator, dst, RK(index))
+    else:
+        assert 0
+
+
+def GenSeq(ast, symbol, generator, dst=None, isTail=False):
+    """ (begin expr+ ) """
+    assert ast[0].type == "keyword", ast[0].info == "begin"
+
+    for exp in ast[1:-1]:
+        mark = generator.mark()
+        GenExp(exp, symbol, generator)
+        generator.release(mark)
+
+    # Value of a seq is last value of its expr.
+    return GenExp(ast[-1], symbol, generator, dst, isTail)
+
+
+def GenIf(ast, symbol, generator, dst=None, isTail=False):
+    """ (if pred true false) """
+    assert ast[0].type == "keyword" and ast[0].info == "if"
+    assert len(ast) == 4
+
+    pred, true, false = ast[1:]
+
+    mark = generator.mark()
+    operand = GenExp(pred, symbol, generator)
+    generator.release(mark)
+    falsePatch = generator.gen((ROpTest, operand, None))
+    reg = target(generator, dst)
+    GenExp(true, symbol, generator, reg, isTail)
+    endPatch = generator.gen((ROpJump, None))
+    generator.patchToHere(falsePatch)
+    GenExp(false, symbol, generator, reg, isTail)
+    generator.patchToHere(endPatch)
+    return reg
+
+
+def GenUnOp(ast, symbol, generator, dst=None, isTail=False):
+    """ (UnOP expr) """
+    assert ast[0].type == "symbol" and ast[0].info in Symbol2UnOp
+    assert len(ast) == 2
+
+    mark = generator.mark()
+    operand = GenExp(ast[1], symbol, generator)
+    generator.release(mark)
+    reg = target(generator, dst)
+    generator.gen((ROpUnOp, reg, operand, Symbol2UnOp[ast[0].info]))
+    return reg
+
+
+def GenBinOp(ast, symbol, generator, dst=None, isTail=False):
+    """(BinOp x y)"""
+    assert ast[0].type == "symbol" and ast[0].info in Symbol2BinOp
+    assert len(ast) == 3
+
+    mark = generator.mark()
+    a = GenExp(ast[1], symbol, generator)
+    b = GenExp(ast[2], symbol, generator)
+    generator.release(mark)
+    reg = target(generator, dst)
+    generator.gen((ROpBinOp, reg, a, b, Symbol2BinOp[ast[0].info]))
+    return reg
+
+
+def GenCall(ast, symbol, generator, dst=None, isTail=False):
+    """ (func arg*) """
+    assert ast[0].type == 'symbol'
+
+    # callee and arguments go to consecutive temporaries.
+    mark = generator.mark()
+    base = generator.alloc()
+    SinglarExp(ast[0], symbol, generator, base)
+    argc = len(ast) - 1
+    for arg in ast[1:]:
+        GenExp(arg, symbol, generator, generator.alloc())
+
+    if isTail:
+        generator.gen((ROpTailCall, base, argc))
+    else:
+        generator.gen((ROpCall, base, argc))
+
+    generator.release(mark)
+    if dst is None:
+        # keep only the result register allocated.
+        reg = generator.alloc()
+        assert reg == base
+        return reg
+    return move(generator, dst, base)
+
+
+def GenDefine(ast, symbol, generator, dst=None, isTail=False):
+    """ (define name expr) """
+    assert ast[0].type == "keyword" and ast[0].info == "define"
+    assert not isinstance(ast[1], list) and ast[1].type == "symbol"
+    assert len(ast) == 3
+
+    scope, info = symbol.add(ast[1].info)
+    value = ast[2]
+    gen = GenExp
+    if isinstance(value, list) and check_token(value[0], "keyword", "lambda"):
+        gen = functools.partial(GenLambda, name=ast[1].info)
+    elif isinstance(value, list) and check_token(value[0], "keyword", "lambda_v"):
+        gen = functools.partial(GenLambdaV, name=ast[1].info)
+    if scope == "global":
+        mark = generator.mark()
+        operand = gen(value, symbol, generator)
+        generator.release(mark)
+        generator.gen((ROpSetGlobal, info, operand))
+    else:
+        gen(value, symbol, generator, info)
+
+    # Value of a define expr is None
+    return move(generator, dst, RK(0))
+
+
+def GenLet(ast, symbol, generator, dst=None, isTail=False):
+    """ (let (binds) expr """
+    assert ast[0].type == "keyword" and ast[0].info == "let"
+    assert len(ast) == 3
+
+    binds, expr = ast[1:]
+    proto = generator.proto
+    first = proto.iLocalvars
+    # new scope for let
+    symbol.push()
+    for item in binds:
+        sym, expr0 = item[:]
+        assert sym.type == "symbol"
+        mark = generator.mark()
+        operand = GenExp(expr0, symbol, generator)
+        generator.release(mark)
+        scope, info = symbol.add(sym.info)
+        assert scope == "local"
+        move(generator, info, operand)
+    reg = GenExp(expr, symbol, generator, dst, isTail)
+    if dst is None and first <= reg < TEMP_BASE:
+        # registers of the let are reused once the scope is closed.
+        reg = move(generator, generator.alloc(), reg)
+    # close the scope, if a localvar of it was captured.
+    proto.iLocalvars -= len(binds)
+    scope = symbol.current_scope()
+    if scope.captured:
+        generator.gen((ROpClose, scope.index))
+    symbol.pop()
+    return reg
+
+
+def GenBody(body, symbol, generator):
+    for expr in body[:-1]:
+        mark = generator.mark()
+        GenExp(expr, symbol, generator)
+        generator.release(mark)
+    operand = GenExp(body[-1], symbol, generator, None, True)
+    generator.gen((ROpRet, operand))
+
+
+def GenLambdaV(ast, symbol, generator, dst=None, isTail=False, name=None):
+    """ (lambda_v (arg1 arg2 . argv ) (body)) """
+    assert ast[0].type == "keyword" and ast[0].info == "lambda_v"
+    assert len(ast) == 3
+
+    args = ast[1]
+    # remove ". argv"
+    proto = RegisterProto(len(args) - 2, True)
+    proto.name = name
+    generator.pushProto(proto)
+    symbol.push(proto)
+    i = 0
+    for arg in args[:-2]:
+        symbol.add(arg.info, {"local": i})
+        i += 1
+    assert args[-2].info == "."
+    symbol.add(args[-1].info, {"varg": True})
+    GenBody(ast[2:], symbol, generator)
+    symbol.pop()
+    proto = generator.popProto()
+    reg = target(generator, dst)
+    generator.gen((ROpClosure, reg, proto.indexInConsts))
+    return reg
+
+
+def GenLambda(ast, symbol, generator, dst=None, isTail=False, name=None):
+    """ (lambda (arg1 arg2) (body)) """
+    assert ast[0].type == "keyword" and ast[0].info in ("lambda", "lambda_v")
+
+    args = ast[1]
+    proto = RegisterProto(len(args), False)
+    proto.name = name
+    generator.pushProto(proto)
+    symbol.push(proto)
+    i = 0
+    for argname in args:
+        symbol.add(argname.info, {"local": i})
+        i += 1
+    GenBody(ast[2:], symbol, generator)
+    symbol.pop()
+    proto = generator.popProto()
+    reg = target(generator, dst)
+    generator.gen((ROpClosure, reg, proto.indexInConsts))
+    return reg
+
+
+class RegisterGenerator(CodeGenerator):
+    def __init__(self, consts, proto):
+        CodeGenerator.__init__(self, consts, proto)
+        # number of temporaries in use
+        self.temps = 0
+        self.savedTemps = []
+
+    def alloc(self):
+        reg = TEMP_BASE + self.temps
+        self.temps += 1
+        if self.temps > self.proto.ntemps:
+            self.proto.ntemps = self.temps
+        return reg
+
+    def mark(self):
+        return self.temps
+
+    def release(self, mark):
+        assert mark <= self.temps
+        self.temps = mark
+
+    def patchToHere(self, pc):
+        inst = self.insts[pc]
+        assert inst[0] in (ROpTest, ROpJump)
+        assert self.pc >= pc
+        self.insts[pc] = inst[:-1] + (self.pc - pc,)
+
+    def pushProto(self, proto):
+        self.savedTemps.append(self.temps)
+        self.temps = 0
+        CodeGenerator.pushProto(self, proto)
+
+    def popProto(self):
+        proto = CodeGenerator.popProto(self)
+        self.temps = self.savedTemps.pop()
+        self.finish(proto)
+        return proto
+
+    def finish(self, proto):
+        """ place temporaries after the localvars """
+        offset = proto.maxLocalvars - TEMP_BASE
+        insts = proto.insts
+        for i, inst in enumerate(insts):
+            fields = [f for f in REG_FIELDS[inst[0]] if inst[f] >= TEMP_BASE]
+            if fields:
+                inst = list(inst)
+                for f in fields:
+                    inst[f] += offset
+                insts[i] = tuple(inst)
+        proto.nregs = proto.maxLocalvars + proto.ntemps
+
+
+class RegisterProto(FunctionProto):
+    def __init__(self, argc, isvarg):
+        FunctionProto.__init__(self, argc, isvarg)
+        # most temporaries alive at the same time
+        self.ntemps = 0
+        # size of the register file, localvars then temporaries
+        self.nregs = argc
+
+
+def generate(ast):
+    """ generate(ast) => constTable of RegisterProto """
+    consts = ConstTable()
+    main = RegisterProto(0, False)
+    generator = RegisterGenerator(consts, main)
+    symbols = SymbolTable(generator)
+    GenExps(ast, symbols, generator)
+    generator.finish(main)
+    consts.addProto(main)
+    return consts
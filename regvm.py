@@ -0,0 +1,288 @@
+from const import *
+
+from runtime import Closure, Native, build_list
+from memo import Memo, MISSING
+from regcode import RegisterProto
+from vm import Frame, VMException, close_upvars
+
+
+class RegisterFrame(Frame):
+    """
+    A frame of the register machine. Its registers, localvars followed by
+    temporaries, are a list of its own used as the frame's stack with base 0,
+    so Frame.capture and close_upvars work unchanged.
+    """
+    # register receiving the value of the callee
+    __slots__ = ["ret"]
+
+    def __init__(self, proto, upvars, args):
+        self.proto = proto
+        self.insts = proto.insts
+        self.upvars = upvars
+        self.base = 0
+        self.pc = 0
+        self.open_upvars = None
+
+        argn = len(args)
+        argc = proto.argc
+        if proto.isVararg:
+            if argn >= argc:
+                self.varargs = build_list(args[argc:])
+                del args[argc:]
+            else:
+                raise VMException("Expect equal or more than %s arguments, got %s"
+                                  % (argc, argn))
+        elif argn != argc:
+            raise VMException("Expect %s arguments, got %s" % (argc, argn))
+
+        padding = proto.nregs - argc
+        if padding:
+            args.extend((None,) * padding)
+        self.stack = args
+
+
+class RegisterVM(object):
+    def __init__(self, consts, env, entry=None, debug=False):
+        self.consts = consts
+        self.env = env
+        if not entry:
+            entry = consts[-1]
+        self.frames = [RegisterFrame(entry, [], [])]
+        self.handlers = list(HANDLERS)
+        self.turn_debug(debug)
+
+    def inst2str(self, inst):
+        op = RegOps[inst[0]]
+        if inst[0] == ROpBinOp:
+            return "%s %s %s %s  %s" % (op, inst[1], inst[2], inst[3],
+                                        BinOps[inst[4]][0])
+        elif inst[0] == ROpUnOp:
+            return "%s %s %s  %s" % (op, inst[1], inst[2], UnOps[inst[3]][0])
+        elif inst[0] in (ROpLoadGlobal, ROpClosure):
+            return "%s %s %s # %s" % (op, inst[1], inst[2], self.consts[inst[2]])
+        elif inst[0] == ROpSetGlobal:
+            return "%s %s %s # %s" % (op, inst[1], inst[2], self.consts[inst[1]])
+        else:
+            return " ".join(map(str, (op,) + inst[1:]))
+
+    def turn_debug(self, flag):
+        self.debug = flag
+        self.handlers[:] = TRACED_HANDLERS if flag else HANDLERS
+
+    def start(self):
+        self.run(self.frames.pop())
+
+    def run(self, frame):
+        handlers = self.handlers
+        try:
+            while frame is not None:
+                pc = frame.pc
+                frame.pc = pc + 1
+                inst = frame.insts[pc]
+                frame = handlers[inst[0]](self, frame, inst)
+        except IndexError:
+            # running off the end of insts finishes the program.
+            if frame.pc <= len(frame.insts):
+                raise
+
+
+def rop_move(vm, frame, inst):
+    regs = frame.stack
+    src = inst[2]
+    regs[inst[1]] = regs[src] if src >= 0 else vm.consts[-1 - src]
+    return frame
+
+
+def rop_load_global(vm, frame, inst):
+    frame.stack[inst[1]] = vm.env[vm.consts[inst[2]]]
+    return frame
+
+
+def rop_set_global(vm, frame, inst):
+    src = inst[2]
+    vm.env[vm.consts[inst[1]]] = frame.stack[src] if src >= 0 else vm.consts[-1 - src]
+    return frame
+
+
+def rop_load_upvar(vm, frame, inst):
+    frame.stack[inst[1]] = frame.upvars[inst[2]].get()
+    return frame
+
+
+def rop_set_upvar(vm, frame, inst):
+    src = inst[2]
+    frame.upvars[inst[1]].set(frame.stack[src] if src >= 0 else vm.consts[-1 - src])
+    return frame
+
+
+def rop_load_varg(vm, frame, inst):
+    frame.stack[inst[1]] = frame.varargs
+    return frame
+
+
+def rop_binop(vm, frame, inst):
+    _, dst, b, c, binop = inst
+    regs = frame.stack
+    b = regs[b] if b >= 0 else vm.consts[-1 - b]
+    c = regs[c] if c >= 0 else vm.consts[-1 - c]
+    regs[dst] = BinOps[binop][1](b, c)
+    return frame
+
+
+def rop_unop(vm, frame, inst):
+    _, dst, b, unop = inst
+    regs = frame.stack
+    regs[dst] = UnOps[unop][1](regs[b] if b >= 0 else vm.consts[-1 - b])
+    return frame
+
+
+def rop_test(vm, frame, inst):
+    src = inst[1]
+    if not (frame.stack[src] if src >= 0 else vm.consts[-1 - src]):
+        frame.pc += inst[2] - 1
+    return frame
+
+
+def rop_jump(vm, frame, inst):
+    frame.pc += inst[1] - 1
+    return frame
+
+
+def call_host(func, args):
+    """ the value of a host function call """
+    if type(func) is Native:
+        if func.argc is not None and func.argc != len(args):
+            raise VMException("Expect %s arguments, got %s" % (func.argc, len(args)))
+        return func.func(*args)
+    ret = func(*args)
+    return ret[0] if ret else None
+
+
+# a memoized closure returns into a frame of it, see call_memo
+MEMO_PROTO = RegisterProto(0, False)
+MEMO_PROTO.nregs = 1
+MEMO_PROTO.insts = [(ROpMemoStore,)]
+
+
+def call_memo(vm, frame, memo, base, args):
+    """
+    call a Memo, its value goes to register 'base'. A closure returns into
+    a frame of MEMO_PROTO, whose upvars are (memo, key), which caches the
+    value and returns it on.
+    """
+    key, value = memo.lookup(args)
+    if value is not MISSING:
+        frame.stack[base] = value
+        return frame
+    func = memo.func
+    if not isinstance(func, Closure):
+        value = frame.stack[base] = call_host(func, args)
+        memo.store(key, value)
+        return frame
+    # built first, it checks the arity before any frame is pushed.
+    callee = RegisterFrame(func.proto, func.upvars, args)
+    frame.ret = base
+    vm.frames.append(frame)
+    store = RegisterFrame(MEMO_PROTO, (memo, key), [])
+    store.ret = 0
+    vm.frames.append(store)
+    return callee
+
+
+def rop_memo_store(vm, frame, inst):
+    memo, key = frame.upvars
+    value = frame.stack[0]
+    memo.store(key, value)
+    frame = vm.frames.pop()
+    frame.stack[frame.ret] = value
+    return frame
+
+
+def rop_call(vm, frame, inst):
+    _, base, argc = inst
+    regs = frame.stack
+    closure = regs[base]
+    args = regs[base + 1:base + 1 + argc]
+    if isinstance(closure, Closure):
+        callee = RegisterFrame(closure.proto, closure.upvars, args)
+        frame.ret = base
+        vm.frames.append(frame)
+        return callee
+    if type(closure) is Memo:
+        return call_memo(vm, frame, closure, base, args)
+    regs[base] = call_host(closure, args)
+    return frame
+
+
+def rop_tail_call(vm, frame, inst):
+    _, base, argc = inst
+    regs = frame.stack
+    closure = regs[base]
+    args = regs[base + 1:base + 1 + argc]
+    if isinstance(closure, Closure):
+        # registers are not reused after the frame is gone, so open
+        # upvars can keep pointing at them.
+        return RegisterFrame(closure.proto, closure.upvars, args)
+    if type(closure) is Memo:
+        # not a tail call, its value is cached before the frame returns.
+        return call_memo(vm, frame, closure, base, args)
+    regs[base] = call_host(closure, args)
+    return frame
+
+
+def rop_ret(vm, frame, inst):
+    src = inst[1]
+    value = frame.stack[src] if src >= 0 else vm.consts[-1 - src]
+    frame = vm.frames.pop()
+    frame.stack[frame.ret] = value
+    return frame
+
+
+def rop_closure(vm, frame, inst):
+    frame.stack[inst[1]] = Closure(vm.consts[inst[2]], frame)
+    return frame
+
+
+def rop_close(vm, frame, inst):
+    close_upvars(frame, inst[1])
+    return frame
+
+
+def rop_unknown(vm, frame, inst):
+    raise VMException("Unknown VM instruction: %s" % inst[0])
+
+
+def traced(handler):
+    def trace(vm, frame, inst):
+        print vm.inst2str(inst)
+        return handler(vm, frame, inst)
+    return trace
+
+
+def make_handlers(table):
+    handlers = [rop_unknown] * (max(RegOps) + 1)
+    for operator, handler in table.items():
+        handlers[operator] = handler
+    return handlers
+
+
+HANDLERS = make_handlers({
+    ROpMove: rop_move,
+    ROpLoadGlobal: rop_load_global,
+    ROpSetGlobal: rop_set_global,
+    ROpLoadUpvar: rop_load_upvar,
+    ROpSetUpvar: rop_set_upvar,
+    ROpLoadVarg: rop_load_varg,
+    ROpBinOp: rop_binop,
+    ROpUnOp: rop_unop,
+    ROpTest: rop_test,
+    ROpJump: rop_jump,
+    ROpCall: rop_call,
+    ROpTailCall: rop_tail_call,
+    ROpRet: rop_ret,
+    ROpClosure: rop_closure,
+    ROpClose: rop_close,
+    ROpMemoStore: rop_memo_store,
+})
+
+TRACED_HANDLERS = [traced(handler) for handler in HANDLERS]
@@ -1,28 +1,83 @@
-import cStringIO
-
-
 class Closure(object):
+    __slots__ = ["proto", "upvars"]
+
     def __init__(self, proto, frame):
         self.proto = proto
-        self.upvars = []
+        try:
+            plan = proto.plan
+        except AttributeError:
+            plan = proto.plan = capture_plan(proto.upvars)
+        if plan:
+            self.upvars = [capture(frame, index, scope_index)
+                           for capture, index, scope_index in plan]
+        else:
+            self.upvars = NO_UPVARS
+
+
+# upvars of a closure which captures nothing, never changed.
+NO_UPVARS = ()
+
+
+def capture_local(frame, index, scope_index):
+    return frame.capture(index, scope_index)
+
+
+def capture_varargs(frame, index, scope_index):
+    return frame.capture_varargs()
+
+
+def capture_up(frame, index, scope_index):
+    return frame.upvars[index]
 
-        for kind, index, scope_index in proto.upvars:
-            if kind == "local":
-                upvar = Upvar(frame, index, scope_index)
-                self.upvars.append(upvar)
-            elif kind == "varg":
-                self.upvars.append(UpvarForVarg(frame))
-            elif kind == "up":
-                self.upvars.append(frame.upvars[index])
-            else:
-                assert 0
+
+CAPTURES = {
+    "local": capture_local,
+    "varg": capture_varargs,
+    "up": capture_up,
+}
+
+
+def capture_plan(upvars):
+    """ proto.upvars with the kinds resolved to capture functions """
+    return tuple((CAPTURES[kind], index, scope_index)
+                 for kind, index, scope_index in upvars)
+
+
+class Native(object):
+    """
+    A host function called with its arguments straight from the stack. It
+    returns its value itself, not in a list. With argc None it takes any
+    number of arguments, otherwise the VM checks the count. Its value is
+    not checked for an awaitable, only a plain host function can suspend
+    the VM, see VM.run_slice.
+    """
+    __slots__ = ["func", "argc", "__name__"]
+
+    def __init__(self, func, argc=None, name=None):
+        self.func = func
+        self.argc = argc
+        self.__name__ = name or getattr(func, "__name__", "native")
+
+    def __call__(self, *args):
+        return self.func(*args)
+
+
+def native(argc=None, name=None):
+    """ decorator registering 'func' as a Native """
+    def wrap(func):
+        return Native(func, argc, name)
+    return wrap
 
 
 class UpvarForVarg(object):
+    __slots__ = ["frame", "closed", "value"]
+    # varargs belong to the whole function scope.
+    scope_index = 0
+    index = None
+
     def __init__(self, frame):
         self.frame = frame
         self.closed = False
-        self.scope_index = 0
 
     def get(self):
         if self.closed:
@@ -39,37 +94,35 @@ class UpvarForVarg(object):
     def close(self):
         if not self.closed:
             self.value = self.frame.varargs
-            del self.frame
+            self.frame = None
             self.closed = True
 
 
 class Upvar(object):
-    CLOSED = 0
-    OPEN = 1
+    """ a captured localvar, lives in 'stack[index]' until closed """
+    __slots__ = ["stack", "index", "scope_index", "value"]
 
-    def __init__(self, frame, index, scope_index):
-        self.frame = frame
+    def __init__(self, stack, index, scope_index):
+        self.stack = stack
         self.index = index
-        self.stat = Upvar.OPEN
         self.scope_index = scope_index
 
     def get(self):
-        if self.stat == Upvar.CLOSED:
+        if self.stack is None:
             return self.value
         else:
-            return self.frame.localvars[self.index]
+            return self.stack[self.index]
 
     def set(self, value):
-        if self.stat == Upvar.CLOSED:
+        if self.stack is None:
             self.value = value
         else:
-            self.frame.localvars[self.index] = value
+            self.stack[self.index] = value
 
     def close(self):
-        assert self.stat == Upvar.OPEN
-        self.value = self.frame.localvars[self.index]
-        del self.frame
-        self.stat == Upvar.CLOSED
+        assert self.stack is not None
+        self.value = self.stack[self.index]
+        self.stack = None
 
 
 def build_list(seq):
@@ -92,6 +145,9 @@ def sclist2pylist(l):
 
 
 class LinkList(object):
+    """ a cons cell, v is its car and next its cdr """
+    __slots__ = ["v", "next"]
+
     def __init__(self, v, next=None):
         self.v = v
         self.next = next
@@ -108,17 +164,33 @@ class LinkList(object):
         return self.next
 
     def __str__(self):
+        """
+        Written into one buffer without recursion, so neither a long nor a
+        deeply nested list runs out of stack.
+        """
+        out = ["("]
+        write = out.append
+        # the rest of every enclosing list, innermost last.
+        rests = []
         n = self
-        sb = cStringIO.StringIO()
-        sb.write("(%s" % self.v)
-        try:
-            while n.next:
-                n = n.next
-                sb.write(" %s" % str(n.v))
-        except AttributeError:
-            sb.write(" . %s" % n)
-        sb.write(")")
-        return sb.getvalue()
+        while 1:
+            v = n.v
+            if type(v) is LinkList:
+                rests.append(n.next)
+                write("(")
+                n = v
+                continue
+            write(str(v))
+            n = n.next
+            while type(n) is not LinkList:
+                if n is not None:
+                    write(" . ")
+                    write(str(n))
+                write(")")
+                if not rests:
+                    return "".join(out)
+                n = rests.pop()
+            write(" ")
 
     def __eq__(self, other):
         if type(other) != type(self):
@@ -143,19 +215,90 @@ def list_eq(a, b):
 
 
 def cons(x, y):
-    if not isinstance(y, LinkList):
-        return LinkList(x, next=y)
-    else:
-        return y.cons(x)
+    return LinkList(x, y)
 
 
 def car(x):
-    if not isinstance(x, LinkList):
+    if type(x) is not LinkList:
         raise ValueError("Unsupported operation car")
-    return x.car()
+    return x.v
 
 
 def cdr(x):
-    if not isinstance(x, LinkList):
+    if type(x) is not LinkList:
         raise ValueError("Unsupported operation cdr")
-    return x.cdr()
+    return x.next
+
+
+# slots of global names, interned for the whole process so code quickened
+# against one Globals runs against any other.
+SLOTS = {}
+SLOT_NAMES = []
+# value of a slot whose name is not bound
+UNBOUND = object()
+
+
+def global_slot(name):
+    slot = SLOTS.get(name)
+    if slot is None:
+        slot = SLOTS[name] = len(SLOT_NAMES)
+        SLOT_NAMES.append(name)
+    return slot
+
+
+class Globals(dict):
+    """
+    A dict of globals which keeps its values in a vector too, indexed by
+    global_slot(name), so a quickened global load is one list index. Every
+    way of rebinding a name writes through to the vector.
+    """
+    def __init__(self, *args, **kwds):
+        dict.__init__(self)
+        self.values = []
+        self.update(*args, **kwds)
+
+    def __reduce__(self):
+        # slots are only valid in this process.
+        return (Globals, (dict(self),))
+
+    def grow(self):
+        """ cover the slots interned since the last call """
+        missing = len(SLOT_NAMES) - len(self.values)
+        if missing > 0:
+            self.values.extend((UNBOUND,) * missing)
+
+    def slot(self, name):
+        slot = global_slot(name)
+        self.grow()
+        return slot
+
+    def __setitem__(self, name, value):
+        dict.__setitem__(self, name, value)
+        self.values[self.slot(name)] = value
+
+    def __delitem__(self, name):
+        dict.__delitem__(self, name)
+        self.values[self.slot(name)] = UNBOUND
+
+    def update(self, *args, **kwds):
+        for name, value in dict(*args, **kwds).iteritems():
+            self[name] = value
+
+    def setdefault(self, name, value=None):
+        if name not in self:
+            self[name] = value
+        return dict.__getitem__(self, name)
+
+    def pop(self, name, *default):
+        value = dict.pop(self, name, *default)
+        self.values[self.slot(name)] = UNBOUND
+        return value
+
+    def popitem(self):
+        name, value = dict.popitem(self)
+        self.values[self.slot(name)] = UNBOUND
+        return name, value
+
+    def clear(self):
+        dict.clear(self)
+        self.values[:] = (UNBOUND,) * len(self.values)
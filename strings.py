@@ -0,0 +1,130 @@
+"""
+Strings, python strs behind a few Native builtins, see install. A string
+literal is the text between its quotes, \\n \\t \\r are escapes and a
+backslash before any other character stands for that character.
+
+    (string-append s ...)               a new string
+    (substring s start [end])
+    (string-length s)
+    (number->string n)
+    (string->number s)                  nil if s is not a number
+
+string-append copies its arguments, so a loop which appends to the
+string it built so far takes quadratic time. A string builder keeps the
+pieces and joins them once:
+
+    (define b (make-string-builder))
+    (string-builder-append! b x ...)    the text of x as display writes it
+    (string-builder-length b)
+    (string-builder->string b)
+"""
+from runtime import Native
+from parser import str2num
+
+
+def string_of(value):
+    if type(value) is not str:
+        raise ValueError("Expect a string, got %s" % (value,))
+    return value
+
+
+def string_append(*strings):
+    for s in strings:
+        string_of(s)
+    return "".join(strings)
+
+
+def substring(s, start, end=None):
+    n = len(string_of(s))
+    if end is None:
+        end = n
+    if not 0 <= start <= end <= n:
+        raise ValueError("Substring %s %s of a string of length %s"
+                         % (start, end, n))
+    return s[start:end]
+
+
+def string_length(s):
+    return len(string_of(s))
+
+
+def number_to_string(n):
+    if type(n) not in (int, long, float):
+        raise ValueError("Expect a number, got %s" % (n,))
+    return str(n)
+
+
+def string_to_number(s):
+    try:
+        return str2num(string_of(s).strip())
+    except ValueError:
+        return None
+
+
+class StringBuilder(object):
+    """ pieces of a string, joined when it is asked for """
+    __slots__ = ["parts", "length"]
+
+    def __init__(self):
+        self.parts = []
+        self.length = 0
+
+    def append(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+
+    def getvalue(self):
+        parts = self.parts
+        if len(parts) > 1:
+            # the next call joins only what is appended in between.
+            parts[:] = ["".join(parts)]
+        return parts[0] if parts else ""
+
+    __str__ = getvalue
+
+    def __repr__(self):
+        return "#<string-builder %d>" % self.length
+
+
+def builder_of(value):
+    if type(value) is not StringBuilder:
+        raise ValueError("Expect a string builder, got %s" % (value,))
+    return value
+
+
+def make_string_builder():
+    return StringBuilder()
+
+
+def string_builder_append(builder, *values):
+    append = builder_of(builder).append
+    for value in values:
+        append(value if type(value) is str else str(value))
+    return builder
+
+
+def string_builder_length(builder):
+    return builder_of(builder).length
+
+
+def string_builder_to_string(builder):
+    return builder_of(builder).getvalue()
+
+
+BUILTINS = dict((name, Native(func, argc, name)) for name, func, argc in [
+    ("string-append", string_append, None),
+    ("substring", substring, None),
+    ("string-length", string_length, 1),
+    ("number->string", number_to_string, 1),
+    ("string->number", string_to_number, 1),
+    ("make-string-builder", make_string_builder, 0),
+    ("string-builder-append!", string_builder_append, None),
+    ("string-builder-length", string_builder_length, 1),
+    ("string-builder->string", string_builder_to_string, 1),
+])
+
+
+def install(env):
+    """ add the string builtins to 'env' """
+    env.update(BUILTINS)
+    return env
@@ -1,7 +1,9 @@
-from vm import *
+from const import *
 
 class SymbolException(Exception):pass
-class Scope(dict):pass
+class Scope(dict):
+    # set once a localvar of the scope is captured by an inner lambda
+    captured = False
 
 class SymbolTable(object):
     def __init__(self, generator):
@@ -17,13 +19,15 @@ class SymbolTable(object):
         scope = Scope()
         if proto:
             scope.proto = proto
-            # a new proto, reset index to 0
-            self.index = 0
-            scope.index = self.index
+            # a new proto, its function scope has index 0
+            scope.index = 0
         else:
+            # nested scopes of a proto always get a larger index than the
+            # scopes enclosing them, so closing a scope can close every
+            # upvar with an index not less than its own.
             scope.proto = self.current.proto
-            self.index += 1
-            scope.index = self.index
+            scope.proto.nscopes += 1
+            scope.index = scope.proto.nscopes
 
         self.scopes.append(self.current)
         self.current = scope
@@ -48,6 +52,14 @@ class SymbolTable(object):
                     return scope[symbol], scope
             return None
 
+    def binding(self, symbol):
+        """ the scope 'symbol' is bound in, upvar aliases are skipped """
+        for scope in [self.current] + self.scopes[::-1]:
+            info = scope.get(symbol)
+            if info is not None and not (isinstance(info, dict) and "upvar" in info):
+                return scope
+        return None
+
     def add(self, symbol, info=None):
         if symbol in self.current:
             exp = SymbolException("symbol '%s' is already defined in current scope.", symbol)
@@ -72,147 +84,68 @@ class SymbolTable(object):
                 return "local", info
 
 
-    def _findSymbol(self, sym):
+    def resolve(self, sym):
+        """ resolve(sym) => (kind, info), kind in global/local/varg/upvar """
         ret = self.lookup(sym)
-        if ret == None:
+        if ret == None or ret[1] is self.globalScope:
             index = self.consts.addLiteral(sym)
             return ("global", index)
         info, scope = ret
-        if scope is self.globalScope:
-            index = self.consts.addLiteral(sym)
-            return ("global", index)
 
         if scope.proto is self.proto:
             if "varg" in info:
                 return ("varg", -1)
+            # 'sym' is a upvar symbol already.
+            elif "upvar" in info:
+                return ("upvar", info["upvar"])
             # 'sym' is a local symbol.
             else:
                 return ("local", info["local"])
 
+        # 'sym' lives in an enclosing proto and becomes a upvar of every
+        # proto between that one and the current one.
+        scopes = [self.current]
+        for s in reversed(self.scopes):
+            if s is scope:
+                break
+            scopes.append(s)
+        scopes = [s for s in scopes if s.proto is not scope.proto]
+
+        # get protos for scopes, outermost first.
+        protos = []
+        for s in reversed(scopes):
+            if len(protos) == 0 or (s.proto is not protos[-1]):
+                protos.append(s.proto)
+
+        if "local" in info:
+            upvar = ("local", info["local"], scope.index)
+            scope.captured = True
+            scope.proto.captured = True
+        elif "varg" in info:
+            upvar = ("varg", None, None)
+            scope.proto.captured = True
         else:
-            # 'sym' is a upvar symbol already.
-            if "upvar" in info:
-                return ("upvar", info["upvar"])
-            # 'sym ' is a local and will become a upvar.
-            scopes = []   
-            scopes.append(self.current)
-            for s in reversed(self.scopes):
-                scopes.append(s)
-                if s is scope:
-                    break
-
-            # get protos for scopes.
-            protos = []
-            for s in scopes:
-                if len(protos) == 0 or (s.proto is not protos[-1]):
-                    protos.append(s.proto)
-
-            # remove the proto where symbol is a local.
-            top_proto = protos.pop()
-            protos.reverse()
-
-            # add upvar in the proto
-            if "local" in info:
-                protos[0].upvars.append(("local", info["local"]))
-            elif "varg" in info:
-                protos[0].upvars.append(("varg", -1))
-
-            pre = protos[0]
-            for proto in protos[1:]:
-                proto.upvars.append(("up", len(pre.upvars) - 1))
-                pre = proto
-
-            # add new symbol in scopes list. 
-            for s in scopes[:-1]:
-                # not for scope will symbol should be a local symbol
-                if s.proto is not top_proto:
-                    assert sym not in s
-                    s[sym] = { "upvar" : len(s.proto.upvars) - 1 }
-
-            return ("upvar", self.current[sym]["upvar"])
+            upvar = ("up", info["upvar"], None)
 
+        for proto in protos:
+            proto.upvars.append(upvar)
+            upvar = ("up", len(proto.upvars) - 1, None)
 
-    def genLoadSymbol(self, sym):
-        type, info = self._findSymbol(sym)
-        if type == "global":
-            return self.generator.gen((OpLoadGlobal, info))
-        elif type == "local":
-            return self.generator.gen((OpLoadLocal, info))
-        elif type == "varg":
-            return self.generator.gen((OpLoadVarg, info))
-        elif type == "upvar":
-            return self.generator.gen((OpLoadUpvar, info))
-        else:
-            assert 0 
+        # add new symbol in scopes list.
+        for s in scopes:
+            assert sym not in s
+            s[sym] = { "upvar" : len(s.proto.upvars) - 1 }
 
-    def genLoadSymbol(self, sym):
-        type, info = self._findSymbol(sym)
-        if type == "global":
-            return self.generator.gen((OpSetGlobal, info))
-        elif type == "local":
-            return self.generator.gen((OpSetLocal, info))
-        elif type == "varg":
-            return self.generator.gen((OpSetVarg, info))
-        elif type == "upvar":
-            return self.generator.gen((OpSetUpvar, info))
-        else:
-            assert 0 
+        return ("upvar", self.current[sym]["upvar"])
 
     def genLoadSymbol(self, sym):
-        ret = self.lookup(sym)
-        if ret == None:
-            index = self.consts.addLiteral(sym)
-            return self.generator.gen((OpLoadGlobal, index))
-        info, scope = ret
-        if scope is self.globalScope:
-            index = self.consts.addLiteral(sym)
-            return self.generator.gen((OpLoadGlobal, index))
+        kind, info = self.resolve(sym)
+        return self.generator.gen((LoadOps[kind], info))
 
-        if scope.proto is self.proto:
-            if "varg" in info:
-                return self.generator.gen((OpLoadVarg, -1))
-            # 'sym' is a local symbol.
-            else:
-                return self.generator.gen((OpLoadLocal, info["local"]))
 
-        else:
-            # 'sym' is a upvar symbol already.
-            if "upvar" in info:
-                return self.generator.gen((OpLocalUpvar, info["upvar"]))
-            # 'sym ' is a local and will become a upvar.
-            scopes = []   
-            scopes.append(self.current)
-            for s in reversed(self.scopes):
-                scopes.append(s)
-                if s is scope:
-                    break
-
-            # get protos for scopes.
-            protos = []
-            for s in scopes:
-                if len(protos) == 0 or (s.proto is not protos[-1]):
-                    protos.append(s.proto)
-
-            # remove the proto where symbol is a local.
-            top_proto = protos.pop()
-            protos.reverse()
-
-            # add upvar in the proto
-            if "local" in info:
-                protos[0].upvars.append(("local", info["local"], scope.index))
-            elif "varg" in info:
-                protos[0].upvars.append(("varg", None, None))
-
-            pre = protos[0]
-            for proto in protos[1:]:
-                proto.upvars.append(("up", len(pre.upvars) - 1, None))
-                pre = proto
-
-            # add new symbol in scopes list. 
-            for s in scopes[:-1]:
-                # not for scope will symbol should be a local symbol
-                if s.proto is not top_proto:
-                    assert sym not in s
-                    s[sym] = { "upvar" : len(s.proto.upvars) - 1 }
-
-            return self.generator.gen((OpLoadUpvar, self.current[sym]["upvar"]))
+LoadOps = {
+    "global": OpLoadGlobal,
+    "local": OpLoadLocal,
+    "varg": OpLoadVarg,
+    "upvar": OpLoadUpvar,
+}
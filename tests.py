@@ -1,21 +1,40 @@
 import unittest
-from parser import Parser, Transform, traverse
+from parser import Parser, Lexer, Transform, traverse, EOF_TOKEN
 import code
 import vm
+import optimize
+import regcode
+import regvm
 import cStringIO
 import runtime
+import arrays
+import asyncvm
+import transpile
+import memo
+import hashtable
+import strings
 import functools
+from const import *
 
 
-def compile(source):
+def compile(source, peephole=False):
     p = Parser(source)
     visitor = Transform()
     ast = p.exprs()
     traverse(ast, visitor)
     consts = code.generate(ast)
+    if peephole:
+        optimize.peephole(consts)
     return consts
 
 
+def compile_register(source):
+    p = Parser(source)
+    ast = p.exprs()
+    traverse(ast, Transform())
+    return regcode.generate(ast)
+
+
 class run_doc(object):
     def __init__(self, results=None):
         self.results = results
@@ -33,6 +52,11 @@ class run_doc(object):
 
 
 class Lisp(unittest.TestCase):
+    dispatch = vm.VM.DISPATCH_TABLE
+    peephole = False
+    adaptive = False
+    backend = "stack"
+
     def check_results(self, expects):
         self.outputs.seek(0)
         results = [line.strip() for line in self.outputs.readlines()]
@@ -41,9 +65,17 @@ class Lisp(unittest.TestCase):
             self.assertEqual(result, expect)
 
     def run_script(self, s, debug=False):
-        consts = compile(s)
-
-        m = vm.VM(consts, self.env)
+        if self.backend == "register":
+            m = regvm.RegisterVM(compile_register(s), self.env)
+        elif self.backend == "transpile":
+            # there is no VM to trace.
+            self.env["debug_on"] = self.env["debug_off"] = lambda: [None]
+            transpile.translate(compile(s, self.peephole)).run(self.env)
+            return
+        else:
+            consts = compile(s, self.peephole)
+            m = vm.VM(consts, self.env, dispatch=self.dispatch,
+                      adaptive=self.adaptive)
 
         if debug:
             def debug_on():
@@ -81,6 +113,9 @@ class Lisp(unittest.TestCase):
         env["display"] = display
         env["assert"] = assertEqual
         env["list"] = newList
+        memo.install(env)
+        hashtable.install(env)
+        strings.install(env)
 
         self.env = env
         self.outputs = outputs
@@ -119,6 +154,13 @@ class Lisp(unittest.TestCase):
         (display (cons x x))
         """
 
+    def test_car_not_cell(self):
+        self.assertRaises(ValueError, self.run_script, "(car 1)")
+        self.assertRaises(ValueError, self.run_script, "(cdr (car (cons 1 2)))")
+        # a host object with the attributes of a cell is not one.
+        self.env["it"] = iter([1])
+        self.assertRaises(ValueError, self.run_script, "(cdr it)")
+
     @run_doc(["3", "7"])
     def test_let(self):
         """
@@ -182,6 +224,1235 @@ class Lisp(unittest.TestCase):
         (assert (sum 1 100000) 5000050000)
         """
 
+    @run_doc()
+    def test_closure_outlives_frame(self):
+        """
+        (define (make x) (let ((y (+ x 1))) (lambda () (+ x y))))
+        (define (make2 x) (cons (lambda () x) (lambda () (+ x 1))))
+        (define f1 (make 1))
+        (define f2 (make 10))
+        (define p (make2 5))
+        (assert (f1) 3)
+        (assert (f2) 21)
+        (define (call f) (f))
+        (assert (call (car p)) 5)
+        (assert (call (cdr p)) 6)
+        """
+
+    @run_doc(["1", "1"])
+    def test_body_sequence(self):
+        """
+        (define (one) 1)
+        (define (f) (display (one)) (one) 2)
+        (assert (f) 2)
+        (begin (define z (one)) (one))
+        (display z)
+        """
+
+    def test_define_memo(self):
+        self.run_script("""
+        (define-memo (fib n) (if (> 2 n) n (+ (fib (- n 1)) (fib (- n 2)))))
+        (define-memo (total l) (if l (+ (car l) (total (cdr l))) 0))
+        (define (last n) (fib n))
+        (assert (fib 40) 102334155)
+        (assert (total (list 1 2 3)) 6)
+        (assert (total (list 1 2 3)) 6)
+        (assert (last 30) 832040)
+        """)
+        fib, total = self.env["fib"].cache, self.env["total"].cache
+        self.assertEqual((fib.hits, fib.misses), (39, 41))
+        # the second list is equal to the first one.
+        self.assertEqual((total.hits, total.misses), (1, 4))
+
+    @run_doc()
+    def test_hash_table(self):
+        """
+        (define h (make-hash-table))
+        (define (fill i n) (if (= i n) h (begin (hash-set! h i (* i i)) (fill (+ i 1) n))))
+        (fill 0 100)
+        (hash-set! h (list 1 (list 2 3)) "nested")
+        (hash-set! h (cons 1 2) "pair")
+        (hash-set! h "key" "string")
+        (assert (hash-ref h 7) 49)
+        (assert (hash-ref h 7.0 "none") "none")
+        (assert (hash-ref h (list 1 (list 2 3))) "nested")
+        (assert (hash-ref h (cons 1 2)) "pair")
+        (assert (hash-ref h (list 1 2) 0) 0)
+        (assert (hash-ref h "key") "string")
+        (hash-remove! h 0)
+        (hash-remove! h (list 1 (list 2.0 3)))
+        (assert (hash-count h) 102)
+        (hash-remove! h (list 1 (list 2 3)))
+        (assert (hash-count h) 101)
+        (assert (if (hash-has-key? h 1) 1 0) 1)
+        (assert (if (hash-has-key? h 0) 1 0) 0)
+        """
+
+    def test_strings(self):
+        self.run_script(r"""
+        (define s (string-append "ab" "c\"d" "\\"))
+        (assert (substring "hello" 1 3) "el")
+        (assert (substring "hello" 3) "lo")
+        (assert (string-length "a\tb\n") 4)
+        (assert (string-append (number->string 42) " " (number->string 1.5)) "42 1.5")
+        (assert (+ (string->number "41") 1) 42)
+        (define bad (string->number "x1"))
+        (define (join i n b) (if (= i n) b (join (+ i 1) n (string-builder-append! b i ","))))
+        (define b (join 0 1000 (make-string-builder)))
+        (define built (string-builder->string b))
+        (assert (string-builder-length b) (string-length built))
+        """)
+        self.assertEqual((self.env["s"], self.env["bad"]), ('abc"d\\', None))
+        self.assertEqual(self.env["built"], ",".join(str(i) for i in range(1000)) + ",")
+
+
+class SwitchDispatch(Lisp):
+    dispatch = vm.VM.DISPATCH_SWITCH
+
+
+class Peephole(Lisp):
+    peephole = True
+
+
+class SwitchPeephole(Lisp):
+    dispatch = vm.VM.DISPATCH_SWITCH
+    peephole = True
+
+
+class AdaptiveLisp(Lisp):
+    peephole = True
+    adaptive = True
+
+
+class RegisterLisp(Lisp):
+    backend = "register"
+
+
+class TranspiledLisp(Lisp):
+    backend = "transpile"
+    peephole = True
+
+
+class GlobalSlots(Lisp):
+    peephole = True
+
+    def setUp(self):
+        Lisp.setUp(self)
+        self.env = runtime.Globals(self.env)
+
+
+class QuickenedGlobals(unittest.TestCase):
+    source = """
+    (define (iter n acc) (if (> n 0) (iter (- n 1) (+ acc (step))) acc))
+    (define total (iter 3 0))
+    """
+
+    def test_quickened(self):
+        consts = compile(self.source)
+        env = runtime.Globals(step=lambda: [1])
+        vm.VM(consts, env).start()
+        self.assertEqual(env["total"], 3)
+        ops = [op for c in consts if isinstance(c, code.FunctionProto)
+               for op, _ in c.insts]
+        self.assertFalse(OpLoadGlobal in ops or OpSetGlobal in ops)
+        self.assertTrue(OpLoadGlobalSlot in ops and OpSetGlobalSlot in ops)
+
+        # rebinding by the host is seen by quickened code.
+        env["step"] = lambda: [10]
+        vm.VM(consts, env).start()
+        self.assertEqual(env["total"], 30)
+        # so is a plain dict env.
+        plain = {"step": lambda: [2]}
+        vm.VM(consts, plain).start()
+        self.assertEqual(plain["total"], 6)
+
+        del env["step"]
+        self.assertRaises(KeyError, vm.VM(consts, env).start)
+        env.update(step=lambda: [5])
+        vm.VM(consts, env).start()
+        self.assertEqual(env.pop("total"), 15)
+        self.assertFalse("total" in env)
+
+    def test_bytecode(self):
+        import bytecode
+        consts = compile(self.source)
+        before = bytecode.dumps(consts)
+        vm.VM(consts, runtime.Globals(step=lambda: [1])).start()
+        self.assertEqual(bytecode.dumps(consts), before)
+
+
+class InlineCaches(unittest.TestCase):
+    source = """
+    (define (add a b) (+ a b))
+    (define (sub a b) (- a b))
+    (define (apply2 f a b) (f a b))
+    (define (loop n acc) (if (= n 0) acc (loop (- n 1) (add acc (apply2 sub n 1)))))
+    (define (v . a) a)
+    (define total (loop 10 (apply2 add 0 (inc 0))))
+    (define args (v 1 2))
+    """
+
+    def test_stats(self):
+        consts = compile(self.source)
+        env = {"inc": lambda x: [x + 1]}
+        m = vm.VM(consts, env)
+        m.start()
+        self.assertEqual(env["total"], 1 + 45)
+        self.assertEqual(str(env["args"]), "(1 2)")
+        ops = dict((c.name, [op for op, _ in c.insts]) for c in consts
+                   if getattr(c, "name", None))
+        self.assertTrue(OpTailCallCached in ops["loop"] and OpCallCached in ops["loop"])
+        self.assertTrue(OpTailCallCached in ops["apply2"])
+        # apply2 first calls add then always sub, so its call site misses once.
+        self.assertEqual(m.ic_misses, 1)
+        # the first of the ten runs of every call site in loop and apply2
+        # fills its cache.
+        self.assertEqual(m.ic_hits, 4 * 9)
+        # a vararg callee and host functions stay uncached.
+        main = [op for op, _ in consts[-1].insts]
+        self.assertEqual(main.count(OpCall), 2)
+
+    def test_arity_after_cache(self):
+        consts = compile("(define (f a) a) (define (g h) (h 1)) (g f) (g (lambda (a b) a))")
+        self.assertRaises(vm.VMException, vm.VM(consts, {}).start)
+
+    def test_arity_before_cache(self):
+        # a failed call leaves its call site uncached, it fails again.
+        env = {}
+        m = vm.VM(compile("(define (g h) (h 1)) (define two (lambda (a b) b))"), env)
+        m.start()
+        for i in range(2):
+            self.assertRaises(vm.VMException, m.call, env["g"], env["two"])
+
+    def test_bytecode(self):
+        import bytecode
+        consts = compile(self.source)
+        before = bytecode.dumps(consts)
+        vm.VM(consts, {"inc": lambda x: [x + 1]}).start()
+        self.assertEqual(bytecode.dumps(consts), before)
+
+    def test_switch(self):
+        # the switch dispatch returns into frames the cached calls pushed.
+        consts = compile(self.source)
+        vm.VM(consts, {"inc": lambda x: [x + 1]}).start()
+        env = {"inc": lambda x: [x + 1]}
+        vm.VM(consts, env, dispatch=vm.VM.DISPATCH_SWITCH).start()
+        self.assertEqual((env["total"], str(env["args"])), (1 + 45, "(1 2)"))
+
+
+class Transpiler(unittest.TestCase):
+    source = """
+    (define (sum from to)
+      (begin
+        (define (iter i acc) (if (> i to) acc (iter (+ i 1) (+ acc i))))
+        (iter from 0)))
+    (define (adders n acc)
+      (if (= n 0) acc (let ((k n)) (adders (- n 1) (cons (lambda (x) (+ x k)) acc)))))
+    (define (apply-all l x) (if l (let ((f (car l))) (+ (f x) (apply-all (cdr l) x))) 0))
+    (define (v . a) a)
+    (define total (sum 1 100000))
+    (define added (apply-all (adders 3 0) 10))
+    (define args (v 1 (if total 2 3)))
+    """
+
+    def test_run(self):
+        env = {}
+        transpile.translate(compile(self.source, True)).run(env)
+        self.assertEqual(env["total"], 5000050000)
+        # every closure keeps its own k.
+        self.assertEqual(env["added"], 11 + 12 + 13)
+        self.assertEqual(str(env["args"]), "(1 2)")
+        self.assertTrue(isinstance(env["sum"], runtime.Native))
+
+    def test_self_tail_call_is_a_loop(self):
+        source = transpile.source(compile(self.source, True))
+        self.assertTrue("continue" in source)
+        # iter and adders, and sum which can't tell its local iter from
+        # itself. apply-all and v make no tail calls.
+        self.assertEqual(source.count("while 1:"), 3)
+        source = transpile.source(compile("(define (f x) (g x)) (define (g x) x)"))
+        self.assertFalse("while 1:" in source)
+
+    def test_arity(self):
+        # the transpiled functions raise what the VM raises.
+        source = """
+        (define (f a b) a)
+        (define (v a . r) a)
+        (define (g) (f 1))
+        (define (h) (+ (f 1) 0))
+        """
+        for call in ("(f 1)", "(g)", "(h)", "(v)"):
+            for run in (lambda consts, env: transpile.translate(consts).run(env),
+                        lambda consts, env: vm.VM(consts, env).start()):
+                self.assertRaises(vm.VMException, run, compile(source + call, True), {})
+        env = {}
+        transpile.translate(compile(source, True)).run(env)
+        self.assertRaises(vm.VMException, vm.VM(compile("(f 1)"), env).start)
+
+    def test_mutual_tail_calls(self):
+        env = {}
+        transpile.run(compile("""
+        (define (even n) (if (= n 0) 1 (odd (- n 1))))
+        (define (odd n) (if (= n 0) 0 (even (- n 1))))
+        (define a (even 100001))
+        (define b (odd 100001))
+        """, True), env)
+        self.assertEqual((env["a"], env["b"]), (0, 1))
+        # a trampolined function still loops on its own tail calls.
+        transpile.run(compile("""
+        (define (k n) n)
+        (define (h n) (if (= n 0) 0 (if (= n -1) (k n) (h (- n 1)))))
+        (define c (h 100000))
+        """, True), env)
+        self.assertEqual(env["c"], 0)
+        # the interpreter calls the trampoline, which returns the value.
+        m = vm.VM(compile("(define c (even 10))"), env)
+        m.start()
+        self.assertEqual(env["c"], 1)
+
+    def test_interpreter_calls(self):
+        env = {}
+        m = vm.VM(compile("(define (twice f x) (f (f x)))"), env)
+        m.start()
+        program = transpile.translate(compile(
+            "(define (inc x) (+ x 1)) (define a (twice inc 1))"))
+        program.run(env, m)
+        self.assertEqual(env["a"], 3)
+        vm.VM(compile("(define b (twice inc 5))"), env).start()
+        self.assertEqual(env["b"], 7)
+
+    def test_fallback(self):
+        self.assertRaises(transpile.TranspileException, transpile.translate,
+                          compile_register("(define a (+ 1 2))"))
+        car = Symbol2UnOp["car"]
+        expr = transpile.UNOPS.pop(car)
+        try:
+            consts = compile("(define a (car (list 1 2)))")
+            self.assertRaises(transpile.TranspileException, transpile.translate, consts)
+            env = {"list": lambda *args: [runtime.build_list(args)]}
+            transpile.run(consts, env)
+            self.assertEqual(env["a"], 1)
+        finally:
+            transpile.UNOPS[car] = expr
+
+    def test_cache(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            consts = compile(self.source, True)
+            cache = transpile.Cache(directory)
+            cache.translate(consts)
+            cache.translate(consts)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            env = {}
+            transpile.Cache(directory).translate(consts).run(env)
+            self.assertEqual(env["total"], 5000050000)
+        finally:
+            shutil.rmtree(directory)
+
+
+class Specializing(unittest.TestCase):
+    source = """
+    (define (count l n) (if l (count (cdr l) (+ n 1)) n))
+    (define (add a b) (+ a b))
+    (define (scale x) (* x 2))
+    (define ints (add 1 2))
+    (define floats (add 1.5 2.0))
+    (define n (count (list 1 2 3) 0))
+    (define s (scale 4))
+    """
+
+    def ops(self, consts):
+        return dict((c.name, [op for op, _ in c.insts]) for c in consts
+                    if getattr(c, "name", None))
+
+    def run_adaptive(self, source, peephole=True):
+        consts = compile(source, peephole)
+        env = {"list": lambda *args: [runtime.build_list(args)]}
+        m = vm.VM(consts, env, adaptive=True)
+        m.start()
+        return consts, env, m
+
+    def test_specialize(self):
+        consts, env, m = self.run_adaptive(self.source)
+        self.assertEqual((env["ints"], env["floats"], env["n"], env["s"]), (3, 3.5, 3, 8))
+        ops = self.ops(consts)
+        self.assertTrue(OpUnOpList in ops["count"])
+        self.assertTrue(OpLocalConstBinOpInt in ops["count"])
+        self.assertTrue(OpLocalConstBinOpInt in ops["scale"])
+        # add saw ints, then floats, and stays generic after its deopt.
+        self.assertTrue(OpLocalLocalBinOp in ops["add"])
+        stats = dict((proto.name, (specialized, count, deopts))
+                     for proto, specialized, count, deopts in m.specialization_stats())
+        self.assertEqual(stats["add"][2], 1)
+        self.assertEqual(stats["count"][2], 0)
+
+    def test_generic_ops(self):
+        consts, env, m = self.run_adaptive(
+            "(define (f a b) (cons (car a) (- b))) (define r (f (list 1) 2))", False)
+        self.assertEqual(str(env["r"]), "(1 . -2)")
+        ops = self.ops(consts)
+        self.assertTrue(OpBinOpCons in ops["f"] and OpUnOpList in ops["f"])
+        # - of one operand is not specialized.
+        self.assertTrue(OpUnOp in ops["f"])
+
+    def test_deopt_limit(self):
+        source = """
+        (define (add a b) (+ a b))
+        (define (loop i acc)
+          (if (= i 0) acc (loop (- i 1) (+ acc (- (add 1 2) (add 1.5 1.5))))))
+        (define r (loop 10 0))
+        """
+        consts, env, m = self.run_adaptive(source)
+        self.assertEqual(env["r"], 0.0)
+        # the + in add switches between ints and floats every call.
+        spec = [s for p, s in m.specializations.items() if p.name == "add"][0]
+        self.assertEqual(max(spec.sites.values()), vm.MAX_DEOPTS)
+        self.assertEqual(spec.deopts, vm.MAX_DEOPTS)
+
+    def test_bytecode(self):
+        import bytecode
+        consts = compile(self.source, True)
+        before = bytecode.dumps(consts)
+        vm.VM(consts, {"list": lambda *args: [runtime.build_list(args)]},
+              adaptive=True).start()
+        self.assertEqual(bytecode.dumps(consts), before)
+
+    def test_other_vm(self):
+        # code specialized by one VM deopts in a VM which is not adaptive.
+        consts, env, m = self.run_adaptive(self.source)
+        env = {"list": lambda *args: [runtime.build_list(args)]}
+        vm.VM(consts, env).start()
+        self.assertEqual(env["ints"], 3)
+        self.assertRaises(vm.VMException, vm.VM, consts, env,
+                          dispatch=vm.VM.DISPATCH_SWITCH, adaptive=True)
+        vm.VM(consts, env, dispatch=vm.VM.DISPATCH_SWITCH).start()
+        self.assertEqual(env["floats"], 3.5)
+
+
+class SelfTailCalls(unittest.TestCase):
+
+    def run_source(self, source, peephole=True):
+        consts = compile(source, peephole)
+        env = {}
+        vm.VM(consts, env).start()
+        return consts, env
+
+    def ops(self, consts, name):
+        return [op for c in consts if getattr(c, "name", None) == name
+                for op, _ in c.insts]
+
+    def test_loop(self):
+        source = """
+        (define (sum from to)
+          (define (iter i acc) (if (> i to) acc (iter (+ i 1) (+ acc i))))
+          (iter from 0))
+        (define r (sum 1 100000))
+        """
+        for peephole in (False, True):
+            consts, env = self.run_source(source, peephole)
+            self.assertEqual(env["r"], 5000050000)
+            ops = self.ops(consts, "iter")
+            self.assertTrue(OpJump in ops)
+            self.assertFalse(OpTailCall in ops)
+
+    def test_captured(self):
+        # every run of the loop closes over its own i.
+        source = """
+        (define (f n)
+          (define (collect i acc)
+            (if (= i 0) acc (collect (- i 1) (cons (lambda () i) acc))))
+          (collect n 0))
+        (define (call g) (g))
+        (define fs (f 3))
+        (define r (+ (call (car fs)) (* 10 (call (car (cdr fs))))))
+        """
+        consts, env = self.run_source(source)
+        self.assertEqual(env["r"], 21)
+        self.assertTrue(OpCloseUpvar in self.ops(consts, "collect"))
+
+    def test_global(self):
+        # a global may be set to another function while it runs.
+        source = """
+        (define (count n) (if (= n 0) 0 (count (- n 1))))
+        (define r (count 10))
+        """
+        consts, env = self.run_source(source)
+        self.assertEqual(env["r"], 0)
+        ops = self.ops(consts, "count")
+        self.assertTrue(OpTailCall in ops or OpTailCallCached in ops)
+        self.assertFalse(OpJump in ops)
+
+    def test_shadowed(self):
+        # the call goes to the inner binding, not to the function itself.
+        source = """
+        (define (f n)
+          (define (g n) (* n 2))
+          (define (h g) (g n))
+          (h g))
+        (define (outer n)
+          (define (outer n) (+ n 1))
+          (outer n))
+        (define r (f 4))
+        (define s (outer 4))
+        """
+        consts, env = self.run_source(source)
+        self.assertEqual((env["r"], env["s"]), (8, 5))
+
+    def test_mutual(self):
+        # tail calls between functions run in one reused frame.
+        source = """
+        (define (even n) (if (= n 0) 1 (odd (- n 1))))
+        (define (odd n) (if (= n 0) 0 (even (- n 1))))
+        (define r (even 100001))
+        """
+        for dispatch in (vm.VM.DISPATCH_TABLE, vm.VM.DISPATCH_SWITCH):
+            consts = compile(source, True)
+            env = {}
+            vm.VM(consts, env, dispatch=dispatch).start()
+            self.assertEqual(env["r"], 0)
+
+    def test_transpile(self):
+        source = """
+        (define (sum from to)
+          (define (iter i acc) (if (> i to) acc (iter (+ i 1) (+ acc i))))
+          (iter from 0))
+        (define r (sum 1 1000))
+        """
+        consts = compile(source, True)
+        env = {}
+        transpile.run(consts, env)
+        self.assertEqual(env["r"], 500500)
+
+
+class Memoization(unittest.TestCase):
+    def env(self, **kwds):
+        env = {"list": runtime.Native(lambda *args: runtime.build_list(args))}
+        return memo.install(env, **kwds)
+
+    def test_host(self):
+        calls = []
+
+        def square(x):
+            calls.append(x)
+            return x * x
+        env = self.env()
+        env["square"] = runtime.Native(square, 1)
+        env["count"] = lambda *args: [len(args)]
+        source = """
+        (define msquare (memoize square))
+        (define mcount (memoize count))
+        (define r (+ (msquare 3) (msquare 3)))
+        (define s (mcount 1 2 3))
+        """
+        vm.VM(compile(source, True), env).start()
+        self.assertEqual((env["r"], env["s"], calls), (18, 3, [3]))
+        machine = vm.VM(compile("", True), env)
+        self.assertEqual(machine.call(env["msquare"], 3), 9)
+        self.assertEqual(machine.call(env["mcount"], 1, 2, 3), 3)
+        self.assertEqual(env["mcount"].cache.hits, 1)
+        # a python list is not hashable, the call is not cached.
+        self.assertEqual(machine.call(env["mcount"], []), 1)
+        self.assertEqual(len(env["mcount"].cache), 1)
+
+    def test_arity(self):
+        # a failed call leaves the frames a plain closure's call leaves.
+        for make in (lambda s: vm.VM(compile(s, True), self.env()),
+                     lambda s: regvm.RegisterVM(compile_register(s), self.env())):
+            frames = []
+            for define in ("define", "define-memo"):
+                m = make("(%s (f a b) a) (f 1)" % define)
+                self.assertRaises(vm.VMException, m.start)
+                frames.append(len(m.frames))
+            self.assertEqual(frames[0], frames[1])
+
+    def test_size(self):
+        env = self.env(size=2)
+        source = """
+        (define-memo (f n) (* n 2))
+        (define g (memoize (lambda (n) (* n 3)) 1))
+        (f 1) (f 2) (f 1) (f 3) (f 2)
+        (g 1) (g 2) (g 1)
+        """
+        vm.VM(compile(source, True), env).start()
+        f, g = env["f"].cache, env["g"].cache
+        self.assertEqual((f.hits, f.misses, f.evictions), (1, 4, 2))
+        self.assertEqual((g.hits, g.misses, g.evictions), (0, 3, 2))
+
+    def test_ttl(self):
+        now = [0]
+        cache = memo.LRUCache(2, ttl=10, clock=lambda: now[0])
+        cache.put("a", 1)
+        now[0] = 5
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        now[0] = 12
+        self.assertEqual((cache.get("a"), cache.get("b")), (None, 2))
+        self.assertEqual(cache.stats(), {"size": 1, "hits": 2, "misses": 1,
+                                         "evictions": 0, "expirations": 1})
+
+    def test_lru(self):
+        cache = memo.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEqual((cache.get("b"), cache.get("a"), cache.get("c")),
+                         (None, 1, 3))
+        cache.put("a", 4)
+        cache.put("d", 5)
+        self.assertEqual((cache.get("c"), cache.get("a")), (None, 4))
+        self.assertRaises(ValueError, memo.LRUCache, 0)
+
+    def test_keys(self):
+        build = runtime.build_list
+        self.assertEqual(memo.make_key([build([1, [2, 3]])]),
+                         memo.make_key([build([1, [2, 3]])]))
+        self.assertNotEqual(memo.make_key([build([1, 2])]),
+                            memo.make_key([build([1, 2.0])]))
+        self.assertNotEqual(memo.make_key([1]), memo.make_key([1.0]))
+        self.assertNotEqual(memo.make_key([runtime.cons(1, 2)]),
+                            memo.make_key([build([1, 2])]))
+
+
+class Profiling(unittest.TestCase):
+    source = """
+    (define (fib n) (if (> 2 n) n (+ (fib (- n 1)) (fib (- n 2)))))
+    (define (loop n) (if (= n 0) (+ 0 (fib 5)) (loop (- n 1))))
+    (display (loop 3))
+    """
+
+    def profile(self):
+        import profiler
+        outputs = []
+
+        def display(*args):
+            outputs.append(args)
+            return [None]
+
+        p = profiler.Profiler()
+        p.run(vm.VM(code.compile_source(self.source), {"display": display}))
+        self.assertEqual(outputs, [(5,)])
+        return p
+
+    def test_counts(self):
+        import profiler
+        p = self.profile()
+        stats = p.pstats()
+        fib = [key for key in stats if key[2] == "fib"][0]
+        loop = [key for key in stats if key[2] == "loop"][0]
+        # 15 calls of fib, 1 not recursive. loop tail calls itself.
+        self.assertEqual(stats[fib][:2], (1, 15))
+        self.assertEqual(stats[loop][:2], (4, 4))
+        self.assertEqual(stats[("~", 0, "<display>")][:2], (1, 1))
+        self.assertEqual(set(stats[fib][4]), set([fib, loop]))
+        # tail calls replace their frame, only the last loop returns.
+        self.assertEqual(dict(p.opcodes())["OpRet"], 15 + 1)
+        self.assertTrue(stats[profiler.MAIN_KEY][3] >= stats[fib][3])
+
+    def test_dump(self):
+        import os
+        import pstats
+        import shutil
+        import tempfile
+        p = self.profile()
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "out")
+            p.dump_stats(path + ".pstats")
+            p.dump_collapsed(path + ".collapsed")
+            stats = pstats.Stats(path + ".pstats")
+            self.assertEqual(stats.total_calls, 1 + 15 + 4 + 1)
+            with open(path + ".collapsed") as f:
+                stacks = [line.rsplit(" ", 1)[0] for line in f]
+        finally:
+            shutil.rmtree(directory)
+        self.assertTrue("<main>;loop;fib;fib" in stacks)
+        self.assertTrue("<main>;<display>" in stacks)
+
+    def test_memo(self):
+        import profiler
+        source = """
+        (define-memo (fib n) (if (> 2 n) n (+ (fib (- n 1)) (fib (- n 2)))))
+        (define (last n) (fib n))
+        (define r (+ (fib 10) (last 10)))
+        """
+        env = memo.install({})
+        p = profiler.Profiler()
+        p.run(vm.VM(code.compile_source(source), env))
+        self.assertEqual(env["r"], 110)
+        stats = p.pstats()
+        # the closure runs once per miss, the hits are timed as host calls.
+        fib = [key for key in stats if key[0] == profiler.FILENAME and
+               key[2] == "<lambda>"][0]
+        self.assertEqual(stats[fib][1], env["fib"].cache.misses)
+        self.assertEqual(stats[("~", 0, "<<lambda>>")][1], env["fib"].cache.hits)
+        self.assertEqual(dict(p.opcodes())["OpMemoStore"], 11)
+
+    def test_callback(self):
+        import profiler
+        env = {}
+        m = vm.VM(code.compile_source("""
+        (define (f x) (+ x 1))
+        (define (g x) (apply1 f x))
+        (define r (g 1))
+        """), env)
+        env["apply1"] = runtime.Native(lambda f, x: m.call(f, x), 2, "apply1")
+        p = profiler.Profiler()
+        p.run(m)
+        self.assertEqual(env["r"], 2)
+        stats = p.pstats()
+        f, g = [[key for key in stats if key[2] == name][0] for name in ("f", "g")]
+        host = ("~", 0, "<apply1>")
+        # f is called by the host function, which is called by g.
+        self.assertEqual(stats[f][:2], (1, 1))
+        self.assertEqual(set(stats[f][4]), set([host]))
+        self.assertEqual(set(stats[host][4]), set([g]))
+        self.assertTrue(stats[g][3] >= stats[host][3] >= stats[f][3])
+        self.assertEqual(set(p.collapsed), set(["<main>", "<main>;g", "<main>;g;<apply1>",
+                                                "<main>;g;<apply1>;f"]))
+
+    def test_off(self):
+        m = vm.VM(compile(self.source), {"display": lambda *args: [None]})
+        m.turn_profile(None)
+        self.assertEqual(m.handlers, vm.DICT_HANDLERS)
+
+
+class PeepholeRules(unittest.TestCase):
+    def insts(self, source):
+        consts = compile(source, True)
+        return consts[-1].insts, [c for c in consts if isinstance(c, code.FunctionProto)]
+
+    def test_define_drops_push_pop(self):
+        insts, _ = self.insts("(define x 1) (define y 2)")
+        self.assertEqual([op for op, _ in insts], [OpLoadConst, OpSetGlobal] * 2)
+
+    def test_superinstructions(self):
+        _, protos = self.insts("(define (f a b) (if (> a b) (+ a 1) b))")
+        ops = [op for op, _ in protos[0].insts]
+        self.assertEqual(ops[:2], [OpLocalLocalBinOp, OpTest])
+        self.assertTrue(OpLocalConstBinOp in ops)
+        # the jump over the false branch became a return.
+        self.assertFalse(OpJump in ops)
+
+    def test_offsets(self):
+        insts = [(OpLoadConst, 1), (OpLoadConst, 2), (OpBinOp, 6),
+                 (OpTest, 4), (OpLoadConst, 1), (OpPop, 1), (OpJump, 2),
+                 (OpJump, 2), (OpLoadConst, 2)]
+        self.assertEqual(optimize.optimize_insts(insts),
+                         [(OpLoadConst, 1), (OpLoadConst, 2), (OpBinOpTest, (6, 2)),
+                          (OpLoadConst, 2)])
+
+
+class EscapeAnalysis(unittest.TestCase):
+    source = """
+    (define (plain x) (let ((y (+ x 1))) (* y 2)))
+    (define (captures x) (let ((y 1)) (let ((z 2)) (lambda () (+ x y)))))
+    """
+
+    def protos(self, backend):
+        consts = code.compile_source(self.source, backend=backend)
+        return dict((c.name, c) for c in consts
+                    if getattr(c, "name", None))
+
+    def test_close_only_captured(self):
+        for backend, close in (("stack", OpCloseUpvar), ("register", ROpClose)):
+            protos = self.protos(backend)
+            closes = [inst[1] for inst in protos["captures"].insts if inst[0] == close]
+            self.assertEqual([inst for inst in protos["plain"].insts if inst[0] == close], [])
+            # only the outer let, its y is captured.
+            self.assertEqual(closes, [1])
+
+    def test_capture_plan(self):
+        consts = code.compile_source(self.source + "(define f (captures 10))")
+        env = {}
+        vm.VM(consts, env).start()
+        f = env["f"]
+        self.assertEqual([u.get() for u in f.upvars], [10, 1])
+        self.assertEqual([c[0] for c in f.proto.plan],
+                         [runtime.capture_local, runtime.capture_local])
+        self.assertEqual(vm.VM(consts, {}).call(f), 11)
+        self.assertTrue(runtime.Closure(env["plain"].proto, None).upvars is runtime.NO_UPVARS)
+
+
+class Folding(unittest.TestCase):
+    def compile(self, source, backend="stack"):
+        return code.compile_source(source, backend=backend)
+
+    def run_source(self, source, backend="stack"):
+        outputs = []
+
+        def display(*args):
+            outputs.append(" ".join(str(a) for a in args))
+            return [None]
+
+        consts = self.compile(source, backend)
+        if backend == "register":
+            regvm.RegisterVM(consts, {"display": display}).start()
+        else:
+            vm.VM(consts, {"display": display}).start()
+        return outputs
+
+    def test_arithmetic(self):
+        consts = self.compile("(display (* 3 (+ 1 2)) (- 5) (/ 7 2))")
+        ops = [op for op, _ in consts[-1].insts]
+        self.assertFalse(OpBinOp in ops or OpUnOp in ops)
+        self.assertEqual([c for c in consts if c is not None],
+                         ["display", 9, -5, 3, consts[-1]])
+
+    def test_if(self):
+        source = """
+        (define (f x) (if (> 2 1) (+ x 10) (* x 20)))
+        (display (f 1) (if 0 1 2) (if (= 1 2) 3 4))
+        """
+        consts = self.compile(source)
+        self.assertFalse(20 in list(consts) or 3 in list(consts))
+        for backend in ("stack", "register"):
+            self.assertEqual(self.run_source(source, backend), ["11 2 4"])
+
+    def test_not_folded(self):
+        self.assertRaises(ZeroDivisionError, self.run_source, "(display (/ 1 0))")
+        # comparisons and cons stay runtime values.
+        self.assertEqual(self.run_source("(display (= 1 1) (cons 1 2))"),
+                         ["True (1 . 2)"])
+
+    def test_literal_types(self):
+        self.assertEqual(self.run_source("(display 1 1.0 (* 1 1.0) (= 1 1))"),
+                         ["1 1.0 1.0 True"])
+
+
+class FastLexer(unittest.TestCase):
+    source = """
+    ; a comment
+    (define (f x . y) (if (> x -1.5) "a
+    b" `(x ,y)))   (display 'sym 10 .5 2.)
+    """
+
+    def tokens(self, lexer):
+        tokens = []
+        while 1:
+            token = lexer.next()
+            if token is EOF_TOKEN:
+                return tokens
+            tokens.append(token)
+
+    def test_same_tokens(self):
+        slow = self.tokens(Lexer(self.source))
+        fast = self.tokens(Lexer(self.source, fast=True))
+        self.assertEqual([(t.type, t.info) for t in slow],
+                         [(t.type, t.info) for t in fast])
+
+    def test_lineno(self):
+        tokens = self.tokens(Lexer(self.source, fast=True))
+        self.assertEqual([(t.info, t.lineno, t.position) for t in tokens[:2]],
+                         [("(", 3, 4), ("define", 3, 5)])
+        self.assertEqual((tokens[-1].lineno, tokens[-1].position), (4, 41))
+
+    def test_chunks(self):
+        expected = [(t.type, t.info, t.lineno, t.position)
+                    for t in self.tokens(Lexer(self.source, fast=True))]
+        for size in (1, 2, 3, 7, 64):
+            f = cStringIO.StringIO(self.source)
+            tokens = self.tokens(Lexer(f, fast=True, chunk_size=size))
+            self.assertEqual([(t.type, t.info, t.lineno, t.position)
+                              for t in tokens], expected)
+
+    def test_mmap(self):
+        import mmap
+        import tempfile
+        with tempfile.TemporaryFile() as f:
+            f.write(self.source)
+            f.flush()
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            ast = Parser(m, fast=True).exprs()
+            m.close()
+        self.assertEqual(ast, Parser(self.source).exprs())
+
+    def test_string_literals(self):
+        source = r'(display "a\"b" "c\\" "\n" "x\y")'
+        for fast in (False, True):
+            tokens = [t.info for t in Lexer(source, fast).tokens
+                      if t.type == "string"]
+            self.assertEqual(tokens, ['a"b', 'c\\', '\n', 'xy'])
+
+
+class Streaming(unittest.TestCase):
+    source = """
+    (define (f x) (* x 2))
+    (display (f 21))
+    (define (g . a) (h a))
+    (define (h a) (let ((n 10) (k (lambda () (cons n a)))) (k)))
+    (display (g 1 2))
+    """
+
+    def test_same_output(self):
+        import toplevel
+        out = cStringIO.StringIO()
+        toplevel.TopLevel(toplevel.default_env(out)).run(self.source)
+        batch = cStringIO.StringIO()
+        vm.VM(code.compile_source(self.source), toplevel.default_env(batch)).start()
+        self.assertEqual(out.getvalue(), "42\n(10 1 2)\n")
+        self.assertEqual(out.getvalue(), batch.getvalue())
+
+    def test_values(self):
+        import toplevel
+        top = toplevel.TopLevel({})
+        forms = Parser("(define x 3) (+ x 1) (let ((y 2)) (* x y))").exprs()
+        self.assertEqual([top.execute(form) for form in forms], [None, 4, 6])
+        # a file is read in chunks.
+        self.assertEqual(top.run(cStringIO.StringIO("(- x 1) (+ x 10)")), 13)
+
+    def test_repl(self):
+        import toplevel
+        lines = iter(["(define (f x)", "  (* x 2))", "(f 4) (g)", "(f 5)"])
+
+        def read(prompt):
+            try:
+                return next(lines)
+            except StopIteration:
+                raise EOFError
+
+        out = cStringIO.StringIO()
+        toplevel.repl(read=read, out=out)
+        self.assertEqual(out.getvalue(), "8\nKeyError: 'g'\n10\n")
+
+
+@unittest.skipIf(arrays.numpy is None, "numpy is not installed")
+class Arrays(unittest.TestCase):
+    def run_source(self, source, backend="stack"):
+        outputs = []
+
+        def display(*args):
+            outputs.append(" ".join(str(a) for a in args))
+            return [None]
+
+        def newList(*args):
+            return [runtime.build_list(args)]
+
+        env = arrays.install({"display": display, "list": newList})
+        consts = code.compile_source(source, backend=backend)
+        if backend == "register":
+            regvm.RegisterVM(consts, env).start()
+        else:
+            vm.VM(consts, env).start()
+        return outputs
+
+    def test_broadcast(self):
+        source = """
+        (define a (array-from-list (list 1 2 3)))
+        (define b (make-array 3 0.5))
+        (display (array->list (* (+ a b) 2)) (array->list (- a)))
+        (display (array-ref (/ a 2.0) 2) (array-length b))
+        """
+        for backend in ("stack", "register"):
+            self.assertEqual(self.run_source(source, backend),
+                             ["(3.0 5.0 7.0) (-1 -2 -3)", "1.5 3"])
+
+    def test_reductions(self):
+        source = """
+        (define a (array-from-list (list 1 5 3)))
+        (display (sum a) (max a) (dot a a) (sum (list 1 2)))
+        """
+        self.assertEqual(self.run_source(source), ["9 5 35 3"])
+
+    def test_load(self):
+        import os
+        import tempfile
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write("1,2\n3,4\n")
+            out = self.run_source('(display (sum (load-array "%s" ",")))' % path)
+        finally:
+            os.unlink(path)
+        self.assertEqual(out, ["10.0"])
+
+
+class Natives(unittest.TestCase):
+    source = """
+    (define (twice f x) (f (f x)))
+    (define (tail x) (inc x))
+    (record (twice inc 1) (add 2 3) (tail 5) (now) (sum3 1 2 3) (old 1))
+    """
+
+    def run_source(self, backend, dispatch=vm.VM.DISPATCH_TABLE):
+        records = []
+        env = {
+            "inc": runtime.Native(lambda x: x + 1, 1),
+            "add": runtime.native(2)(lambda a, b: a + b),
+            "now": runtime.Native(lambda: 7, 0),
+            "sum3": runtime.Native(lambda *args: sum(args)),
+            "old": lambda x: [x * 10],
+            "record": runtime.Native(lambda *args: records.append(args)),
+        }
+        consts = code.compile_source(self.source, backend=backend)
+        if backend == "register":
+            regvm.RegisterVM(consts, env).start()
+        else:
+            vm.VM(consts, env, dispatch=dispatch).start()
+        return records
+
+    def test_backends(self):
+        expected = [(3, 5, 6, 7, 6, 10)]
+        self.assertEqual(self.run_source("stack"), expected)
+        self.assertEqual(self.run_source("stack", vm.VM.DISPATCH_SWITCH), expected)
+        self.assertEqual(self.run_source("register"), expected)
+
+    def test_arity(self):
+        env = {"inc": runtime.Native(lambda x: x + 1, 1)}
+        m = vm.VM(code.compile_source("(inc 1 2)"), env)
+        self.assertRaises(vm.VMException, m.start)
+        m = regvm.RegisterVM(code.compile_source("(inc)", backend="register"), env)
+        self.assertRaises(vm.VMException, m.start)
+
+    def test_call(self):
+        m = vm.VM(code.compile_source("1"), {})
+        self.assertEqual(m.call(runtime.Native(lambda a, b: a - b, 2), 5, 2), 3)
+
+    def test_reentrant_call(self):
+        # a host function calls back into the VM which runs it.
+        source = """
+        (define (inc x) (+ x 1))
+        (define (f x) (+ 10 (apply1 inc (- x 1))))
+        (define r (+ 100 (f 5)))
+        """
+        for dispatch in (vm.VM.DISPATCH_TABLE, vm.VM.DISPATCH_SWITCH):
+            env = {"apply1": runtime.Native(lambda f, x: m.call(f, x), 2)}
+            m = vm.VM(code.compile_source(source), env, dispatch=dispatch)
+            m.start()
+            self.assertEqual(env["r"], 115)
+            self.assertEqual(m.call(env["f"], 1), 11)
+
+    def test_hash_table_iteration(self):
+        def items(l):
+            items = []
+            while l:
+                items.append(l.car())
+                l = l.cdr()
+            return items
+
+        env = hashtable.install({})
+        vm.VM(compile("""
+        (define h (make-hash-table))
+        (define (fill i n) (if (= i n) h (begin (hash-set! h i (* i i)) (fill (+ i 1) n))))
+        (fill 0 100)
+        (hash-set! h (cons 1 2) "pair")
+        (define keys (hash-keys h))
+        (define values (hash-values h))
+        (define pairs (hash->list h))
+        """, True), env).start()
+        keys = items(env["keys"])
+        self.assertEqual(len(keys), 101)
+        # list keys come back as they were given.
+        pairs = [k for k in keys if isinstance(k, runtime.LinkList) and k.cdr() == 2]
+        self.assertEqual(str(pairs[0]), "(1 . 2)")
+        self.assertEqual(sorted(items(env["values"]))[:3], [0, 1, 4])
+        pairs = env["pairs"]
+        self.assertEqual(len(items(pairs)), 101)
+        self.assertEqual(env["h"].get(pairs.car().car()), pairs.car().cdr())
+
+    def test_hash_table_errors(self):
+        table = hashtable.make_hash_table()
+        self.assertRaises(ValueError, hashtable.hash_set, table, [1], 1)
+        self.assertRaises(ValueError, hashtable.hash_ref, table, {})
+        self.assertRaises(ValueError, hashtable.hash_remove, table, {})
+        self.assertRaises(ValueError, hashtable.hash_has_key, table, [1])
+        self.assertRaises(ValueError, hashtable.hash_ref, runtime.cons(1, 2), 1)
+        self.assertRaises(ValueError, hashtable.hash_count, None)
+        self.assertRaises(ValueError, hashtable.hash_remove, None, 1)
+        # a wrong argument count is not an unhashable key.
+        self.assertRaises(TypeError, hashtable.hash_ref, table, 1, 2, 3)
+
+    def test_hash_table_keys(self):
+        table = hashtable.make_hash_table()
+        for key in (1, 1.0, True):
+            table.set(key, type(key))
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.get(1.0), float)
+        self.assertEqual(sorted(table.keys()), [1, 1.0, True])
+        # the cdr of an improper list is keyed with its type too.
+        table.set(runtime.cons(1, 1), "int")
+        self.assertEqual(table.get(runtime.cons(1, 1.0)), None)
+
+    def test_string_builder(self):
+        b = strings.StringBuilder()
+        for part in ("ab", "c", "de"):
+            b.append(part)
+        self.assertEqual((b.getvalue(), str(b), b.length), ("abcde", "abcde", 5))
+        b.append("f")
+        self.assertEqual(b.getvalue(), "abcdef")
+        self.assertEqual(len(b.parts), 1)
+
+    def test_string_errors(self):
+        self.assertRaises(ValueError, strings.string_append, "a", 1)
+        self.assertRaises(ValueError, strings.substring, "abc", 2, 4)
+        self.assertRaises(ValueError, strings.substring, "abc", 2, 1)
+        self.assertRaises(ValueError, strings.number_to_string, "1")
+        self.assertRaises(ValueError, strings.string_builder_append, "b", "x")
+
+
+class Future(object):
+    """ enough of a future for vm.is_awaitable """
+    def __init__(self, value):
+        self.value = value
+
+    def add_done_callback(self, callback):
+        pass
+
+
+class TimeSlicing(unittest.TestCase):
+    source = """
+    (define (count n acc) (if (= n 0) acc (count (- n 1) (+ acc (fetch n)))))
+    (record (count 5 0))
+    """
+
+    def make_vm(self, fetch):
+        self.records = []
+
+        def record(value):
+            self.records.append(value)
+            return [None]
+
+        return vm.VM(code.compile_source(self.source),
+                     {"fetch": fetch, "record": record})
+
+    def test_slices(self):
+        m = self.make_vm(lambda n: [n])
+        slices = 1
+        while not m.run_slice(10):
+            slices += 1
+        self.assertEqual(self.records, [15])
+        self.assertTrue(slices > 5)
+
+    def test_interleave(self):
+        vms = [self.make_vm(lambda n: [n]) for _ in range(2)]
+        order = []
+        running = list(vms)
+        while running:
+            for m in list(running):
+                if m.run_slice(5):
+                    running.remove(m)
+                order.append(vms.index(m))
+        self.assertEqual(order[:4], [0, 1, 0, 1])
+
+    def test_suspend(self):
+        m = self.make_vm(lambda n: Future(n * 10))
+        waited = []
+
+        def wait(future):
+            waited.append(future.value)
+            return future.value
+
+        asyncvm.run_sync(m, 3, wait)
+        self.assertEqual(self.records, [150])
+        self.assertEqual(waited, [50, 40, 30, 20, 10])
+        self.assertRaises(vm.Suspend, self.make_vm(lambda n: Future(n)).start)
+
+    @unittest.skipIf(asyncvm.asyncio is None, "trollius is not installed")
+    def test_event_loop(self):
+        asyncio = asyncvm.asyncio
+
+        @asyncio.coroutine
+        def fetch(n):
+            yield asyncvm.From(asyncio.sleep(0, loop=loop))
+            raise asyncvm.Return(n)
+
+        loop = asyncio.new_event_loop()
+        try:
+            vms = [self.make_vm(lambda n: fetch(n)) for _ in range(3)]
+            loop.run_until_complete(asyncio.gather(
+                *[asyncvm.run(m, 4, loop=loop) for m in vms], loop=loop))
+        finally:
+            loop.close()
+        self.assertEqual(self.records, [15, 15, 15])
+
+
+class Tasks(unittest.TestCase):
+    def run_tasks(self, source):
+        outputs = []
+
+        def display(*args):
+            outputs.append(" ".join(str(a) for a in args))
+            return [None]
+
+        m = vm.VM(code.compile_source(source), {"display": display})
+        scheduler = vm.Scheduler(m)
+        scheduler.install(m.env)
+        scheduler.run()
+        return outputs
+
+    def test_yield(self):
+        source = """
+        (define (say name n)
+          (if (= n 0) 0 (begin (display name n) (yield) (say name (- n 1)))))
+        (spawn say 1 2)
+        (spawn say 2 2)
+        """
+        self.assertEqual(self.run_tasks(source), ["1 2", "2 2", "1 1", "2 1"])
+
+    def test_pipeline(self):
+        source = """
+        (define (produce out n)
+          (if (= n 0) (send out 0) (begin (send out n) (produce out (- n 1)))))
+        (define (square in out)
+          (let ((v (receive in)))
+            (begin (send out (* v v)) (if (= v 0) 0 (square in out)))))
+        (define (total in acc)
+          (let ((v (receive in))) (if (= v 0) acc (total in (+ acc v)))))
+        (define a (make-channel))
+        (define b (make-channel 4))
+        (spawn produce a 10)
+        (spawn square a b)
+        (display (total b 0))
+        """
+        self.assertEqual(self.run_tasks(source), ["385"])
+
+    def test_many_tasks(self):
+        source = """
+        (define done (make-channel 100000))
+        (define (work i) (begin (yield) (send done i)))
+        (define (start i) (if (= i 0) 0 (begin (spawn work i) (start (- i 1)))))
+        (define (wait n acc) (if (= n 0) acc (wait (- n 1) (+ acc (receive done)))))
+        (start 20000)
+        (display (wait 20000 0))
+        """
+        self.assertEqual(self.run_tasks(source), [str(20000 * 20001 / 2)])
+
+    def test_deadlock(self):
+        self.assertRaises(vm.VMException, self.run_tasks, "(receive (make-channel))")
+        self.assertRaises(vm.VMException, self.run_tasks, "(spawn 1)")
+
+
+def pool_setup(env):
+    env["offset"] = lambda: [100]
+
+
+class Pool(unittest.TestCase):
+    source = """
+    (define base (offset))
+    (define (score x y) (+ base (* x y)))
+    (define (pair . a) a)
+    """
+
+    def test_map(self):
+        import pool
+        with pool.Runner(self.source, setup=pool_setup, processes=2) as runner:
+            results = runner.map("score", [(i, 2) for i in range(20)] + [(1,)])
+            pairs = list(runner.imap("pair", [(1, 2), ()]))
+        self.assertEqual([r.value for r in results[:-1]],
+                         [100 + i * 2 for i in range(20)])
+        self.assertFalse(results[-1].ok)
+        self.assertTrue("VMException" in results[-1].error)
+        self.assertEqual([str(r.value) for r in pairs], ["(1 2)", "None"])
+
+    def test_call(self):
+        m = vm.VM(code.compile_source(self.source), {"offset": lambda: [1]})
+        m.start()
+        self.assertEqual(m.call(m.env["score"], 2, 3), 7)
+        self.assertEqual(m.call(m.env["offset"]), 1)
+        self.assertRaises(vm.VMException, m.call, m.env["score"], 1)
+
 
 class LispList(unittest.TestCase):
     def test_sclist2pylist(self):
@@ -197,6 +1468,91 @@ class LispList(unittest.TestCase):
         x = []
         assert x == sclist2pylist(build_list(x))
 
+    def test_cell_slots(self):
+        cell = runtime.cons(1, None)
+        self.assertFalse(hasattr(cell, "__dict__"))
+        self.assertEqual((cell.car(), cell.cdr()), (1, None))
+
+    def test_str(self):
+        build = runtime.build_list
+        self.assertEqual(str(build([1, [2, [3, "s"]], 4])), "(1 (2 (3 s)) 4)")
+        self.assertEqual(str(runtime.cons(1, 0)), "(1 . 0)")
+        self.assertEqual(str(runtime.cons(runtime.cons(1, 2), 3)), "((1 . 2) . 3)")
+        nested = None
+        for i in range(10000):
+            nested = runtime.cons(nested, None)
+        self.assertEqual(str(nested), "(" * 10000 + "None" + ")" * 10000)
+        self.assertEqual(str(build(range(100000))), "(%s)" % " ".join(map(str, range(100000))))
+
+
+class Bytecode(unittest.TestCase):
+    source = """
+    (define (muln n) (lambda (x) (* x n)))
+    (define (count . a) (if (= a 0) 0 (+ 1 (count))))
+    (define mul3 (muln 3))
+    (display (mul3 3.5) "x")
+    """
+
+    def run_consts(self, consts):
+        outputs = []
+
+        def display(*args):
+            outputs.append("".join(str(a) for a in args))
+            return [None]
+
+        vm.VM(consts, {"display": display}).start()
+        return outputs
+
+    def test_roundtrip(self):
+        import bytecode
+        consts = compile(self.source)
+        loaded = bytecode.loads(bytecode.dumps(consts))
+        self.assertEqual(len(list(consts)), len(list(loaded)))
+        for a, b in zip(consts, loaded):
+            if isinstance(a, code.FunctionProto):
+                self.assertEqual(a.insts, b.insts)
+                self.assertEqual(a.upvars, b.upvars)
+                self.assertEqual((a.argc, a.isVararg, a.maxLocalvars),
+                                 (b.argc, b.isVararg, b.maxLocalvars))
+            else:
+                self.assertEqual(a, b)
+        self.assertEqual(self.run_consts(loaded), ['10.5x'])
+
+    def test_register_roundtrip(self):
+        import bytecode
+        loaded = bytecode.loads(bytecode.dumps(compile_register(self.source)))
+        self.assertTrue(isinstance(loaded[-1], regcode.RegisterProto))
+        outputs = []
+
+        def display(*args):
+            outputs.append("".join(str(a) for a in args))
+            return [None]
+
+        regvm.RegisterVM(loaded, {"display": display}).start()
+        self.assertEqual(outputs, ['10.5x'])
+
+    def test_bad_data(self):
+        import bytecode
+        data = bytecode.dumps(compile(self.source))
+        self.assertRaises(bytecode.BytecodeException, bytecode.loads, "XXXX" + data[4:])
+        self.assertRaises(bytecode.BytecodeException, bytecode.loads, data[:4] + "\x00")
+
+    def test_cache(self):
+        import bytecode
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            cache = bytecode.Cache(directory)
+            first = cache.compile(self.source)
+            second = cache.compile(self.source)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertEqual(self.run_consts(first), self.run_consts(second))
+            cache.compile(self.source + "(display 1)")
+            self.assertEqual(cache.misses, 2)
+        finally:
+            shutil.rmtree(directory)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,130 @@
+"""
+Streaming compile and execute. Every top-level form is parsed, transformed,
+compiled into a main proto of its own and run before the next form is read,
+against one VM, env and global SymbolTable.
+
+    python toplevel.py [file]      run a file, or a REPL without one
+"""
+import sys
+
+import arrays
+import hashtable
+import memo
+import optimize
+import strings
+from code import CodeGenerator, ConstTable, FunctionProto, GenExp
+from parser import Parser, ParseException, Transform, traverse
+from symbol import SymbolTable
+from runtime import Globals, build_list, native
+from vm import VM
+
+
+class TopLevel(object):
+    def __init__(self, env, peephole=True, fold=True, dispatch=VM.DISPATCH_TABLE):
+        self.peephole = peephole
+        self.fold = fold
+        self.consts = ConstTable()
+        main = FunctionProto(0, False)
+        self.generator = CodeGenerator(self.consts, main)
+        self.symbols = SymbolTable(self.generator)
+        self.vm = VM(self.consts, env, entry=main, dispatch=dispatch)
+
+    @property
+    def env(self):
+        return self.vm.env
+
+    def compile(self, form):
+        """ compile one top-level form, its value is left on the stack """
+        ast = [form]
+        traverse(ast, Transform())
+        if self.fold:
+            optimize.fold(ast)
+
+        main = FunctionProto(0, False)
+        self.generator.newMain(main)
+        self.symbols.globalScope.proto = main
+        first = len(self.consts.consts)
+        try:
+            GenExp(ast[0], self.symbols, self.generator)
+        except:
+            # drop scopes and protos left open by the failed form.
+            self.symbols.current = self.symbols.globalScope
+            self.symbols.scopes = []
+            self.generator.stack = []
+            raise
+
+        if self.peephole:
+            for value in self.consts.consts[first:] + [main]:
+                if isinstance(value, FunctionProto):
+                    value.insts[:] = optimize.optimize_insts(value.insts)
+        return main
+
+    def execute(self, form):
+        """ compile and run one form, returns its value """
+        return self.vm.execute(self.compile(form))
+
+    def run(self, src):
+        """
+        run every form of 'src', a string or a file, returns the value of
+        the last one.
+        """
+        value = None
+        for form in Parser(src, fast=True).iter_exprs():
+            value = self.execute(form)
+        return value
+
+
+def default_env(out=sys.stdout):
+    @native()
+    def display(*args):
+        out.write(" ".join(str(arg) for arg in args) + "\n")
+
+    @native(name="list")
+    def newList(*args):
+        return build_list(args)
+
+    env = Globals(display=display, list=newList)
+    hashtable.install(env)
+    memo.install(env)
+    strings.install(env)
+    if arrays.numpy is not None:
+        arrays.install(env)
+    return env
+
+
+def repl(toplevel=None, read=raw_input, out=sys.stdout):
+    """ read forms until EOF, printing the value of each """
+    if toplevel is None:
+        toplevel = TopLevel(default_env(out))
+    lines = []
+    while 1:
+        try:
+            lines.append(read(". " if lines else "> "))
+        except EOFError:
+            return
+        try:
+            forms = Parser("\n".join(lines), fast=True).exprs()
+        except ParseException:
+            # an unfinished form goes on at the next line.
+            continue
+        lines = []
+        for form in forms:
+            try:
+                value = toplevel.execute(form)
+            except Exception, e:
+                out.write("%s: %s\n" % (type(e).__name__, e))
+                break
+            if value is not None:
+                out.write("%s\n" % (value,))
+
+
+def main(argv):
+    if len(argv) > 1:
+        with open(argv[1], "rb") as f:
+            TopLevel(default_env()).run(f)
+    else:
+        repl()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
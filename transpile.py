@@ -0,0 +1,624 @@
+"""
+Ahead of time translation of a compiled program into python source. Every
+FunctionProto becomes a python function, made by a factory which takes the
+cells of its upvars, so a Lisp closure is a runtime.Native wrapping a
+python closure and the interpreter calls it as a host function.
+
+Localvars are python locals, a captured one lives in a one element list
+which is replaced when its scope is closed. The operand stack is kept as
+python expressions while translating, forward jumps become if/else and a
+tail call of a function to itself becomes a loop. A function with other
+tail calls is wrapped in a trampoline, they return a TailCall to it when
+the callee has one too, so mutual tail recursion doesn't grow the stack.
+
+    program = transpile.translate(code.compile_source(src))
+    program.run(env)
+    python transpile.py script.lisp     print the generated source
+"""
+import os
+import sys
+import marshal
+import hashlib
+import tempfile
+
+import bytecode
+from const import *
+from code import FunctionProto
+from memo import Memo
+from regcode import RegisterProto
+from runtime import Closure, Native, LinkList, build_list, car, cdr
+from vm import VM, VMException
+
+MAGIC = "PYLT"
+
+BINOPS = {
+    Symbol2BinOp["+"]: "(%s + %s)",
+    Symbol2BinOp["-"]: "(%s - %s)",
+    Symbol2BinOp["*"]: "(%s * %s)",
+    Symbol2BinOp["/"]: "(%s / %s)",
+    Symbol2BinOp["cons"]: "LinkList(%s, %s)",
+    Symbol2BinOp["="]: "(%s == %s)",
+    Symbol2BinOp[">"]: "(%s > %s)",
+}
+
+UNOPS = {
+    Symbol2UnOp["-"]: "(-%s)",
+    Symbol2UnOp["car"]: "car(%s)",
+    Symbol2UnOp["cdr"]: "cdr(%s)",
+}
+
+# constants written as python literals, anything else is read from consts.
+LITERALS = (int, long, float, str, bool, type(None))
+
+NO_DEPS = frozenset()
+VARG = "va"
+
+
+class TailCall(object):
+    """ a tail call to the trampolined Native 'func', returned to the trampoline """
+    __slots__ = ["func", "args"]
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+
+class TranspileException(Exception):
+    pass
+
+
+def successors(pc, inst):
+    op, operand = inst
+    if op == OpJump:
+        # a jump back starts the function again, see code.GenSelfTailCall
+        return (pc + operand,) if operand > 0 else ()
+    elif op == OpTest:
+        return (pc + 1, pc + operand)
+    elif op == OpBinOpTest:
+        return (pc + 1, pc + operand[1])
+    elif op in (OpRet, OpTailCall, OpHalt):
+        return ()
+    return (pc + 1,)
+
+
+def postdominators(insts):
+    """
+    immediate postdominator of every instruction, len(insts) is the exit.
+    Jumps back are exits too, so a postdominator has a larger pc.
+    """
+    n = len(insts)
+    ipdom = [n] * (n + 1)
+    for pc in reversed(range(n)):
+        succ = successors(pc, insts[pc])
+        if not succ:
+            continue
+        a = succ[0]
+        for b in succ[1:]:
+            while a != b:
+                if a < b:
+                    a = ipdom[a]
+                else:
+                    b = ipdom[b]
+        ipdom[pc] = a
+    return ipdom
+
+
+class Value(object):
+    """
+    an entry of the operand stack, a python expression. 'deps' are the
+    locals it reads, 'safe' ones can be evaluated later without changing
+    what the program does. 'name' is the global it was loaded from.
+    """
+    __slots__ = ["expr", "deps", "safe", "name"]
+
+    def __init__(self, expr, deps=NO_DEPS, safe=True, name=None):
+        self.expr = expr
+        self.deps = deps
+        self.safe = safe
+        self.name = name
+
+    def __eq__(self, other):
+        return self.expr == other.expr
+
+    def __ne__(self, other):
+        return self.expr != other.expr
+
+
+class FunctionWriter(object):
+    """ python source of one FunctionProto """
+    def __init__(self, proto, index, consts):
+        self.proto = proto
+        self.index = index
+        self.name = "lisp_%d" % index
+        self.consts = consts
+        self.insts = list(bytecode.unquicken(proto.insts, consts))
+        self.ipdom = postdominators(self.insts)
+        self.ntemps = 0
+        self.self_tail = False
+        self.other_tail = False
+        # captured localvar => scope indexes it is captured in
+        self.cells = {}
+        self.varg_cell = False
+        for op, operand in self.insts:
+            if op != OpBuildClosure:
+                continue
+            for kind, index, scope_index in consts[operand].upvars:
+                if kind == "local":
+                    self.cells.setdefault(index, set()).add(scope_index)
+                elif kind == "varg":
+                    self.varg_cell = True
+
+    def temp(self, prefix="t"):
+        self.ntemps += 1
+        return "%s%d" % (prefix, self.ntemps)
+
+    def assign(self, expr, out, depth):
+        name = self.temp()
+        out.append((depth, "%s = %s" % (name, expr)))
+        return Value(name)
+
+    def flush(self, stack, out, depth, dep=None):
+        """
+        evaluate stack entries into temps, the ones reading 'dep', or the
+        unsafe ones when 'dep' is None
+        """
+        for i, value in enumerate(stack):
+            if (value.deps and dep in value.deps) if dep is not None else not value.safe:
+                stack[i] = self.assign(value.expr, out, depth)
+
+    def local(self, index):
+        if index in self.cells:
+            return Value("l%d[0]" % index, frozenset([index]))
+        return Value("l%d" % index, frozenset([index]))
+
+    def literal(self, index):
+        value = self.consts[index]
+        if type(value) in LITERALS:
+            return Value(repr(value))
+        return Value("consts[%d]" % index)
+
+    def call(self, callee, args):
+        if not callee.expr.isalnum():
+            raise TranspileException("callee is not a name")
+        n = len(args)
+        args = ", ".join(arg.expr for arg in args)
+        sep = ", " if args else ""
+        # call checks the arity of a Native as the VM does.
+        return "(%s.func(%s) if type(%s) is Native and %s.argc in (%d, None) else call(%s%s%s))" % (
+            callee.expr, args, callee.expr, callee.expr, n, callee.expr, sep, args)
+
+    def pop(self, stack, n):
+        values = stack[len(stack) - n:]
+        del stack[len(stack) - n:]
+        return values
+
+    def emit(self, pc, stop, stack, out, depth):
+        """
+        translate insts from 'pc' until 'stop', returns the stack there or
+        None when every path has returned.
+        """
+        insts = self.insts
+        n = len(insts)
+        while pc != stop:
+            if pc >= n:
+                out.append((depth, "return None"))
+                return None
+            start = pc
+            op, operand = insts[pc]
+            pc += 1
+
+            if op == OpLoadLocal:
+                stack.append(self.local(operand))
+
+            elif op == OpSetLocal:
+                value = stack.pop()
+                self.flush(stack, out, depth, operand)
+                out.append((depth, "%s = %s" % (self.local(operand).expr, value.expr)))
+
+            elif op == OpLoadGlobal:
+                self.flush(stack, out, depth)
+                value = self.assign("env[%r]" % self.consts[operand], out, depth)
+                value.name = self.consts[operand]
+                stack.append(value)
+
+            elif op == OpSetGlobal:
+                value = stack.pop()
+                self.flush(stack, out, depth)
+                out.append((depth, "env[%r] = %s" % (self.consts[operand], value.expr)))
+
+            elif op == OpLoadUpvar:
+                stack.append(Value("u%d[0]" % operand, frozenset([("u", operand)])))
+
+            elif op == OpSetUpvar:
+                value = stack.pop()
+                self.flush(stack, out, depth, ("u", operand))
+                out.append((depth, "u%d[0] = %s" % (operand, value.expr)))
+
+            elif op == OpLoadVarg:
+                expr = "va[0]" if self.varg_cell else "va"
+                stack.append(Value(expr, frozenset([VARG])))
+
+            elif op == OpLoadConst:
+                stack.append(self.literal(operand))
+
+            elif op == OpBinOp:
+                a, b = self.pop(stack, 2)
+                if operand not in BINOPS:
+                    raise TranspileException("Unknown BinOp '%s'" % operand)
+                stack.append(Value(BINOPS[operand] % (a.expr, b.expr),
+                                   a.deps | b.deps, False))
+
+            elif op == OpUnOp:
+                a = stack.pop()
+                if operand not in UNOPS:
+                    raise TranspileException("Unknown UnOp '%s'" % operand)
+                stack.append(Value(UNOPS[operand] % a.expr, a.deps, False))
+
+            elif op == OpLocalConstBinOp:
+                local, const, binop = operand
+                a, b = self.local(local), self.literal(const)
+                stack.append(Value(BINOPS[binop] % (a.expr, b.expr), a.deps, False))
+
+            elif op == OpLocalLocalBinOp:
+                x, y, binop = operand
+                a, b = self.local(x), self.local(y)
+                stack.append(Value(BINOPS[binop] % (a.expr, b.expr),
+                                   a.deps | b.deps, False))
+
+            elif op == OpCall:
+                args = self.pop(stack, operand)
+                callee = stack.pop()
+                self.flush(stack, out, depth)
+                if not callee.expr.isalnum():
+                    callee = self.assign(callee.expr, out, depth)
+                stack.append(self.assign(self.call(callee, args), out, depth))
+
+            elif op == OpTailCall:
+                args = self.pop(stack, operand)
+                callee = stack.pop()
+                if not callee.expr.isalnum():
+                    callee = self.assign(callee.expr, out, depth)
+                self.tail_call(callee, args, out, depth)
+                return None
+
+            elif op == OpRet:
+                if operand != 1:
+                    raise TranspileException("Returns %s values" % operand)
+                out.append((depth, "return %s" % stack.pop().expr))
+                return None
+
+            elif op == OpHalt:
+                out.append((depth, "return None"))
+                return None
+
+            elif op == OpJump:
+                if operand <= 0:
+                    if start + operand != 0:
+                        raise TranspileException("Jump back into the body")
+                    # the arguments are stored already.
+                    self.self_tail = True
+                    out.append((depth, "continue"))
+                    return None
+                pc = start + operand
+
+            elif op in (OpTest, OpBinOpTest):
+                if op == OpTest:
+                    cond = stack.pop()
+                    target = start + operand
+                else:
+                    binop, offset = operand
+                    a, b = self.pop(stack, 2)
+                    cond = Value(BINOPS[binop] % (a.expr, b.expr))
+                    target = start + offset
+                stack = self.branch(cond, pc, target, self.ipdom[start], stack, out, depth)
+                if stack is None:
+                    return None
+                pc = self.ipdom[start]
+
+            elif op == OpPop:
+                for value in self.pop(stack, operand):
+                    if not value.safe:
+                        out.append((depth, value.expr))
+
+            elif op == OpCloseUpvar:
+                # later stores to the slots go to new cells.
+                for index, scopes in sorted(self.cells.items()):
+                    if max(scopes) >= operand:
+                        self.flush(stack, out, depth, index)
+                        out.append((depth, "l%d = [None]" % index))
+
+            elif op == OpBuildClosure:
+                stack.append(self.assign(self.closure(operand), out, depth))
+
+            else:
+                raise TranspileException("Can't transpile %s" % VMOps.get(op, op))
+        return stack
+
+    def branch(self, cond, pc, target, join, stack, out, depth):
+        outs = [[], []]
+        stacks = [self.emit(start, join, list(stack), body, depth + 1)
+                  for start, body in zip((pc, target), outs)]
+        live = [s for s in stacks if s is not None]
+        if len(live) == 2:
+            # values which differ between the branches go in join variables.
+            merged = []
+            for a, b in zip(*live):
+                if a == b:
+                    merged.append(a)
+                    continue
+                name = self.temp("j")
+                outs[0].append((depth + 1, "%s = %s" % (name, a.expr)))
+                outs[1].append((depth + 1, "%s = %s" % (name, b.expr)))
+                merged.append(Value(name))
+            stack = merged
+        elif live:
+            stack = live[0]
+        else:
+            stack = None
+
+        out.append((depth, "if %s:" % cond.expr))
+        out.extend(outs[0] or [(depth + 1, "pass")])
+        out.append((depth, "else:"))
+        out.extend(outs[1] or [(depth + 1, "pass")])
+        return stack
+
+    def tail_call(self, callee, args, out, depth):
+        proto = self.proto
+        argc = proto.argc
+        # a global of another name is not worth the check.
+        other = callee.name not in (None, getattr(proto, "name", None))
+        if not other and (proto.isVararg and len(args) >= argc or len(args) == argc):
+            self.self_tail = True
+            # entry is the function of the Native, the trampoline if it has one.
+            out.append((depth, "if type(%s) is Native and %s.func is entry:"
+                        % (callee.expr, callee.expr)))
+            names = ["l%d" % i for i in range(argc)]
+            values = [arg.expr for arg in args[:argc]]
+            if proto.isVararg:
+                names.append("rest")
+                rest = [arg.expr for arg in args[argc:]]
+                values.append("(%s)" % "".join(v + ", " for v in rest))
+            if names:
+                out.append((depth + 1, "%s = %s" % (", ".join(names), ", ".join(values))))
+            out.extend((depth + 1, line) for line in self.prologue())
+            out.append((depth + 1, "continue"))
+            # only a rebound name gets here, it is not worth a trampoline.
+            out.append((depth, "return %s" % self.call(callee, args)))
+            return
+        # a chain of tail calls can only be unbounded through functions
+        # with a trampoline, anything else is called right away.
+        self.other_tail = True
+        out.append((depth, "if type(%s) is Native and %s.argc in (%d, None) and "
+                    "getattr(%s.func, 'body', None):"
+                    % (callee.expr, callee.expr, len(args), callee.expr)))
+        out.append((depth + 1, "return TailCall(%s, (%s))" % (
+            callee.expr, "".join(arg.expr + ", " for arg in args))))
+        out.append((depth, "return %s" % self.call(callee, args)))
+
+    def closure(self, index):
+        proto = self.consts[index]
+        if not isinstance(proto, FunctionProto) or isinstance(proto, RegisterProto):
+            raise TranspileException("Not a stack FunctionProto")
+        cells = []
+        for kind, i, scope_index in proto.upvars:
+            if kind == "local":
+                cells.append("l%d" % i)
+            elif kind == "varg":
+                cells.append("va")
+            else:
+                cells.append("u%d" % i)
+        argc = None if proto.isVararg else proto.argc
+        return "Native(make_%d(%s), %r, %r)" % (
+            index, ", ".join(cells), argc, getattr(proto, "name", None))
+
+    def prologue(self):
+        proto = self.proto
+        lines = []
+        for i in range(proto.argc):
+            if i in self.cells:
+                lines.append("l%d = [l%d]" % (i, i))
+        if proto.isVararg:
+            if self.varg_cell:
+                lines.append("va = [build_list(rest)]")
+            else:
+                lines.append("va = build_list(rest)")
+        for i in range(proto.argc, proto.maxLocalvars):
+            lines.append("l%d = %s" % (i, "[None]" if i in self.cells else "None"))
+        return lines
+
+    def source(self):
+        proto = self.proto
+        body = []
+        self.emit(0, None, [], body, 0)
+        params = ["l%d" % i for i in range(proto.argc)]
+        header = []
+        if proto.isVararg:
+            # a Native of any arity, the body checks it as the VM does.
+            header = ["if len(rest) < %d:" % proto.argc,
+                      "    raise VMException('Expect equal or more than %d arguments, got %%s'"
+                      " %% len(rest))" % proto.argc]
+            if params:
+                header.append("%s, = rest[:%d]" % (", ".join(params), proto.argc))
+                header.append("rest = rest[%d:]" % proto.argc)
+            params = ["*rest"]
+        upvars = ["u%d" % i for i in range(len(proto.upvars))]
+
+        lines = ["def make_%d(%s):" % (self.index, ", ".join(upvars)),
+                 "    def %s(%s):" % (self.name, ", ".join(params))]
+        indent = "        "
+        lines.extend(indent + line for line in header)
+        lines.extend(indent + line for line in self.prologue())
+        if self.self_tail:
+            lines.append(indent + "while 1:")
+            indent += "    "
+        lines.extend(indent + "    " * depth + line for depth, line in body)
+        if self.other_tail:
+            lines.append("    entry = trampoline(%s)" % self.name)
+        else:
+            lines.append("    entry = %s" % self.name)
+        lines.append("    return entry")
+        return "\n".join(lines) + "\n"
+
+
+def source(consts):
+    """ python source of the program 'consts' """
+    protos = [(i, value) for i, value in enumerate(consts)
+              if isinstance(value, FunctionProto)]
+    for i, proto in protos:
+        if isinstance(proto, RegisterProto):
+            raise TranspileException("Only stack protos can be transpiled")
+    parts = [FunctionWriter(proto, i, consts).source() for i, proto in protos]
+    main = protos[-1][0]
+    parts.append("main = make_%d()\n" % main)
+    return "\n\n".join(parts)
+
+
+def translate(consts):
+    """ a Program of 'consts', raises TranspileException """
+    return Program(compile(source(consts), "<transpiled>", "exec"), consts)
+
+
+class Program(object):
+    """
+    a transpiled program, run(env) runs its main proto. Closures of the
+    interpreter it calls run on a VM of 'consts', or of the consts of 'vm'
+    when they come from another program.
+    """
+    def __init__(self, code, consts):
+        self.code = code
+        self.consts = consts
+
+    def run(self, env, vm=None):
+        consts = self.consts if vm is None else vm.consts
+
+        def call(func, *args):
+            # Natives are called inline by the generated code, but not
+            # the one a Memo wraps.
+            if type(func) is Native:
+                if func.argc is not None and func.argc != len(args):
+                    raise VMException("Expect %s arguments, got %s"
+                                      % (func.argc, len(args)))
+                return func.func(*args)
+            if isinstance(func, Closure):
+                return VM(consts, env).call(func, *args)
+            if type(func) is Memo:
+                return func.call(call, args)
+            ret = func(*args)
+            return ret[-1] if ret else None
+
+        def trampoline(body):
+            # the function the interpreter and the generated code call.
+            def bounce(*args):
+                ret = body(*args)
+                while type(ret) is TailCall:
+                    # the callee has a trampoline too, its body runs here
+                    # and its tail calls come back to this loop.
+                    ret = ret.func.func.body(*ret.args)
+                return ret
+            bounce.body = body
+            return bounce
+
+        namespace = {
+            "Native": Native,
+            "LinkList": LinkList,
+            "build_list": build_list,
+            "car": car,
+            "cdr": cdr,
+            "env": env,
+            "consts": consts,
+            "call": call,
+            "trampoline": trampoline,
+            "TailCall": TailCall,
+            "VMException": VMException,
+        }
+        exec self.code in namespace
+        return namespace["main"]()
+
+
+def run(consts, env):
+    """ run the stack program 'consts' transpiled, or by the VM when it can't be """
+    try:
+        program = translate(consts)
+    except TranspileException:
+        VM(consts, env).start()
+        return None
+    return program.run(env)
+
+
+_fingerprint = None
+
+
+def transpiler_version():
+    """ digest of the compiler, this module and the python running it """
+    global _fingerprint
+    if _fingerprint is None:
+        h = hashlib.sha1(bytecode.compiler_version() + sys.version)
+        with open(os.path.splitext(__file__)[0] + ".py", "rb") as f:
+            h.update(f.read())
+        _fingerprint = h.hexdigest()
+    return _fingerprint
+
+
+class Cache(object):
+    """ on-disk cache of transpiled code objects keyed by program """
+    suffix = ".lispy"
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.path.join(os.path.expanduser("~"), ".cache",
+                                     "pylisp", "transpiled")
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, consts):
+        key = hashlib.sha1(transpiler_version() + bytecode.dumps(consts)).hexdigest()
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, consts):
+        try:
+            with open(self.path(consts), "rb") as f:
+                data = f.read()
+        except IOError:
+            return None
+        if data[:len(MAGIC)] != MAGIC:
+            return None
+        try:
+            return Program(marshal.loads(data[len(MAGIC):]), consts)
+        except (ValueError, EOFError, TypeError):
+            return None
+
+    def put(self, consts, program):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(MAGIC + marshal.dumps(program.code))
+            os.rename(tmp, self.path(consts))
+        except:
+            os.unlink(tmp)
+            raise
+
+    def translate(self, consts):
+        program = self.get(consts)
+        if program is not None:
+            self.hits += 1
+            return program
+        self.misses += 1
+        program = translate(consts)
+        self.put(consts, program)
+        return program
+
+
+def main(argv):
+    import code
+    if len(argv) < 2:
+        print "usage: python transpile.py script.lisp"
+        return
+    with open(argv[1], "rb") as f:
+        print source(code.compile_source(f.read()))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,54 +1,171 @@
+from types import GeneratorType
+from collections import deque
+
 from const import *
 
-from runtime import LinkList, build_list, Closure
+from runtime import LinkList, build_list, Closure, Upvar, UpvarForVarg
+from runtime import Globals, SLOT_NAMES, UNBOUND, Native
+from code import FunctionProto
+from memo import Memo, MISSING
 
 
 class VMException(Exception):
     pass
 
 
+class Suspend(VMException):
+    """ a host function returned an awaitable, see VM.run_slice """
+    def __init__(self, awaitable):
+        VMException.__init__(self, "A host function returned an awaitable "
+                                   "outside of VM.run_slice")
+        self.awaitable = awaitable
+
+
+def is_awaitable(value):
+    """ a generator based coroutine or a future """
+    return isinstance(value, GeneratorType) or hasattr(value, "add_done_callback")
+
+
 class Frame(object):
-    def __init__(self, proto, upvars, args):
+    """
+    Frames share one value stack. stack[base - 1] holds the callee,
+    stack[base:base + maxLocalvars] are the localvars (arguments first)
+    and the operand stack of the frame grows above them.
+    """
+    __slots__ = ["proto", "insts", "upvars", "stack", "base", "varargs",
+                 "pc", "open_upvars"]
+
+    def __init__(self, proto, upvars, stack, base):
         self.proto = proto
         self.insts = proto.insts
-        self.args = args
         self.upvars = upvars
-        self.to_be_forked = False
-
-        self.localvars = [None] * proto.maxLocalvars
+        self.stack = stack
+        self.base = base
+        self.pc = 0
+        # upvars pointing into this frame's localvars, None if there is none.
+        self.open_upvars = None
 
-        argn = len(args)
+        argn = len(stack) - base
         argc = proto.argc
         if proto.isVararg:
             if argn >= argc:
-                self.localvars[:argc] = args[:argc]
-                self.varargs = build_list(args[argc:])
+                self.varargs = build_list(stack[base + argc:])
+                del stack[base + argc:]
             else:
                 raise VMException("Expect equal or more than %s arguments, got %s"
                                   % (argc, argn))
+        elif argn != argc:
+            raise VMException("Expect %s arguments, got %s" % (argc, argn))
+
+        padding = proto.maxLocalvars - argc
+        if padding:
+            stack.extend((None,) * padding)
+
+    def capture(self, index, scope_index):
+        """ the open upvar for localvar 'index', shared by all closures """
+        slot = self.base + index
+        if self.open_upvars is None:
+            self.open_upvars = []
         else:
-            if argn == argc:
-                self.localvars[:argc] = args[:]
-            else:
-                raise VMException("Expect %s arguments, got %s" % (argc, argn))
+            for upvar in self.open_upvars:
+                if upvar.index == slot:
+                    return upvar
+        upvar = Upvar(self.stack, slot, scope_index)
+        self.open_upvars.append(upvar)
+        return upvar
+
+    def capture_varargs(self):
+        if self.open_upvars is None:
+            self.open_upvars = []
+        else:
+            for upvar in self.open_upvars:
+                if upvar.index is None:
+                    return upvar
+        upvar = UpvarForVarg(self)
+        self.open_upvars.append(upvar)
+        return upvar
 
-        self.stack = []
+
+HALT_PROTO = FunctionProto(0, False)
+HALT_PROTO.insts = [(OpHalt, 0)]
+
+# a memoized closure returns into a frame of it, see call_memo
+MEMO_PROTO = FunctionProto(0, False)
+MEMO_PROTO.insts = [(OpMemoStore, 0)]
+
+
+# builds a Frame without running its __init__, for calls through an
+# inline cache whose arguments are known to match.
+new = object.__new__
 
 
 def close_upvars(frame, scope_index):
-    for upvar in frame.upvars:
-        if upvar.frame is frame and upvar.scope_index == index:
+    """ close upvars of the scope 'scope_index' and the scopes nested in it """
+    upvars = frame.open_upvars
+    if not upvars:
+        return
+    still_open = []
+    for upvar in upvars:
+        if upvar.scope_index >= scope_index:
             upvar.close()
+        else:
+            still_open.append(upvar)
+    frame.open_upvars = still_open or None
+
+
+def tail_frame(frame, closure, argn):
+    """
+    replace 'frame' with a call to 'closure', reusing its stack slots and
+    the Frame itself. Once its upvars are closed nothing else refers to it.
+    """
+    close_upvars(frame, 0)
+    stack = frame.stack
+    base = frame.base
+    stack[base - 1:] = stack[-argn - 1:]
+    Frame.__init__(frame, closure.proto, closure.upvars, stack, base)
+    return frame
 
 
 class VM(object):
-    def __init__(self, consts, env, entry=None, debug=False):
+    DISPATCH_SWITCH = "switch"
+    DISPATCH_TABLE = "table"
+
+    def __init__(self, consts, env, entry=None, debug=False,
+                 dispatch=DISPATCH_TABLE, adaptive=False):
         self.consts = consts
         self.env = env
         if not entry:
             entry = consts[-1]
-        self.frames = [Frame(entry, [], [])]
-        self.debug = debug
+        self.stack = []
+        self.frames = [Frame(entry, [], self.stack, 0)]
+        if dispatch not in (VM.DISPATCH_SWITCH, VM.DISPATCH_TABLE):
+            raise VMException("Unknown dispatch mode '%s'" % dispatch)
+        self.dispatch = dispatch
+        # awaitable returned by a host function, see run_slice
+        self.awaiting = None
+        # see turn_profile
+        self.profiler = None
+        # calls through inline caches, see op_call_cached
+        self.ic_hits = 0
+        self.ic_misses = 0
+        # proto => Specialization, see specialize
+        self.specializations = {}
+        if adaptive and dispatch != VM.DISPATCH_TABLE:
+            raise VMException("Adaptive mode needs the table dispatch")
+        self.adaptive = adaptive
+        # globals are quickened to slots only in a Globals env, a plain
+        # dict may be changed behind the VM's back.
+        if isinstance(env, Globals):
+            self.globals = env.values
+            tables = ADAPTIVE_TABLES if adaptive else TABLES
+        else:
+            self.globals = None
+            tables = ADAPTIVE_DICT_TABLES if adaptive else DICT_TABLES
+        self.table, self.traced_table = tables
+        # per VM copy, turn_debug swaps the handlers in place so a running
+        # loop sees the change without checking a flag per instruction.
+        self.handlers = list(self.table)
+        self.turn_debug(debug)
 
     def inst2str(self, inst):
         operator, operand = inst
@@ -63,136 +180,290 @@ class VM(object):
         elif operator == OpLoadConst:
             c = self.consts[operand]
             return "%s %s # %s" % (op, operand, c)
-        elif operator == OpLoadGlobal:
+        elif operator in (OpLoadGlobal, OpSetGlobal):
             c = self.consts[operand]
             return "%s %s # %s" % (op, operand, c)
+        elif operator in (OpLoadGlobalSlot, OpSetGlobalSlot):
+            return "%s %s # %s" % (op, operand, SLOT_NAMES[operand])
+        elif operator in (OpLocalConstBinOp, OpLocalLocalBinOp, OpLocalLocalBinOpInt):
+            a, b, binop = operand
+            return "%s %s %s  %s" % (op, a, b, BinOps[binop][0])
+        elif operator == OpBinOpTest:
+            binop, offset = operand
+            return "%s  %s %s" % (op, BinOps[binop][0], offset)
+        elif operator in (OpCallCached, OpTailCallCached):
+            argc, proto, _ = operand
+            return "%s %s # %s" % (op, argc, getattr(proto, "name", None) or "<lambda>")
+        elif operator in (OpBinOpInt, OpBinOpFloat, OpBinOpCons):
+            return "%s  %s" % (op, BinOps[operand][0])
+        elif operator == OpUnOpList:
+            return "%s  %s" % (op, UnOps[operand][0])
+        elif operator == OpLocalConstBinOpInt:
+            a, _, binop, value = operand
+            return "%s %s %s  %s" % (op, a, value, BinOps[binop][0])
+        elif operator == OpBinOpTestInt:
+            binop, offset = operand
+            return "%s  %s %s" % (op, BinOps[binop][0], offset)
         else:
             return "%s %s" % (op, operand)
 
+    def specialization_stats(self):
+        """
+        [(proto, specialized, specializations, deopts)] of every proto the
+        VM specialized, 'specialized' are its instructions which still are.
+        """
+        stats = []
+        for proto, spec in self.specializations.items():
+            specialized = sum(1 for op, _ in proto.insts if op in SPECIALIZED)
+            stats.append((proto, specialized, spec.specialized, spec.deopts))
+        return stats
+
     def turn_debug(self, flag):
         self.debug = flag
+        self.handlers[:] = self.traced_table if flag else self.table
+
+    def turn_profile(self, profiler):
+        """ run the handlers of 'profiler', see profiler.py, None stops it """
+        if profiler is None:
+            self.handlers[:] = self.table
+        elif self.dispatch != VM.DISPATCH_TABLE:
+            raise VMException("Profiling needs the table dispatch")
+        else:
+            self.handlers[:] = profiler.wrap(self.table)
+        self.profiler = profiler
+
+    def execute(self, proto):
+        """
+        Run 'proto' as a new main program on the same consts and env and
+        return the value it leaves on the stack, None if there is none.
+        """
+        stack = self.stack
+        del stack[:]
+        frame = Frame(proto, [], stack, 0)
+        self.frames = [frame]
+        self.start()
+        close_upvars(frame, 0)
+        if len(stack) > proto.maxLocalvars:
+            return stack[-1]
+
+    def call(self, func, *args):
+        """ call a Lisp closure or a host function, returns its value """
+        if type(func) is Native:
+            return func(*args)
+        if type(func) is Memo:
+            return func.call(self.call, args)
+        if not isinstance(func, Closure):
+            ret = func(*args)
+            return ret[-1] if ret else None
+        # a host function may call back while the VM runs, the call goes
+        # above the running program's stack and frames.
+        stack = self.stack
+        frames = self.frames
+        top = len(stack)
+        # the callee returns into a frame which only halts.
+        halt = Frame(HALT_PROTO, [], stack, top)
+        stack.append(func)
+        stack.extend(args)
+        try:
+            frame = Frame(func.proto, func.upvars, stack, top + 1)
+            self.frames = [halt, frame]
+            if self.profiler is not None:
+                # its OpRet leaves the entry.
+                self.profiler.enter_proto(func.proto)
+            self.start()
+            return stack[-1]
+        finally:
+            del stack[top:]
+            self.frames = frames
+
+    def run_slice(self, budget):
+        """
+        Run at most 'budget' instructions, returns True when the program has
+        finished. A host function which returns an awaitable ends the slice
+        early, the awaitable is left in self.awaiting and the program goes
+        on once resume() is given its value.
+        """
+        if self.dispatch != VM.DISPATCH_TABLE:
+            raise VMException("Time slicing needs the table dispatch")
+        if self.awaiting is not None:
+            raise VMException("The VM is waiting for a host function")
+        frame = self.frames.pop()
+        handlers = self.handlers
+        try:
+            while budget:
+                budget -= 1
+                pc = frame.pc
+                frame.pc = pc + 1
+                operator, operand = frame.insts[pc]
+                frame = handlers[operator](self, frame, operand)
+                if frame is None:
+                    return True
+        except IndexError:
+            if frame.pc <= len(frame.insts):
+                raise
+            return True
+        except Suspend, e:
+            # the handler has popped the call, the value goes in its place.
+            self.awaiting = e.awaitable
+        self.frames.append(frame)
+        return False
+
+    def resume(self, value):
+        """ the value of the awaitable the VM is waiting for """
+        if self.awaiting is None:
+            raise VMException("The VM is not waiting for a host function")
+        self.awaiting = None
+        self.stack.append(value)
 
     def start(self):
+        frame = self.frames.pop()
+        if self.dispatch == VM.DISPATCH_SWITCH:
+            self.run_switch(frame)
+        else:
+            self.run_table(frame)
+
+    def run_table(self, frame):
+        handlers = self.handlers
+        try:
+            while frame is not None:
+                pc = frame.pc
+                frame.pc = pc + 1
+                operator, operand = frame.insts[pc]
+                frame = handlers[operator](self, frame, operand)
+        except IndexError:
+            # running off the end of insts finishes the program.
+            if frame.pc <= len(frame.insts):
+                raise
+
+    def run_switch(self, frame):
         env = self.env
         consts = self.consts
         frames = self.frames
-        frame = frames.pop()
+        stack = self.stack
         insts = frame.insts
-        pc = 0
+        base = frame.base
+        pc = frame.pc
+        debug = self.debug
 
         while True:
             try:
                 operator, operand = insts[pc]
-                if self.debug:
+                if debug:
                     print self.inst2str(insts[pc])
             except IndexError:
                 return
 
             if operator == OpLoadLocal:
                 assert operand >= 0
-                var = frame.localvars[operand]
-                assert var is not None
-                frame.stack.append(var)
+                var = stack[base + operand]
+                stack.append(var)
 
             elif operator == OpSetLocal:
                 assert operand >= 0
-                a = frame.stack.pop()
-                frame.localvars[operand] = a
+                a = stack.pop()
+                stack[base + operand] = a
 
             elif operator == OpLoadGlobal:
                 a = consts[operand]
-                frame.stack.append(env[a])
+                stack.append(env[a])
 
             elif operator == OpSetGlobal:
-                b = frame.stack.pop()
+                b = stack.pop()
                 s = consts[operand]
                 env[s] = b
 
             elif operator == OpLoadUpvar:
                 assert operand >= 0
                 var = frame.upvars[operand].get()
-                frame.stack.append(var)
+                stack.append(var)
 
             elif operator == OpSetUpvar:
                 assert operand >= 0
-                a = frame.stack.pop()
+                a = stack.pop()
                 frame.upvars[operand].set(a)
 
             elif operator == OpLoadVarg:
-                frame.stack.append(frame.varargs)
+                stack.append(frame.varargs)
 
             elif operator == OpLoadConst:
                 var = consts[operand]
-                frame.stack.append(var)
+                stack.append(var)
 
             elif operator == OpBinOp:
-                b = frame.stack.pop()
-                a = frame.stack.pop()
+                b = stack.pop()
+                a = stack.pop()
                 try:
-                    frame.stack.append(BinOps[operand][1](a, b))
+                    stack.append(BinOps[operand][1](a, b))
                 except KeyError:
                     raise VMException("Unknown BinOp '%s' " % operand)
 
             elif operator == OpUnOp:
-                a = frame.stack.pop()
+                a = stack.pop()
                 try:
                     symbol, unop = UnOps[operand]
-                    frame.stack.append(unop(a))
+                    stack.append(unop(a))
                 except KeyError:
                     raise VMException("Unknown UnOp '%s' " % operand)
 
             elif operator == OpCall:
                 assert operand >= 0
-
-                if operand == 0:
-                    args = []
-                else:
-                    args = frame.stack[-operand:]
-                    frame.stack = frame.stack[:-operand]
-                closure = frame.stack.pop()
+                closure = stack[-operand - 1]
 
                 if isinstance(closure, Closure):
                     proto = closure.proto
                     upvars = closure.upvars
-                    new_frame = Frame(proto, upvars, args)
-                    frame.saved_pc = pc
+                    new_frame = Frame(proto, upvars, stack, len(stack) - operand)
+                    # a frame resumes at the instruction after its call,
+                    # as in the handlers.
+                    frame.pc = pc + 1
 
                     frames.append(frame)
                     frame = new_frame
 
                     insts = frame.insts
+                    base = frame.base
                     pc = 0
                     continue
+                elif type(closure) is Memo:
+                    frame.pc = pc + 1
+                    frame = call_memo(self, frame, closure, operand)
+                    insts = frame.insts
+                    base = frame.base
+                    pc = frame.pc
+                    continue
                 else:
-                    ret = closure(*args)
-                    frame.stack.extend(ret or [])
+                    call_host(stack, closure, operand)
+                    debug = self.debug
 
             elif operator == OpTailCall:
-                if operand == 0:
-                    args = []
-                else:
-                    args = frame.stack[-operand:]
-                    frame.stack = frame.stack[:-operand]
-                closure = frame.stack.pop()
+                closure = stack[-operand - 1]
 
                 if isinstance(closure, Closure):
-                    proto = closure.proto
-                    upvars = closure.upvars
-                    frame = Frame(proto, upvars, args)
+                    frame = tail_frame(frame, closure, operand)
                     insts = frame.insts
                     pc = 0
                     continue
+                elif type(closure) is Memo:
+                    frame.pc = pc + 1
+                    frame = call_memo(self, frame, closure, operand)
+                    insts = frame.insts
+                    base = frame.base
+                    pc = frame.pc
+                    continue
                 else:
-                    ret = closure(*args)
-                    frame.stack.extend(ret or [])
+                    call_host(stack, closure, operand)
+                    debug = self.debug
 
             elif operator == OpRet:
-                rets = frame.stack[-operand:]
+                rets = stack[-operand:]
                 close_upvars(frame, 0)
+                del stack[base - 1:]
                 frame = frames.pop()
-                pc = frame.saved_pc
+                pc = frame.pc
                 insts = frame.insts
-                frame.stack.extend(rets)
+                base = frame.base
+                stack.extend(rets)
+                continue
 
             elif operator == OpJump:
                 pc += operand
@@ -211,13 +482,13 @@ class VM(object):
                 JUMP 2
                 LOAD B
                 """
-                isTrue = frame.stack.pop()
+                isTrue = stack.pop()
                 if not isTrue:
                     pc += operand
                     continue
 
             elif operator == OpPop:
-                frame.stack = frame.stack[:-operand]
+                del stack[-operand:]
 
             elif operator == OpCloseUpvar:
                 scope_index = operand
@@ -226,11 +497,840 @@ class VM(object):
             elif operator == OpBuildClosure:
                 proto = consts[operand]
                 closure = Closure(proto, frame)
-                frame.stack.append(closure)
+                stack.append(closure)
 
             elif operator == OpHalt:
                 return
             else:
-                raise VMException("Unknown VM instruction: %s" % operator)
+                # superinstructions are only implemented as handlers.
+                frame.pc = pc + 1
+                frame = self.handlers[operator](self, frame, operand)
+                insts = frame.insts
+                base = frame.base
+                pc = frame.pc
+                continue
 
             pc += 1
+
+
+class Switch(Exception):
+    """ raised by a task builtin to leave the running task """
+    pass
+
+
+SWITCH = Switch()
+# value of a task which has not run yet
+UNSTARTED = object()
+
+
+class Task(object):
+    """ a green thread, its frames and the value stack they share """
+    __slots__ = ["frames", "stack", "value", "done"]
+
+    def __init__(self, frames, stack):
+        self.frames = frames
+        self.stack = stack
+        # pushed as the value of the builtin call the task waits in.
+        self.value = UNSTARTED
+        self.done = False
+
+
+class Channel(object):
+    """
+    A queue between tasks holding up to 'capacity' values. With a capacity
+    of 0 a sender waits until a receiver takes its value.
+    """
+    __slots__ = ["capacity", "items", "senders", "receivers"]
+
+    def __init__(self, capacity=0):
+        self.capacity = capacity
+        self.items = deque()
+        # tasks waiting, with the values they send
+        self.senders = deque()
+        self.receivers = deque()
+
+
+class Scheduler(object):
+    """
+    Runs the program of 'vm' as the main task, together with the tasks it
+    spawns, on the table dispatch. Tasks are switched cooperatively, at
+    yield and when a send or receive has to wait.
+
+        scheduler = Scheduler(vm)
+        scheduler.install(vm.env)
+        scheduler.run()
+    """
+    def __init__(self, vm):
+        if vm.dispatch != VM.DISPATCH_TABLE:
+            raise VMException("Tasks need the table dispatch")
+        self.vm = vm
+        self.main = Task(vm.frames, vm.stack)
+        self.ready = deque([self.main])
+        self.current = None
+        self.switches = 0
+
+    def install(self, env):
+        env["spawn"] = self.spawn
+        env["yield"] = self.yield_
+        env["make-channel"] = self.make_channel
+        env["send"] = self.send
+        env["receive"] = self.receive
+        return env
+
+    def spawn(self, func, *args):
+        """ (spawn f arg*), run (f arg*) in a new task """
+        if not isinstance(func, Closure):
+            raise VMException("spawn expects a lisp function")
+        stack = []
+        halt = Frame(HALT_PROTO, [], stack, 0)
+        stack.append(func)
+        stack.extend(args)
+        task = Task([halt, Frame(func.proto, func.upvars, stack, 1)], stack)
+        self.ready.append(task)
+        return [task]
+
+    def yield_(self):
+        """ (yield), let the other ready tasks run """
+        self.ready.append(self.current)
+        raise SWITCH
+
+    def make_channel(self, capacity=0):
+        return [Channel(capacity)]
+
+    def send(self, channel, value):
+        """ (send channel value) """
+        if channel.receivers:
+            receiver = channel.receivers.popleft()
+            receiver.value = value
+            self.ready.append(receiver)
+        elif len(channel.items) < channel.capacity:
+            channel.items.append(value)
+        else:
+            channel.senders.append((self.current, value))
+            raise SWITCH
+        return [None]
+
+    def receive(self, channel):
+        """ (receive channel) """
+        if channel.items:
+            value = channel.items.popleft()
+            if channel.senders:
+                sender, pending = channel.senders.popleft()
+                channel.items.append(pending)
+                self.ready.append(sender)
+        elif channel.senders:
+            sender, value = channel.senders.popleft()
+            self.ready.append(sender)
+        else:
+            channel.receivers.append(self.current)
+            raise SWITCH
+        return [value]
+
+    def run(self):
+        """ run until no task is ready, the main task has to finish """
+        vm = self.vm
+        handlers = vm.handlers
+        ready = self.ready
+        while ready:
+            task = self.current = ready.popleft()
+            frame = task.frames.pop()
+            vm.frames = task.frames
+            if task.value is not UNSTARTED:
+                task.stack.append(task.value)
+            task.value = None
+            try:
+                while frame is not None:
+                    pc = frame.pc
+                    frame.pc = pc + 1
+                    operator, operand = frame.insts[pc]
+                    frame = handlers[operator](vm, frame, operand)
+                task.done = True
+            except IndexError:
+                if frame.pc <= len(frame.insts):
+                    raise
+                task.done = True
+            except Switch:
+                task.frames.append(frame)
+                self.switches += 1
+        self.current = None
+        if not self.main.done:
+            raise VMException("Deadlock, every task is waiting")
+
+
+def op_load_local(vm, frame, operand):
+    stack = frame.stack
+    stack.append(stack[frame.base + operand])
+    return frame
+
+
+def op_set_local(vm, frame, operand):
+    stack = frame.stack
+    stack[frame.base + operand] = stack.pop()
+    return frame
+
+
+def op_load_global(vm, frame, operand):
+    frame.stack.append(vm.env[vm.consts[operand]])
+    return frame
+
+
+def op_set_global(vm, frame, operand):
+    vm.env[vm.consts[operand]] = frame.stack.pop()
+    return frame
+
+
+def op_load_global_quicken(vm, frame, operand):
+    name = vm.consts[operand]
+    frame.stack.append(vm.env[name])
+    frame.insts[frame.pc - 1] = (OpLoadGlobalSlot, vm.env.slot(name))
+    return frame
+
+
+def op_set_global_quicken(vm, frame, operand):
+    name = vm.consts[operand]
+    vm.env[name] = frame.stack.pop()
+    frame.insts[frame.pc - 1] = (OpSetGlobalSlot, vm.env.slot(name))
+    return frame
+
+
+def op_load_global_slot(vm, frame, operand):
+    try:
+        value = vm.globals[operand]
+    except IndexError:
+        # interned by another Globals after this one last grew.
+        vm.env.grow()
+        value = UNBOUND
+    if value is UNBOUND:
+        raise KeyError(SLOT_NAMES[operand])
+    frame.stack.append(value)
+    return frame
+
+
+def op_set_global_slot(vm, frame, operand):
+    value = frame.stack.pop()
+    dict.__setitem__(vm.env, SLOT_NAMES[operand], value)
+    try:
+        vm.globals[operand] = value
+    except IndexError:
+        vm.env.grow()
+        vm.globals[operand] = value
+    return frame
+
+
+def op_load_global_slot_dict(vm, frame, operand):
+    frame.stack.append(vm.env[SLOT_NAMES[operand]])
+    return frame
+
+
+def op_set_global_slot_dict(vm, frame, operand):
+    vm.env[SLOT_NAMES[operand]] = frame.stack.pop()
+    return frame
+
+
+def op_load_upvar(vm, frame, operand):
+    frame.stack.append(frame.upvars[operand].get())
+    return frame
+
+
+def op_set_upvar(vm, frame, operand):
+    frame.upvars[operand].set(frame.stack.pop())
+    return frame
+
+
+def op_load_varg(vm, frame, operand):
+    frame.stack.append(frame.varargs)
+    return frame
+
+
+def op_load_const(vm, frame, operand):
+    frame.stack.append(vm.consts[operand])
+    return frame
+
+
+def op_binop(vm, frame, operand):
+    stack = frame.stack
+    b = stack.pop()
+    if operand == BinOpCons:
+        stack[-1] = LinkList(stack[-1], b)
+        return frame
+    try:
+        binop = BinOps[operand][1]
+    except KeyError:
+        raise VMException("Unknown BinOp '%s' " % operand)
+    # the result replaces the first operand in place.
+    stack[-1] = binop(stack[-1], b)
+    return frame
+
+
+def op_unop(vm, frame, operand):
+    stack = frame.stack
+    a = stack[-1]
+    # anything but a cell goes to runtime.car/cdr, which raise.
+    if type(a) is LinkList:
+        if operand == UnOpCar:
+            stack[-1] = a.v
+            return frame
+        elif operand == UnOpCdr:
+            stack[-1] = a.next
+            return frame
+    try:
+        unop = UnOps[operand][1]
+    except KeyError:
+        raise VMException("Unknown UnOp '%s' " % operand)
+    stack[-1] = unop(stack[-1])
+    return frame
+
+
+def call_native(stack, native, argn):
+    """ call a Native with the top 'argn' values, its value replaces the callee """
+    argc = native.argc
+    if argc is not None and argc != argn:
+        raise VMException("Expect %s arguments, got %s" % (argc, argn))
+    if argn == 1:
+        a = stack.pop()
+        stack[-1] = native.func(a)
+    elif argn == 2:
+        b = stack.pop()
+        a = stack.pop()
+        stack[-1] = native.func(a, b)
+    elif argn == 0:
+        stack[-1] = native.func()
+    else:
+        args = stack[-argn:]
+        del stack[-argn:]
+        stack[-1] = native.func(*args)
+
+
+def call_host(stack, func, argn):
+    """ call a python function with the top 'argn' values as arguments """
+    if type(func) is Native:
+        call_native(stack, func, argn)
+        return
+    top = len(stack)
+    args = stack[top - argn:]
+    del stack[top - argn - 1:]
+    ret = func(*args)
+    if ret:
+        if type(ret) is not list and is_awaitable(ret):
+            raise Suspend(ret)
+        stack.extend(ret)
+
+
+def cache_call(insts, pc, op, argc, proto):
+    """ quicken the call before 'pc' to an inline cache of 'proto' """
+    if not proto.isVararg:
+        padding = (None,) * (proto.maxLocalvars - argc)
+        insts[pc - 1] = (op, (argc, proto, padding))
+
+
+def call_memo(vm, frame, memo, argn):
+    """
+    call a Memo with the top 'argn' values. A cached value replaces the
+    call, otherwise a closure returns into a frame of MEMO_PROTO, whose
+    upvars are (memo, key), which caches its value and returns it on.
+    """
+    stack = frame.stack
+    top = len(stack)
+    key, value = memo.lookup(stack[top - argn:])
+    if value is not MISSING:
+        del stack[top - argn - 1:]
+        stack.append(value)
+        return frame
+    func = stack[top - argn - 1] = memo.func
+    if not isinstance(func, Closure):
+        call_host(stack, func, argn)
+        # a host function may return no value at all.
+        if len(stack) == top - argn:
+            memo.store(key, stack[-1])
+        return frame
+    # built first, it checks the arity before any frame is pushed.
+    callee = Frame(func.proto, func.upvars, stack, top - argn)
+    vm.frames.append(frame)
+    vm.frames.append(Frame(MEMO_PROTO, (memo, key), stack, top))
+    return callee
+
+
+def op_call(vm, frame, operand):
+    stack = frame.stack
+    closure = stack[-operand - 1]
+    if isinstance(closure, Closure):
+        callee = Frame(closure.proto, closure.upvars, stack, len(stack) - operand)
+        cache_call(frame.insts, frame.pc, OpCallCached, operand, closure.proto)
+        vm.frames.append(frame)
+        return callee
+    if type(closure) is Native:
+        call_native(stack, closure, operand)
+        return frame
+    if type(closure) is Memo:
+        return call_memo(vm, frame, closure, operand)
+    call_host(stack, closure, operand)
+    return frame
+
+
+def op_tail_call(vm, frame, operand):
+    stack = frame.stack
+    closure = stack[-operand - 1]
+    if isinstance(closure, Closure):
+        # the frame is reused, the call is cached once its arity is checked.
+        insts, pc = frame.insts, frame.pc
+        callee = tail_frame(frame, closure, operand)
+        cache_call(insts, pc, OpTailCallCached, operand, closure.proto)
+        return callee
+    if type(closure) is Native:
+        call_native(stack, closure, operand)
+        return frame
+    if type(closure) is Memo:
+        # not a tail call, its value is cached before the frame returns.
+        return call_memo(vm, frame, closure, operand)
+    call_host(stack, closure, operand)
+    return frame
+
+
+def op_memo_store(vm, frame, operand):
+    memo, key = frame.upvars
+    memo.store(key, frame.stack[-1])
+    return vm.frames.pop()
+
+
+def op_call_cached(vm, frame, operand):
+    """
+    A call which last went to 'proto'. Calling it again needs no type or
+    arity check, any other callee takes the generic path, which caches it.
+    """
+    argc, proto, padding = operand
+    stack = frame.stack
+    closure = stack[-argc - 1]
+    try:
+        hit = closure.proto is proto
+    except AttributeError:
+        hit = False
+    if hit:
+        vm.ic_hits += 1
+        vm.frames.append(frame)
+        callee = new(Frame)
+        callee.proto = proto
+        callee.insts = proto.insts
+        callee.upvars = closure.upvars
+        callee.stack = stack
+        callee.base = len(stack) - argc
+        callee.pc = 0
+        callee.open_upvars = None
+        if padding:
+            stack.extend(padding)
+        return callee
+    vm.ic_misses += 1
+    return op_call(vm, frame, argc)
+
+
+def op_tail_call_cached(vm, frame, operand):
+    argc, proto, padding = operand
+    stack = frame.stack
+    closure = stack[-argc - 1]
+    try:
+        hit = closure.proto is proto
+    except AttributeError:
+        hit = False
+    if hit:
+        vm.ic_hits += 1
+        if frame.open_upvars:
+            close_upvars(frame, 0)
+        stack[frame.base - 1:] = stack[-argc - 1:]
+        # the callee takes over the frame, see tail_frame.
+        frame.proto = proto
+        frame.insts = proto.insts
+        frame.upvars = closure.upvars
+        frame.pc = 0
+        if padding:
+            stack.extend(padding)
+        return frame
+    vm.ic_misses += 1
+    return op_tail_call(vm, frame, argc)
+
+
+def op_ret(vm, frame, operand):
+    stack = frame.stack
+    if frame.open_upvars:
+        close_upvars(frame, 0)
+    if operand == 1:
+        value = stack[-1]
+        del stack[frame.base - 1:]
+        stack.append(value)
+    else:
+        rets = stack[-operand:]
+        del stack[frame.base - 1:]
+        stack.extend(rets)
+    return vm.frames.pop()
+
+
+def op_jump(vm, frame, operand):
+    # frame.pc already points past the jump.
+    frame.pc += operand - 1
+    return frame
+
+
+def op_test(vm, frame, operand):
+    if not frame.stack.pop():
+        frame.pc += operand - 1
+    return frame
+
+
+def op_pop(vm, frame, operand):
+    del frame.stack[-operand:]
+    return frame
+
+
+def op_close_upvar(vm, frame, operand):
+    close_upvars(frame, operand)
+    return frame
+
+
+def op_build_closure(vm, frame, operand):
+    frame.stack.append(Closure(vm.consts[operand], frame))
+    return frame
+
+
+def op_local_const_binop(vm, frame, operand):
+    local, const, binop = operand
+    stack = frame.stack
+    stack.append(BinOps[binop][1](stack[frame.base + local], vm.consts[const]))
+    return frame
+
+
+def op_local_local_binop(vm, frame, operand):
+    a, b, binop = operand
+    stack = frame.stack
+    base = frame.base
+    stack.append(BinOps[binop][1](stack[base + a], stack[base + b]))
+    return frame
+
+
+def op_binop_test(vm, frame, operand):
+    binop, offset = operand
+    stack = frame.stack
+    b = stack.pop()
+    if not BinOps[binop][1](stack.pop(), b):
+        frame.pc += offset - 1
+    return frame
+
+
+# deopts of one instruction after which it stays generic.
+MAX_DEOPTS = 4
+
+
+class Specialization(object):
+    """ adaptive quickening of one FunctionProto """
+    __slots__ = ["specialized", "deopts", "sites"]
+
+    def __init__(self):
+        # instructions written to a specialized form, and back
+        self.specialized = 0
+        self.deopts = 0
+        # pc => deopts of the instruction there
+        self.sites = {}
+
+
+def specialization(vm, proto):
+    try:
+        return vm.specializations[proto]
+    except KeyError:
+        spec = vm.specializations[proto] = Specialization()
+        return spec
+
+
+def specialize(vm, frame, pc, inst):
+    """ write 'inst' over the instruction at 'pc' which 'frame' just ran """
+    spec = specialization(vm, frame.proto)
+    if spec.sites.get(pc, 0) < MAX_DEOPTS:
+        frame.insts[pc] = inst
+        spec.specialized += 1
+
+
+def deopt(vm, frame, inst):
+    """
+    the guard of the running instruction failed, write the generic 'inst'
+    back and run it instead. The operands must be back on the stack.
+    """
+    pc = frame.pc - 1
+    frame.insts[pc] = inst
+    frame.pc = pc
+    spec = specialization(vm, frame.proto)
+    spec.deopts += 1
+    spec.sites[pc] = spec.sites.get(pc, 0) + 1
+    return frame
+
+
+def op_binop_adaptive(vm, frame, operand):
+    stack = frame.stack
+    a, b = stack[-2:]
+    op_binop(vm, frame, operand)
+    if operand == BinOpCons:
+        specialize(vm, frame, frame.pc - 1, (OpBinOpCons, operand))
+    elif type(a) is int and type(b) is int:
+        specialize(vm, frame, frame.pc - 1, (OpBinOpInt, operand))
+    elif type(a) is float and type(b) is float:
+        specialize(vm, frame, frame.pc - 1, (OpBinOpFloat, operand))
+    return frame
+
+
+def op_unop_adaptive(vm, frame, operand):
+    a = frame.stack[-1]
+    op_unop(vm, frame, operand)
+    if type(a) is LinkList and operand in (UnOpCar, UnOpCdr):
+        specialize(vm, frame, frame.pc - 1, (OpUnOpList, operand))
+    return frame
+
+
+def op_local_const_binop_adaptive(vm, frame, operand):
+    local, const, binop = operand
+    op_local_const_binop(vm, frame, operand)
+    value = vm.consts[const]
+    if binop == BinOpCons:
+        return frame
+    if type(frame.stack[frame.base + local]) is int and type(value) is int:
+        specialize(vm, frame, frame.pc - 1,
+                   (OpLocalConstBinOpInt, (local, const, binop, value)))
+    return frame
+
+
+def op_local_local_binop_adaptive(vm, frame, operand):
+    a, b, binop = operand
+    op_local_local_binop(vm, frame, operand)
+    if binop == BinOpCons:
+        # its second operand is a list once the first cell is built.
+        return frame
+    stack = frame.stack
+    base = frame.base
+    if type(stack[base + a]) is int and type(stack[base + b]) is int:
+        specialize(vm, frame, frame.pc - 1, (OpLocalLocalBinOpInt, operand))
+    return frame
+
+
+def op_binop_test_adaptive(vm, frame, operand):
+    stack = frame.stack
+    a, b = stack[-2:]
+    # the test may jump, the pc is taken before it runs.
+    pc = frame.pc - 1
+    op_binop_test(vm, frame, operand)
+    if type(a) is int and type(b) is int:
+        specialize(vm, frame, pc, (OpBinOpTestInt, operand))
+    return frame
+
+
+def op_binop_int(vm, frame, operand):
+    stack = frame.stack
+    b = stack.pop()
+    a = stack[-1]
+    if type(a) is not int or type(b) is not int:
+        stack.append(b)
+        return deopt(vm, frame, (OpBinOp, operand))
+    if operand == BinOpAdd:
+        stack[-1] = a + b
+    elif operand == BinOpSub:
+        stack[-1] = a - b
+    elif operand == BinOpGt:
+        stack[-1] = a > b
+    elif operand == BinOpEq:
+        stack[-1] = a == b
+    else:
+        stack[-1] = BinOps[operand][1](a, b)
+    return frame
+
+
+def op_binop_float(vm, frame, operand):
+    stack = frame.stack
+    b = stack.pop()
+    a = stack[-1]
+    if type(a) is not float or type(b) is not float:
+        stack.append(b)
+        return deopt(vm, frame, (OpBinOp, operand))
+    if operand == BinOpAdd:
+        stack[-1] = a + b
+    elif operand == BinOpSub:
+        stack[-1] = a - b
+    elif operand == BinOpGt:
+        stack[-1] = a > b
+    elif operand == BinOpEq:
+        stack[-1] = a == b
+    else:
+        stack[-1] = BinOps[operand][1](a, b)
+    return frame
+
+
+def op_binop_cons(vm, frame, operand):
+    # cons takes anything, there is nothing to guard.
+    stack = frame.stack
+    b = stack.pop()
+    stack[-1] = LinkList(stack[-1], b)
+    return frame
+
+
+def op_unop_list(vm, frame, operand):
+    stack = frame.stack
+    a = stack[-1]
+    if type(a) is not LinkList:
+        return deopt(vm, frame, (OpUnOp, operand))
+    stack[-1] = a.v if operand == UnOpCar else a.next
+    return frame
+
+
+def op_local_const_binop_int(vm, frame, operand):
+    local, const, binop, value = operand
+    stack = frame.stack
+    a = stack[frame.base + local]
+    if type(a) is not int:
+        return deopt(vm, frame, (OpLocalConstBinOp, (local, const, binop)))
+    if binop == BinOpAdd:
+        stack.append(a + value)
+    elif binop == BinOpSub:
+        stack.append(a - value)
+    elif binop == BinOpGt:
+        stack.append(a > value)
+    elif binop == BinOpEq:
+        stack.append(a == value)
+    else:
+        stack.append(BinOps[binop][1](a, value))
+    return frame
+
+
+def op_local_local_binop_int(vm, frame, operand):
+    x, y, binop = operand
+    stack = frame.stack
+    base = frame.base
+    a = stack[base + x]
+    b = stack[base + y]
+    if type(a) is not int or type(b) is not int:
+        return deopt(vm, frame, (OpLocalLocalBinOp, operand))
+    if binop == BinOpAdd:
+        stack.append(a + b)
+    elif binop == BinOpSub:
+        stack.append(a - b)
+    elif binop == BinOpGt:
+        stack.append(a > b)
+    elif binop == BinOpEq:
+        stack.append(a == b)
+    else:
+        stack.append(BinOps[binop][1](a, b))
+    return frame
+
+
+def op_binop_test_int(vm, frame, operand):
+    binop, offset = operand
+    stack = frame.stack
+    b = stack.pop()
+    a = stack.pop()
+    if type(a) is not int or type(b) is not int:
+        stack.append(a)
+        stack.append(b)
+        return deopt(vm, frame, (OpBinOpTest, operand))
+    if binop == BinOpGt:
+        true = a > b
+    elif binop == BinOpEq:
+        true = a == b
+    else:
+        true = BinOps[binop][1](a, b)
+    if not true:
+        frame.pc += offset - 1
+    return frame
+
+
+def op_halt(vm, frame, operand):
+    return None
+
+
+def op_unknown(vm, frame, operand):
+    operator = frame.insts[frame.pc - 1][0]
+    raise VMException("Unknown VM instruction: %s" % operator)
+
+
+def make_handlers(table):
+    handlers = [op_unknown] * (max(VMOps) + 1)
+    for operator, handler in table.items():
+        handlers[operator] = handler
+    return handlers
+
+
+def traced(handler):
+    def trace(vm, frame, operand):
+        print vm.inst2str(frame.insts[frame.pc - 1])
+        return handler(vm, frame, operand)
+    return trace
+
+
+HANDLERS = make_handlers({
+    OpLoadLocal: op_load_local,
+    OpSetLocal: op_set_local,
+    OpLoadGlobal: op_load_global_quicken,
+    OpSetGlobal: op_set_global_quicken,
+    OpLoadGlobalSlot: op_load_global_slot,
+    OpSetGlobalSlot: op_set_global_slot,
+    OpLoadUpvar: op_load_upvar,
+    OpSetUpvar: op_set_upvar,
+    OpLoadVarg: op_load_varg,
+    OpLoadConst: op_load_const,
+    OpBinOp: op_binop,
+    OpUnOp: op_unop,
+    OpCall: op_call,
+    OpTailCall: op_tail_call,
+    OpCallCached: op_call_cached,
+    OpTailCallCached: op_tail_call_cached,
+    OpRet: op_ret,
+    OpJump: op_jump,
+    OpTest: op_test,
+    OpPop: op_pop,
+    OpCloseUpvar: op_close_upvar,
+    OpBuildClosure: op_build_closure,
+    OpHalt: op_halt,
+    OpLocalConstBinOp: op_local_const_binop,
+    OpLocalLocalBinOp: op_local_local_binop,
+    OpBinOpTest: op_binop_test,
+    OpBinOpInt: op_binop_int,
+    OpBinOpFloat: op_binop_float,
+    OpBinOpCons: op_binop_cons,
+    OpUnOpList: op_unop_list,
+    OpLocalConstBinOpInt: op_local_const_binop_int,
+    OpLocalLocalBinOpInt: op_local_local_binop_int,
+    OpBinOpTestInt: op_binop_test_int,
+    OpMemoStore: op_memo_store,
+})
+
+TRACED_HANDLERS = [traced(handler) for handler in HANDLERS]
+
+# for an env which is not a Globals, code quickened by another VM still runs.
+DICT_HANDLERS = list(HANDLERS)
+DICT_HANDLERS[OpLoadGlobal] = op_load_global
+DICT_HANDLERS[OpSetGlobal] = op_set_global
+DICT_HANDLERS[OpLoadGlobalSlot] = op_load_global_slot_dict
+DICT_HANDLERS[OpSetGlobalSlot] = op_set_global_slot_dict
+
+TRACED_DICT_HANDLERS = [traced(handler) for handler in DICT_HANDLERS]
+
+# in adaptive mode the generic handlers also specialize their instruction.
+SPECIALIZED = frozenset([OpBinOpInt, OpBinOpFloat, OpBinOpCons, OpUnOpList,
+                         OpLocalConstBinOpInt, OpLocalLocalBinOpInt,
+                         OpBinOpTestInt])
+ADAPTIVE = {
+    OpBinOp: op_binop_adaptive,
+    OpUnOp: op_unop_adaptive,
+    OpLocalConstBinOp: op_local_const_binop_adaptive,
+    OpLocalLocalBinOp: op_local_local_binop_adaptive,
+    OpBinOpTest: op_binop_test_adaptive,
+}
+
+
+def adaptive_handlers(handlers):
+    handlers = list(handlers)
+    for operator, handler in ADAPTIVE.items():
+        handlers[operator] = handler
+    return handlers
+
+
+ADAPTIVE_HANDLERS = adaptive_handlers(HANDLERS)
+ADAPTIVE_DICT_HANDLERS = adaptive_handlers(DICT_HANDLERS)
+
+# (handlers, traced handlers) of a VM
+TABLES = (HANDLERS, TRACED_HANDLERS)
+DICT_TABLES = (DICT_HANDLERS, TRACED_DICT_HANDLERS)
+ADAPTIVE_TABLES = (ADAPTIVE_HANDLERS,
+                   [traced(handler) for handler in ADAPTIVE_HANDLERS])
+ADAPTIVE_DICT_TABLES = (ADAPTIVE_DICT_HANDLERS,
+                        [traced(handler) for handler in ADAPTIVE_DICT_HANDLERS])